@@ -0,0 +1,86 @@
+"""
+日次予定送信ジョブの非同期実行
+/api/send_daily_agenda からジョブを登録し、バックグラウンドのワーカースレッドで
+送信タスクを処理する。タスクはDBでリース管理されるため、cronサービスや
+専用ワーカー（python send_daily_agenda.py worker）と同時に動いても各ユーザーへの送信は1回だけになる。
+"""
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from config import Config
+from db import get_db
+
+logger = logging.getLogger(__name__)
+
+
+class AgendaJobRunner:
+    """日次予定送信ジョブの登録と、プロセス内ワーカースレッドの管理"""
+
+    def __init__(self, db_helper=None, worker_count=None):
+        self._db_helper = db_helper
+        self.worker_count = worker_count or Config.AGENDA_LOCAL_WORKERS
+        self._lock = threading.Lock()
+        self._workers = {}
+
+    @property
+    def db_helper(self):
+        # 指定がなければプロセス共有のDBHelperを使う（fork後に作成される）
+        return self._db_helper or get_db()
+
+    def enqueue(self, target_date=None):
+        """明日（またはtarget_date）のジョブを登録してジョブIDを返す"""
+        # 送信処理（send_daily_agenda）はジョブを登録するときに初めて読み込む（Webワーカーの起動を軽くする）
+        from send_daily_agenda import enqueue_agenda_run
+        target_date = target_date or datetime.now().date() + timedelta(days=1)
+        job_id = enqueue_agenda_run(self.db_helper, target_date)
+        self._start_workers(job_id)
+        return job_id
+
+    def _start_workers(self, job_id):
+        # gunicornのfork後に初めて呼ばれたプロセスでスレッドを起動する
+        with self._lock:
+            alive = [t for t in self._workers.get(job_id, []) if t.is_alive()]
+            for i in range(len(alive), self.worker_count):
+                thread = threading.Thread(
+                    target=self._run,
+                    args=(job_id,),
+                    name=f'agenda-worker-{i}',
+                    daemon=True
+                )
+                thread.start()
+                alive.append(thread)
+            self._workers[job_id] = alive
+
+    def _run(self, job_id):
+        from send_daily_agenda import run_agenda_worker
+        try:
+            run_agenda_worker(job_id, self.db_helper)
+        except Exception as e:
+            logger.error(f"日次予定送信ワーカーでエラーが発生しました: job_id={job_id}, error={e}")
+
+    def get_status(self, job_id):
+        """ジョブの進捗（完了数・失敗数・残り・スループット）を返す"""
+        job = self.db_helper.get_agenda_job(job_id)
+        if not job:
+            return None
+        counts = self.db_helper.get_agenda_task_counts(job_id)
+        processed = counts['done'] + counts['failed']
+        job['total'] = sum(counts.values())
+        job['done'] = counts['done']
+        job['failed'] = counts['failed']
+        job['in_progress'] = counts['leased']
+        job['remaining'] = counts['pending'] + counts['leased']
+        job['elapsed_seconds'] = None
+        job['throughput_per_sec'] = None
+        if job['started_at']:
+            started = datetime.fromisoformat(job['started_at'])
+            finished = datetime.fromisoformat(job['finished_at']) if job['finished_at'] else datetime.utcnow()
+            elapsed = max((finished - started).total_seconds(), 0.0)
+            job['elapsed_seconds'] = round(elapsed, 1)
+            if elapsed > 0:
+                job['throughput_per_sec'] = round(processed / elapsed, 2)
+        report_json = self.db_helper.get_agenda_run_report(job_id)
+        job['report'] = json.loads(report_json) if report_json else None
+        return job
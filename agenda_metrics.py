@@ -0,0 +1,162 @@
+"""
+日次予定送信の計測
+ユーザーごとの段階別処理時間（認証情報の読み込み・予定取得・メッセージ生成・プッシュ送信）を記録し、
+ジョブ完了時にヒストグラム・遅いユーザー・エラー分類別件数の集計レポートを作る
+"""
+import bisect
+import heapq
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import DEFAULT_BUCKETS_MS, registry
+
+STAGES = ('credential_load', 'calendar_fetch', 'render', 'push')
+SLOWEST_USERS_LIMIT = 10
+
+STAGE_DURATION_MS = registry.histogram(
+    'agenda_stage_duration_ms', '日次予定送信の段階別処理時間（ミリ秒）')
+USER_DURATION_MS = registry.histogram(
+    'agenda_user_duration_ms', '日次予定送信のユーザーあたり処理時間（ミリ秒）')
+USERS_PROCESSED = registry.counter(
+    'agenda_users_processed_total', '日次予定送信の処理ユーザー数（result=done/failed）')
+USER_ERRORS = registry.counter(
+    'agenda_user_errors_total', '日次予定送信のエラー件数（error_class別）')
+LAST_RUN_USERS = registry.gauge(
+    'agenda_last_run_users', '直近に完了したジョブの処理ユーザー数（result別）')
+LAST_RUN_WALL_SECONDS = registry.gauge(
+    'agenda_last_run_wall_seconds', '直近に完了したジョブの所要時間（秒）')
+LAST_RUN_STAGE_P95_MS = registry.gauge(
+    'agenda_last_run_stage_p95_ms', '直近に完了したジョブの段階別処理時間のp95（ミリ秒）')
+
+
+class StageTimer:
+    """1ユーザー分の段階別処理時間を計測する"""
+
+    def __init__(self):
+        self.stage_ms = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.stage_ms[name] = self.stage_ms.get(name, 0) + int(round(elapsed_ms))
+            STAGE_DURATION_MS.observe(elapsed_ms, stage=name)
+
+    def total_ms(self):
+        return int(round((time.perf_counter() - self._started) * 1000))
+
+
+def record_user_result(timer, error_class):
+    """1ユーザー分の結果をプロセス内メトリクスに反映"""
+    USER_DURATION_MS.observe(timer.total_ms())
+    USERS_PROCESSED.inc(result='failed' if error_class else 'done')
+    if error_class:
+        USER_ERRORS.inc(error_class=error_class)
+
+
+class _StageStats:
+    """バケット件数・合計・最大値から近似パーセンタイルを求める"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum_ms = 0
+        self.max_ms = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum_ms += value
+        self.max_ms = max(self.max_ms, value)
+
+    def percentile(self, ratio):
+        # 該当バケットの上限値（最大値を超える場合は最大値）を返す
+        if not self.count:
+            return None
+        target = ratio * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(self.buckets[i], self.max_ms) if i < len(self.buckets) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self):
+        histogram = {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+        histogram['+Inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'sum_ms': self.sum_ms,
+            'avg_ms': round(self.sum_ms / self.count, 1) if self.count else None,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'max_ms': self.max_ms if self.count else None,
+            'histogram': histogram
+        }
+
+
+def build_agenda_run_report(db, job_id):
+    """ジョブのユーザーごとの計測値を集計してレポート（dict）を返す
+
+    計測値はキーセットページングで読み、ヒストグラムと上位N件だけを保持する。
+    """
+    stage_stats = {stage: _StageStats() for stage in STAGES + ('total',)}
+    slowest = []
+    errors_by_class = {}
+    users = 0
+    failed = 0
+
+    for row in db.iter_agenda_task_metrics(job_id):
+        users += 1
+        for stage in STAGES:
+            value = row['stage_ms'].get(stage)
+            if value is not None:
+                stage_stats[stage].add(value)
+        total_ms = row['total_ms'] or 0
+        stage_stats['total'].add(total_ms)
+        if row['error_class']:
+            failed += 1
+            errors_by_class[row['error_class']] = errors_by_class.get(row['error_class'], 0) + 1
+        entry = (total_ms, row['line_user_id'], row['stage_ms'], row['error_class'])
+        if len(slowest) < SLOWEST_USERS_LIMIT:
+            heapq.heappush(slowest, entry)
+        elif total_ms > slowest[0][0]:
+            heapq.heapreplace(slowest, entry)
+
+    job = db.get_agenda_job(job_id) or {}
+    wall_seconds = None
+    if job.get('started_at'):
+        started = datetime.fromisoformat(job['started_at'])
+        finished = datetime.fromisoformat(job['finished_at']) if job.get('finished_at') else datetime.utcnow()
+        wall_seconds = round((finished - started).total_seconds(), 1)
+
+    return {
+        'job_id': job_id,
+        'users': users,
+        'done': users - failed,
+        'failed': failed,
+        'wall_seconds': wall_seconds,
+        'stages': {stage: stats.to_dict() for stage, stats in stage_stats.items()},
+        'slowest_users': [
+            {'line_user_id': user_id, 'total_ms': total_ms, 'stage_ms': stage_ms, 'error_class': error_class}
+            for total_ms, user_id, stage_ms, error_class in sorted(slowest, key=lambda e: e[0], reverse=True)
+        ],
+        'errors_by_class': errors_by_class
+    }
+
+
+def publish_run_report(report):
+    """集計レポートの主要値をゲージとして公開"""
+    LAST_RUN_USERS.set(report['done'], result='done')
+    LAST_RUN_USERS.set(report['failed'], result='failed')
+    if report['wall_seconds'] is not None:
+        LAST_RUN_WALL_SECONDS.set(report['wall_seconds'])
+    for stage, stats in report['stages'].items():
+        if stats['p95_ms'] is not None:
+            LAST_RUN_STAGE_P95_MS.set(stats['p95_ms'], stage=stage)
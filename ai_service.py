@@ -4,21 +4,44 @@ from dateutil import parser
 import re
 import json
 from config import Config
+from deadline import DeadlineExceeded, current_deadline, stage_timed_out, stage_timeout, allows_optional
+from http_clients import openai_client
+from tracing import span
 import calendar
 import pytz
 import logging
 
 logger = logging.getLogger("ai_service")
-logger.setLevel(logging.INFO)
-if not logger.hasHandlers():
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+# extract_dates_and_timesで日時を抽出できなかった場合のエラーメッセージ
+DATES_EXTRACTION_ERROR = "イベント情報を正しく認識できませんでした。\n\n・日時を打つと空き時間を返します\n・予定を打つとカレンダーに追加します\n\n例：\n『明日の午前9時から会議を追加して』\n『来週月曜日の14時から打ち合わせ』"
 
 class AIService:
     def __init__(self):
-        self.client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
+        if not Config.OPENAI_API_KEY:
+            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        """同期クライアント（プロセスで共有するクライアント。gunicornの--preloadではfork後のワーカーで接続プールを作る）"""
+        if self._client is None:
+            self._client = openai_client()
+        return self._client
+
+    @property
+    def async_client(self):
+        """非同期クライアント（イベントループ内で最初に使われたときに作成し、接続プールを共有する）"""
+        if self._async_client is None:
+            self._async_client = openai.AsyncOpenAI(api_key=Config.OPENAI_API_KEY)
+        return self._async_client
+
+    async def aclose(self):
+        """非同期クライアントの接続を閉じる"""
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
     
     def _get_jst_now_str(self):
         now = datetime.now(pytz.timezone('Asia/Tokyo'))
@@ -26,82 +49,129 @@ class AIService:
     
     def extract_dates_and_times(self, text):
         """テキストから日時を抽出し、タスクの種類を判定します"""
-        try:
-            now_jst = self._get_jst_now_str()
-            system_prompt = (
-                f"あなたは予定とタスクを管理するAIです。\n"
-                f"現在の日時（日本時間）は {now_jst} です。  \n"
-                "【最重要】ユーザーの入力が箇条書き・改行・スペース・句読点で区切られている場合も、全ての時間帯・枠を必ず個別に抽出してください。\n"
-                "この日時は、すべての自然言語の解釈において**常に絶対的な基準**としてください。  \n"
-                "会話の流れや前回の入力に引きずられることなく、**毎回この現在日時を最優先にしてください。**\n"
-                "\n"
-                "あなたは日時抽出とタスク管理の専門家です。ユーザーのテキストを分析して、以下のJSON形式で返してください。\n\n"
-                "分析ルール:\n"
-                "1. 複数の日時がある場合は全て抽出\n"
-                "2. 日本語の日付表現（今日、明日、来週、再来週、来月など）を具体的な日付に変換\n"
-                "3. 月が指定されていない場合（例：16日、17日）は今月として認識\n"
-                "4. 時間表現（午前9時、14時30分、9-10時、9時-10時、9:00-10:00など）を24時間形式に変換\n"
-                "5. **タスクの種類を判定（最重要）**:\n   - 日時のみ（タイトルや内容がない）場合は必ず「availability_check」（空き時間確認）\n   - 日時+タイトル/予定内容がある場合は「add_event」（予定追加）\n   - 例：「7/8 18時以降」→ availability_check（日時のみ）\n   - 例：「7/10 18:00〜20:00」→ availability_check（日時のみ）\n   - 例：「・7/10 9-10時\n・7/11 9-10時」→ availability_check（日時のみ複数）\n   - 例：「7/10 9-10時」→ availability_check（9:00〜10:00として抽出）\n   - 例：「7/10 9時-10時」→ availability_check（9:00〜10:00として抽出）\n   - 例：「7/10 9:00-10:00」→ availability_check（9:00〜10:00として抽出）\n   - 例：「7月18日 11:00-14:00,15:00-17:00」→ availability_check（日時のみ複数）\n   - 例：「7月20日 13:00-0:00」→ availability_check（日時のみ）\n   - 例：「明日の午前9時から会議を追加して」→ add_event（日時+予定内容）\n   - 例：「来週月曜日の14時から打ち合わせ」→ add_event（日時+予定内容）\n   - 例：「田中さんとMTG」→ add_event（予定内容あり）\n   - 例：「会議を追加」→ add_event（予定内容あり）\n"
-                "6. 自然言語の時間表現は必ず具体的な時刻範囲・日付範囲に変換してください。\n"
-                "   例：'18時以降'→'18:00〜23:59'、'終日'→'00:00〜23:59'、'今日'→'現在時刻〜23:59'、'今日から1週間'→'今日〜7日後の23:59'。\n"
-                "   例：'来週'→'来週の月曜日〜日曜日'、'再来週'→'再来週の月曜日〜日曜日'、'来月'→'来月の1日〜末日'。\n"
-                "   終了時間が指定されていない場合は1時間の予定として認識してください（例：'10時'→'10:00〜11:00'）。\n"
-                "7. 箇条書き（・や-）、改行、スペース、句読点で区切られている場合も、すべての日時・時間帯を抽出してください。\n"
-                "   例：'・7/10 9-10時\n・7/11 9-10時' → 2件の予定として抽出\n"
-                "   例：'7/11 15:00〜16:00 18:00〜19:00' → 2件の予定として抽出\n"
-                "   例：'7/12 終日' → 1件の終日予定として抽出\n"
-                "8. 同じ日付の終日予定は1件だけ抽出してください。\n"
-                "9. 予定タイトル（description）も必ず抽出してください。\n"
-                "10. \"終日\"や\"00:00〜23:59\"の終日枠は、ユーザーが明示的に\"終日\"と書いた場合のみ抽出してください。\n"
-                "11. 1つの日付に複数の時間帯（枠）が指定されている場合は、必ずその枠ごとに抽出してください。\n"
-                "12. 同じ日に部分枠（例: 15:00〜16:00, 18:00〜19:00）がある場合は、その日付の終日枠（00:00〜23:59）は抽出しないでください。\n"
-                "13. 複数の日時・時間帯が入力される場合、全ての時間帯をリストにし、それぞれに対して開始時刻・終了時刻をISO形式（例: 2025-07-11T15:00:00+09:00）で出力してください。\n"
-                "14. 予定タイトル（会議名や打合せ名など）と、説明（議題や詳細、目的など）があれば両方抽出してください。\n"
-                "15. 説明はタイトル以降の文や\"の件\"\"について\"などを優先して抽出してください。\n"
-                "16. **日時のみの入力の場合は必ずavailability_checkとして判定してください。予定の内容や目的が明確に示されていない場合は空き時間確認として扱ってください。**\n"
-                "\n"
-                "【出力例】\n"
-                "空き時間確認の場合:\n"
-                "{\n  \"task_type\": \"availability_check\",\n  \"dates\": [\n    {\n      \"date\": \"2025-07-08\",\n      \"time\": \"18:00\",\n      \"end_time\": \"23:59\"\n    }\n  ]\n}\n"
-                "\n"
-                "予定追加の場合:\n"
-                "{\n  \"task_type\": \"add_event\",\n  \"dates\": [\n    {\n      \"date\": \"2025-07-14\",\n      \"time\": \"20:00\",\n      \"end_time\": \"21:00\",\n      \"title\": \"田中さんMTG\",\n      \"description\": \"新作アプリの件\"\n    }\n  ]\n}\n"
-            )
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": text
-                    }
-                ],
-                temperature=0.1
-            )
-            result = response.choices[0].message.content
-            logger.info(f"[DEBUG] AI生レスポンス: {result}")
-            parsed = self._parse_ai_response(result)
-            
-            # AIの判定結果を強制的に修正
-            if parsed and isinstance(parsed, dict) and 'dates' in parsed:
-                # 日時のみの場合は強制的にavailability_checkに変更
-                has_title_or_description = False
-                for date_info in parsed.get('dates', []):
-                    if date_info.get('title') or date_info.get('description'):
-                        has_title_or_description = True
-                        break
-                
-                if not has_title_or_description:
-                    logger.info(f"[DEBUG] 日時のみのため、task_typeをavailability_checkに強制変更")
-                    parsed['task_type'] = 'availability_check'
-            
-            return self._supplement_times(parsed, text)
+        with span('openai', 'extract_dates_and_times', text_length=len(text)) as s:
+            try:
+                client = self.client.with_options(**self._request_options())
+                response = client.chat.completions.create(**self._dates_and_times_request(text))
+                return self._traced_result(s, response, text)
+            except DeadlineExceeded:
+                raise
+            except openai.APITimeoutError as e:
+                s.fail(e)
+                stage_timed_out('openai')
+                return {"error": DATES_EXTRACTION_ERROR}
+            except Exception as e:
+                s.fail(e)
+                return {"error": DATES_EXTRACTION_ERROR}
+
+    async def extract_dates_and_times_async(self, text):
+        """extract_dates_and_timesの非同期版（asgi.pyの処理経路で使う）"""
+        with span('openai', 'extract_dates_and_times', text_length=len(text)) as s:
+            try:
+                client = self.async_client.with_options(**self._request_options())
+                response = await client.chat.completions.create(**self._dates_and_times_request(text))
+                return self._traced_result(s, response, text)
+            except DeadlineExceeded:
+                raise
+            except openai.APITimeoutError as e:
+                s.fail(e)
+                stage_timed_out('openai')
+                return {"error": DATES_EXTRACTION_ERROR}
+            except Exception as e:
+                s.fail(e)
+                return {"error": DATES_EXTRACTION_ERROR}
+
+    def _traced_result(self, s, response, text):
+        """_dates_and_times_resultを実行し、トークン数と抽出した日時（枠）の数をスパンに記録する"""
+        if getattr(response, 'usage', None) is not None:
+            s.set('total_tokens', response.usage.total_tokens)
+        result = self._dates_and_times_result(response.choices[0].message.content, text)
+        s.set('frames', len(result.get('dates', [])) if isinstance(result, dict) else 0)
+        return result
+
+    def _request_options(self):
+        """OpenAI APIのタイムアウト（処理期限がある場合は残り時間まで。期限を超えないようリトライもしない）"""
+        options = {'timeout': stage_timeout('openai', Config.OPENAI_TIMEOUT_SECONDS)}
+        if current_deadline() is not None:
+            options['max_retries'] = 0
+        return options
+
+    def _dates_and_times_request(self, text):
+        """日時抽出・タスク判定のChat Completions APIリクエスト"""
+        now_jst = self._get_jst_now_str()
+        system_prompt = (
+            f"あなたは予定とタスクを管理するAIです。\n"
+            f"現在の日時（日本時間）は {now_jst} です。  \n"
+            "【最重要】ユーザーの入力が箇条書き・改行・スペース・句読点で区切られている場合も、全ての時間帯・枠を必ず個別に抽出してください。\n"
+            "この日時は、すべての自然言語の解釈において**常に絶対的な基準**としてください。  \n"
+            "会話の流れや前回の入力に引きずられることなく、**毎回この現在日時を最優先にしてください。**\n"
+            "\n"
+            "あなたは日時抽出とタスク管理の専門家です。ユーザーのテキストを分析して、以下のJSON形式で返してください。\n\n"
+            "分析ルール:\n"
+            "1. 複数の日時がある場合は全て抽出\n"
+            "2. 日本語の日付表現（今日、明日、来週、再来週、来月など）を具体的な日付に変換\n"
+            "3. 月が指定されていない場合（例：16日、17日）は今月として認識\n"
+            "4. 時間表現（午前9時、14時30分、9-10時、9時-10時、9:00-10:00など）を24時間形式に変換\n"
+            "5. **タスクの種類を判定（最重要）**:\n   - 日時のみ（タイトルや内容がない）場合は必ず「availability_check」（空き時間確認）\n   - 日時+タイトル/予定内容がある場合は「add_event」（予定追加）\n   - 例：「7/8 18時以降」→ availability_check（日時のみ）\n   - 例：「7/10 18:00〜20:00」→ availability_check（日時のみ）\n   - 例：「・7/10 9-10時\n・7/11 9-10時」→ availability_check（日時のみ複数）\n   - 例：「7/10 9-10時」→ availability_check（9:00〜10:00として抽出）\n   - 例：「7/10 9時-10時」→ availability_check（9:00〜10:00として抽出）\n   - 例：「7/10 9:00-10:00」→ availability_check（9:00〜10:00として抽出）\n   - 例：「7月18日 11:00-14:00,15:00-17:00」→ availability_check（日時のみ複数）\n   - 例：「7月20日 13:00-0:00」→ availability_check（日時のみ）\n   - 例：「明日の午前9時から会議を追加して」→ add_event（日時+予定内容）\n   - 例：「来週月曜日の14時から打ち合わせ」→ add_event（日時+予定内容）\n   - 例：「田中さんとMTG」→ add_event（予定内容あり）\n   - 例：「会議を追加」→ add_event（予定内容あり）\n"
+            "6. 自然言語の時間表現は必ず具体的な時刻範囲・日付範囲に変換してください。\n"
+            "   例：'18時以降'→'18:00〜23:59'、'終日'→'00:00〜23:59'、'今日'→'現在時刻〜23:59'、'今日から1週間'→'今日〜7日後の23:59'。\n"
+            "   例：'来週'→'来週の月曜日〜日曜日'、'再来週'→'再来週の月曜日〜日曜日'、'来月'→'来月の1日〜末日'。\n"
+            "   終了時間が指定されていない場合は1時間の予定として認識してください（例：'10時'→'10:00〜11:00'）。\n"
+            "7. 箇条書き（・や-）、改行、スペース、句読点で区切られている場合も、すべての日時・時間帯を抽出してください。\n"
+            "   例：'・7/10 9-10時\n・7/11 9-10時' → 2件の予定として抽出\n"
+            "   例：'7/11 15:00〜16:00 18:00〜19:00' → 2件の予定として抽出\n"
+            "   例：'7/12 終日' → 1件の終日予定として抽出\n"
+            "8. 同じ日付の終日予定は1件だけ抽出してください。\n"
+            "9. 予定タイトル（description）も必ず抽出してください。\n"
+            "10. \"終日\"や\"00:00〜23:59\"の終日枠は、ユーザーが明示的に\"終日\"と書いた場合のみ抽出してください。\n"
+            "11. 1つの日付に複数の時間帯（枠）が指定されている場合は、必ずその枠ごとに抽出してください。\n"
+            "12. 同じ日に部分枠（例: 15:00〜16:00, 18:00〜19:00）がある場合は、その日付の終日枠（00:00〜23:59）は抽出しないでください。\n"
+            "13. 複数の日時・時間帯が入力される場合、全ての時間帯をリストにし、それぞれに対して開始時刻・終了時刻をISO形式（例: 2025-07-11T15:00:00+09:00）で出力してください。\n"
+            "14. 予定タイトル（会議名や打合せ名など）と、説明（議題や詳細、目的など）があれば両方抽出してください。\n"
+            "15. 説明はタイトル以降の文や\"の件\"\"について\"などを優先して抽出してください。\n"
+            "16. **日時のみの入力の場合は必ずavailability_checkとして判定してください。予定の内容や目的が明確に示されていない場合は空き時間確認として扱ってください。**\n"
+            "\n"
+            "【出力例】\n"
+            "空き時間確認の場合:\n"
+            "{\n  \"task_type\": \"availability_check\",\n  \"dates\": [\n    {\n      \"date\": \"2025-07-08\",\n      \"time\": \"18:00\",\n      \"end_time\": \"23:59\"\n    }\n  ]\n}\n"
+            "\n"
+            "予定追加の場合:\n"
+            "{\n  \"task_type\": \"add_event\",\n  \"dates\": [\n    {\n      \"date\": \"2025-07-14\",\n      \"time\": \"20:00\",\n      \"end_time\": \"21:00\",\n      \"title\": \"田中さんMTG\",\n      \"description\": \"新作アプリの件\"\n    }\n  ]\n}\n"
+        )
+        return {
+            "model": "gpt-3.5-turbo",
+            "messages": [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": text
+                }
+            ],
+            "temperature": 0.1
+        }
+
+    def _dates_and_times_result(self, result, text):
+        """AIの応答から日時を取り出し、タスクの種類を補正します"""
+        logger.debug("AI生レスポンス: %s", result)
+        parsed = self._parse_ai_response(result)
+        
+        # AIの判定結果を強制的に修正
+        if parsed and isinstance(parsed, dict) and 'dates' in parsed:
+            # 日時のみの場合は強制的にavailability_checkに変更
+            has_title_or_description = False
+            for date_info in parsed.get('dates', []):
+                if date_info.get('title') or date_info.get('description'):
+                    has_title_or_description = True
+                    break
             
-        except Exception as e:
-            return {"error": "イベント情報を正しく認識できませんでした。\n\n・日時を打つと空き時間を返します\n・予定を打つとカレンダーに追加します\n\n例：\n『明日の午前9時から会議を追加して』\n『来週月曜日の14時から打ち合わせ』"}
+            if not has_title_or_description:
+                logger.debug("日時のみのため、task_typeをavailability_checkに強制変更")
+                parsed['task_type'] = 'availability_check'
+        
+        return self._supplement_times(parsed, text)
     
     def _parse_ai_response(self, response):
         """AIの応答をパースします"""
@@ -121,16 +191,16 @@ class AIService:
         jst = pytz.timezone('Asia/Tokyo')
         now = datetime.now(jst)
         logger = logging.getLogger("ai_service")
-        print(f"[DEBUG] _supplement_times開始: parsed={parsed}")
-        print(f"[DEBUG] 元テキスト: {original_text}")
+        logger.debug("_supplement_times開始: parsed=%s", parsed)
+        logger.debug("元テキスト: %s", original_text)
         if not parsed or 'dates' not in parsed:
-            print(f"[DEBUG] datesが存在しない: {parsed}")
+            logger.debug("datesが存在しない: %s", parsed)
             return parsed
         allday_dates = set()
         new_dates = []
         # 1. AI抽出を最優先。time, end_timeが空欄のものだけ補完
         for d in parsed['dates']:
-            print(f"[DEBUG] datesループ: {d}")
+            logger.debug("datesループ: %s", d)
             phrase = d.get('description', '') or original_text
             # time, end_timeが両方セットされていれば何もしない
             if d.get('time') and d.get('end_time'):
@@ -153,7 +223,7 @@ class AIService:
                 d['time'] = '00:00'
                 d['end_time'] = '23:59'
                 if d.get('date') in allday_dates:
-                    print(f"[DEBUG] 同じ日付の終日予定はスキップ: {d.get('date')}")
+                    logger.debug("同じ日付の終日予定はスキップ: %s", d.get('date'))
                     continue
                 allday_dates.add(d.get('date'))
             # 明日
@@ -180,7 +250,7 @@ class AIService:
                     time_obj = datetime.strptime(d.get('time'), "%H:%M")
                     end_time_obj = time_obj + timedelta(hours=1)
                     d['end_time'] = end_time_obj.strftime('%H:%M')
-                    print(f"[DEBUG] 今日の終了時間を1時間後に強制設定: {d.get('time')} -> {d['end_time']}")
+                    logger.debug("今日の終了時間を1時間後に強制設定: %s -> %s", d.get('time'), d['end_time'])
             # 本日
             if re.search(r'本日', phrase):
                 d['date'] = now.strftime('%Y-%m-%d')
@@ -190,7 +260,7 @@ class AIService:
                     hour = int(time_match.group(1))
                     d['time'] = f"{hour:02d}:00"
                     d['end_time'] = f"{hour+1:02d}:00"
-                    print(f"[DEBUG] 本日X時の処理: {hour}時 -> {hour+1}時")
+                    logger.debug("本日X時の処理: %s時 -> %s時", hour, hour+1)
                 elif not d.get('time'):
                     d['time'] = now.strftime('%H:%M')
                 # 本日の場合は終了時間を1時間後に強制設定（AIの設定を上書き）
@@ -199,7 +269,7 @@ class AIService:
                     time_obj = datetime.strptime(d.get('time'), "%H:%M")
                     end_time_obj = time_obj + timedelta(hours=1)
                     d['end_time'] = end_time_obj.strftime('%H:%M')
-                    print(f"[DEBUG] 本日の終了時間を1時間後に強制設定: {d.get('time')} -> {d['end_time']}")
+                    logger.debug("本日の終了時間を1時間後に強制設定: %s -> %s", d.get('time'), d['end_time'])
             # 今日から1週間
             if re.search(r'今日から1週間', phrase):
                 d['date'] = now.strftime('%Y-%m-%d')
@@ -220,7 +290,7 @@ class AIService:
                 d['end_date'] = next_sunday.strftime('%Y-%m-%d')
                 d['time'] = '00:00'
                 d['end_time'] = '23:59'
-                print(f"[DEBUG] 来週の処理: {d['date']} 〜 {d['end_date']}")
+                logger.debug("来週の処理: %s 〜 %s", d['date'], d['end_date'])
             
             # 再来週（再来週の月曜日〜日曜日）
             if re.search(r'再来週', phrase):
@@ -235,7 +305,7 @@ class AIService:
                 d['end_date'] = next_next_sunday.strftime('%Y-%m-%d')
                 d['time'] = '00:00'
                 d['end_time'] = '23:59'
-                print(f"[DEBUG] 再来週の処理: {d['date']} 〜 {d['end_date']}")
+                logger.debug("再来週の処理: %s 〜 %s", d['date'], d['end_date'])
             
             # 来月（来月の1日〜末日）
             if re.search(r'来月', phrase):
@@ -258,7 +328,7 @@ class AIService:
                 d['end_date'] = next_month_end.strftime('%Y-%m-%d')
                 d['time'] = '00:00'
                 d['end_time'] = '23:59'
-                print(f"[DEBUG] 来月の処理: {d['date']} 〜 {d['end_date']}")
+                logger.debug("来月の処理: %s 〜 %s", d['date'], d['end_date'])
             # end_timeが空
             if d.get('time') and not d.get('end_time'):
                 # 終了時間が設定されていない場合は1時間後に設定
@@ -275,11 +345,24 @@ class AIService:
                     e = d.get('end_time', '')
                     d['title'] = f"予定（{d.get('date', '')} {t}〜{e}）"
             new_dates.append(d)
-        print(f"[DEBUG] new_dates(AI+補完): {new_dates}")
-        # 2. 正規表現で漏れた枠を「追加」する（AI抽出に無い場合のみ）
+        logger.debug("new_dates(AI+補完): %s", new_dates)
+        # 2. 正規表現で漏れた枠を「追加」する（AI抽出に無い場合のみ。処理期限が近い場合は省略）
+        if allows_optional('regex_supplement'):
+            self._add_regex_matches(parsed, new_dates, original_text, now)
+        
+        logger.debug("new_dates(正規表現追加後): %s", new_dates)
+        
+        # 移動時間の自動追加処理
+        new_dates = self._add_travel_time(new_dates, original_text)
+        
+        parsed['dates'] = new_dates
+        return parsed
+    
+    def _add_regex_matches(self, parsed, new_dates, original_text, now):
+        """AI抽出で漏れた枠を正規表現で探し、new_datesに追加します"""
         pattern1 = r'(\d{1,2})/(\d{1,2})[\s　]*([0-9]{1,2}):?([0-9]{0,2})[\-〜~]([0-9]{1,2}):?([0-9]{0,2})'
         matches1 = re.findall(pattern1, original_text)
-        print(f"[DEBUG] pattern1マッチ: {matches1}")
+        logger.debug("pattern1マッチ: %s", matches1)
         for m in matches1:
             month, day, sh, sm, eh, em = m
             year = now.year
@@ -302,10 +385,10 @@ class AIService:
                 if parsed.get('task_type') == 'add_event':
                     new_date_entry['title'] = f"予定（{date_str} {start_time}〜{end_time}）"
                 new_dates.append(new_date_entry)
-                print(f"[DEBUG] pattern1で追加: {new_date_entry}")
+                logger.debug("pattern1で追加: %s", new_date_entry)
         pattern2 = r'[・\-]\s*(\d{1,2})/(\d{1,2})\s*([0-9]{1,2})-([0-9]{1,2})時'
         matches2 = re.findall(pattern2, original_text)
-        print(f"[DEBUG] pattern2マッチ: {matches2}")
+        logger.debug("pattern2マッチ: %s", matches2)
         for m in matches2:
             month, day, sh, eh = m
             year = now.year
@@ -328,10 +411,10 @@ class AIService:
                 if parsed.get('task_type') == 'add_event':
                     new_date_entry['title'] = f"予定（{date_str} {start_time}〜{end_time}）"
                 new_dates.append(new_date_entry)
-                print(f"[DEBUG] pattern2で追加: {new_date_entry}")
+                logger.debug("pattern2で追加: %s", new_date_entry)
         pattern3 = r'(\d{1,2})/(\d{1,2})\s*([0-9]{1,2})時?-([0-9]{1,2})時?'
         matches3 = re.findall(pattern3, original_text)
-        print(f"[DEBUG] pattern3マッチ: {matches3}")
+        logger.debug("pattern3マッチ: %s", matches3)
         for m in matches3:
             month, day, sh, eh = m
             year = now.year
@@ -354,12 +437,12 @@ class AIService:
                 if parsed.get('task_type') == 'add_event':
                     new_date_entry['title'] = f"予定（{date_str} {start_time}〜{end_time}）"
                 new_dates.append(new_date_entry)
-                print(f"[DEBUG] pattern3で追加: {new_date_entry}")
+                logger.debug("pattern3で追加: %s", new_date_entry)
         
         # 月が指定されていない場合（例：16日11:30-14:00）の処理
         pattern4 = r'(\d{1,2})日\s*([0-9]{1,2}):?([0-9]{0,2})[\-〜~]([0-9]{1,2}):?([0-9]{0,2})'
         matches4 = re.findall(pattern4, original_text)
-        print(f"[DEBUG] pattern4マッチ（日のみ）: {matches4}")
+        logger.debug("pattern4マッチ（日のみ）: %s", matches4)
         for m in matches4:
             day, sh, sm, eh, em = m
             year = now.year
@@ -387,12 +470,12 @@ class AIService:
                 if parsed.get('task_type') == 'add_event':
                     new_date_entry['title'] = f"予定（{date_str} {start_time}〜{end_time}）"
                 new_dates.append(new_date_entry)
-                print(f"[DEBUG] pattern4で追加（日のみ）: {new_date_entry}")
+                logger.debug("pattern4で追加（日のみ）: %s", new_date_entry)
         
         # 複数の時間帯が同じ日に指定されている場合（例：16日11:30-14:00/15:00-17:00）
         pattern5 = r'(\d{1,2})日\s*([0-9]{1,2}):?([0-9]{0,2})[\-〜~]([0-9]{1,2}):?([0-9]{0,2})/([0-9]{1,2}):?([0-9]{0,2})[\-〜~]([0-9]{1,2}):?([0-9]{0,2})'
         matches5 = re.findall(pattern5, original_text)
-        print(f"[DEBUG] pattern5マッチ（日のみ複数時間帯）: {matches5}")
+        logger.debug("pattern5マッチ（日のみ複数時間帯）: %s", matches5)
         for m in matches5:
             day, sh1, sm1, eh1, em1, sh2, sm2, eh2, em2 = m
             year = now.year
@@ -422,7 +505,7 @@ class AIService:
                 if parsed.get('task_type') == 'add_event':
                     new_date_entry1['title'] = f"予定（{date_str} {start_time1}〜{end_time1}）"
                 new_dates.append(new_date_entry1)
-                print(f"[DEBUG] pattern5で追加（1つ目）: {new_date_entry1}")
+                logger.debug("pattern5で追加（1つ目）: %s", new_date_entry1)
             
             # 2つ目の時間帯
             start_time2 = f"{int(sh2):02d}:{sm2 if sm2 else '00'}"
@@ -437,7 +520,7 @@ class AIService:
                 if parsed.get('task_type') == 'add_event':
                     new_date_entry2['title'] = f"予定（{date_str} {start_time2}〜{end_time2}）"
                 new_dates.append(new_date_entry2)
-                print(f"[DEBUG] pattern5で追加（2つ目）: {new_date_entry2}")
+                logger.debug("pattern5で追加（2つ目）: %s", new_date_entry2)
         
         # より柔軟な日付解析：改行やスペースで区切られた複数の日付に対応
         # 例：「16日11:30-14:00/15:00-17:00\n17日18:00-19:00\n18日9:00-10:00/16:00-16:30/17:30-18:00」
@@ -488,7 +571,7 @@ class AIService:
                     if parsed.get('task_type') == 'add_event':
                         new_date_entry['title'] = f"予定（{date_str} {start_time}〜{end_time}）"
                     new_dates.append(new_date_entry)
-                    print(f"[DEBUG] 柔軟な日付解析で追加: {new_date_entry}")
+                    logger.debug("柔軟な日付解析で追加: %s", new_date_entry)
         
         # 本日/今日の処理を追加（AIが既に予定を作成していない場合のみ）
         if ('本日' in original_text or '今日' in original_text) and not new_dates:
@@ -517,7 +600,7 @@ class AIService:
                 if not title:
                     title = "予定"
                 
-                print(f"[DEBUG] 抽出されたタイトル: '{title}'")
+                logger.debug("抽出されたタイトル: '%s'", title)
                 
                 # メイン予定を作成
                 main_event = {
@@ -529,15 +612,7 @@ class AIService:
                 }
                 
                 new_dates.append(main_event)
-                print(f"[DEBUG] 本日/今日の予定を追加: {main_event}")
-        
-        print(f"[DEBUG] new_dates(正規表現追加後): {new_dates}")
-        
-        # 移動時間の自動追加処理
-        new_dates = self._add_travel_time(new_dates, original_text)
-        
-        parsed['dates'] = new_dates
-        return parsed
+                logger.debug("本日/今日の予定を追加: %s", main_event)
     
     def _add_travel_time(self, dates, original_text):
         """移動時間を自動追加する処理"""
@@ -551,7 +626,7 @@ class AIService:
         if not has_travel:
             return dates
         
-        print(f"[DEBUG] 移動時間の自動追加を開始")
+        logger.debug("移動時間の自動追加を開始")
         
         jst = pytz.timezone('Asia/Tokyo')
         new_dates = []
@@ -572,12 +647,12 @@ class AIService:
                             existing_date.get('time') == travel_event.get('time') and 
                             existing_date.get('end_time') == travel_event.get('end_time')):
                             is_duplicate = True
-                            print(f"[DEBUG] 重複する移動時間をスキップ: {travel_event}")
+                            logger.debug("重複する移動時間をスキップ: %s", travel_event)
                             break
                     
                     if not is_duplicate:
                         new_dates.append(travel_event)
-                        print(f"[DEBUG] 移動時間を追加: {travel_event}")
+                        logger.debug("移動時間を追加: %s", travel_event)
         
         return new_dates
     
@@ -819,29 +894,29 @@ class AIService:
         ]
         日付ごとに空き時間をまとめて返す（重複枠・重複時間帯は除外）
         """
-        print(f"[DEBUG] format_free_slots_response_by_frame開始")
-        print(f"[DEBUG] 入力データ: {free_slots_by_frame}")
+        logger.debug("format_free_slots_response_by_frame開始")
+        logger.debug("入力データ: %s", free_slots_by_frame)
         
         jst = pytz.timezone('Asia/Tokyo')
         if not free_slots_by_frame:
-            print(f"[DEBUG] free_slots_by_frameが空")
+            logger.debug("free_slots_by_frameが空")
             return "✅空き時間はありませんでした。"
             
         # 日付ごとに空き時間をまとめる
         date_slots = {}
         for i, frame in enumerate(free_slots_by_frame):
-            print(f"[DEBUG] フレーム{i+1}処理: {frame}")
+            logger.debug("フレーム%s処理: %s", i+1, frame)
             date = frame['date']
             slots = frame['free_slots']
-            print(f"[DEBUG] フレーム{i+1}の空き時間: {slots}")
+            logger.debug("フレーム%sの空き時間: %s", i+1, slots)
             
             if date not in date_slots:
                 date_slots[date] = set()
             for slot in slots:
                 date_slots[date].add((slot['start'], slot['end']))
-                print(f"[DEBUG] 日付{date}に空き時間追加: {slot['start']}〜{slot['end']}")
+                logger.debug("日付%sに空き時間追加: %s〜%s", date, slot['start'], slot['end'])
                 
-        print(f"[DEBUG] 日付ごとの空き時間: {date_slots}")
+        logger.debug("日付ごとの空き時間: %s", date_slots)
         
         response = "✅以下が空き時間です！\n\n"
         for date in sorted(date_slots.keys()):
@@ -850,7 +925,7 @@ class AIService:
             response += f"{dt.month}/{dt.day}（{weekday}）\n"
             
             slots = sorted(list(date_slots[date]))
-            print(f"[DEBUG] 日付{date}の最終空き時間: {slots}")
+            logger.debug("日付%sの最終空き時間: %s", date, slots)
             
             if not slots:
                 response += "・空き時間なし\n"
@@ -858,5 +933,5 @@ class AIService:
                 for start, end in slots:
                     response += f"・{start}〜{end}\n"
                     
-        print(f"[DEBUG] 最終レスポンス: {response}")
+        logger.debug("最終レスポンス: %s", response)
         return response 
\ No newline at end of file
@@ -1,51 +1,70 @@
 import os
+import contextvars
+import functools
 import logging
 import json
+import threading
+import time
 import urllib3
-logging.basicConfig(level=logging.INFO)
 
-# GOOGLE_CREDENTIALS_FILEの自動判定（JSON or パス）
-GOOGLE_CREDENTIALS_FILE_ENV = os.environ.get("GOOGLE_CREDENTIALS_FILE")
-if GOOGLE_CREDENTIALS_FILE_ENV:
-    try:
-        # まずJSONとして読めるか？
-        parsed = json.loads(GOOGLE_CREDENTIALS_FILE_ENV)
-        with open("credentials.json", "w") as f:
-            json.dump(parsed, f)
-        os.environ["GOOGLE_CREDENTIALS_PATH"] = "credentials.json"
-        print("Google認証ファイルをJSON形式からcredentials.jsonに変換しました")
-    except json.JSONDecodeError:
-        # JSONでなければパスとみなす
-        if os.path.exists(GOOGLE_CREDENTIALS_FILE_ENV):
-            os.environ["GOOGLE_CREDENTIALS_PATH"] = GOOGLE_CREDENTIALS_FILE_ENV
-            print(f"Google認証ファイルパスを使用: {GOOGLE_CREDENTIALS_FILE_ENV}")
-        else:
-            raise RuntimeError("GOOGLE_CREDENTIALS_FILE がJSONでも有効なパスでもありません")
-else:
-    # 既存運用（Config.GOOGLE_CREDENTIALS_FILE を使うなど）
-    os.environ["GOOGLE_CREDENTIALS_PATH"] = getattr(Config, "GOOGLE_CREDENTIALS_FILE", "credentials.json")
-    print(f"デフォルトのGoogle認証ファイルパスを使用: {os.environ['GOOGLE_CREDENTIALS_PATH']}")
-
-from flask import Flask, request, abort, render_template_string, redirect, url_for, session, Response, make_response
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
-from line_bot_handler import LineBotHandler
 from config import Config
-import json
+from logging_config import configure_logging, start_log_sampling
+
+configure_logging()
+from startup import boot_phase, record_phase, update_memory_gauge
+
+# 起動処理の計測（gunicornの--preloadではマスターで1回だけ実行され、ワーカーはfork後に共有する）
+_imports_started = time.perf_counter()
+
+from flask import Flask, request, abort, render_template_string, redirect, url_for, session, Response, make_response, g
+from linebot import WebhookHandler
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, PostbackEvent, TextSendMessage
+from line_bot_handler import ERROR_REPLY_TEXT, LineBotHandler
 from datetime import datetime
-import pickle
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-# from googleapiclient.discovery import build  # 使ってなければ削除
-from db import DBHelper
+from db import get_db, start_request_stats
+from deadline import start_deadline, observe_remaining_at_reply
+from tracing import span, start_trace, user_hash
 from werkzeug.middleware.proxy_fix import ProxyFix
 from ai_service import AIService
-from send_daily_agenda import send_daily_agenda
+from agenda_jobs import AgendaJobRunner
+from coalesce import MessageCoalescer
+from metrics import registry as metrics_registry
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+record_phase('imports', _imports_started)
 
 # ログ設定
 logger = logging.getLogger(__name__)
 
+
+def _prepare_google_credentials():
+    """GOOGLE_CREDENTIALS_FILEの自動判定（JSON or パス）"""
+    credentials_env = os.environ.get("GOOGLE_CREDENTIALS_FILE")
+    if credentials_env:
+        try:
+            # まずJSONとして読めるか？
+            parsed = json.loads(credentials_env)
+            with open("credentials.json", "w") as f:
+                json.dump(parsed, f)
+            os.environ["GOOGLE_CREDENTIALS_PATH"] = "credentials.json"
+            print("Google認証ファイルをJSON形式からcredentials.jsonに変換しました")
+        except json.JSONDecodeError:
+            # JSONでなければパスとみなす
+            if os.path.exists(credentials_env):
+                os.environ["GOOGLE_CREDENTIALS_PATH"] = credentials_env
+                print(f"Google認証ファイルパスを使用: {credentials_env}")
+            else:
+                raise RuntimeError("GOOGLE_CREDENTIALS_FILE がJSONでも有効なパスでもありません")
+    else:
+        # 既存運用（Config.GOOGLE_CREDENTIALS_FILE を使うなど）
+        os.environ["GOOGLE_CREDENTIALS_PATH"] = getattr(Config, "GOOGLE_CREDENTIALS_FILE", "credentials.json")
+        print(f"デフォルトのGoogle認証ファイルパスを使用: {os.environ['GOOGLE_CREDENTIALS_PATH']}")
+
+
+with boot_phase('credentials'):
+    _prepare_google_credentials()
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
 
@@ -54,16 +73,18 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
 # 設定の検証
 try:
-    Config.validate_config()
+    with boot_phase('config'):
+        Config.validate_config()
     logger.info("設定の検証が完了しました")
 except ValueError as e:
     logger.error(f"設定エラー: {e}")
     raise
 
-# LINEボットハンドラーを初期化
+# LINEボットハンドラーを初期化（接続を持つクライアント・DB接続プールはfork後に最初に使われたときに作成される）
 try:
-    line_bot_handler = LineBotHandler()
-    handler = line_bot_handler.get_handler()
+    with boot_phase('handler'):
+        line_bot_handler = LineBotHandler()
+        handler = line_bot_handler.get_handler()
     logger.info("LINEボットハンドラーの初期化が完了しました")
 except Exception as e:
     logger.error(f"LINEボットハンドラーの初期化に失敗しました: {e}")
@@ -71,8 +92,41 @@ except Exception as e:
 
 # セキュリティのためAPIキーなどの機密情報はログに出力しない
 
-# DBヘルパーの初期化
-db_helper = DBHelper()
+# 日次予定送信ジョブ（バックグラウンドで実行）
+agenda_job_runner = AgendaJobRunner()
+
+# 時間がかかるメッセージの処理（REPLY_DEADLINE_SECONDSを過ぎたらWebhookには先に応答する）
+message_executor = ThreadPoolExecutor(max_workers=Config.MESSAGE_WORKERS, thread_name_prefix='message')
+
+# 続けて届いたメッセージのまとめ処理（MESSAGE_COALESCE_MSが0なら無効）
+message_coalescer = MessageCoalescer(Config.MESSAGE_COALESCE_MS) if Config.MESSAGE_COALESCE_MS > 0 else None
+
+# リクエストごとの処理時間とDB操作の内訳
+REQUEST_DURATION_MS = metrics_registry.histogram('http_request_duration_ms', 'エンドポイントごとのリクエスト処理時間（ミリ秒）')
+REQUEST_DB_MS = metrics_registry.histogram('http_request_db_ms', 'リクエストごとのDB操作の合計時間（ミリ秒）')
+REQUEST_DB_QUERIES = metrics_registry.histogram('http_request_db_queries', 'リクエストごとのSQL文の実行数',
+                                                buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.db_stats = start_request_stats()
+
+@app.after_request
+def record_request_timing(response):
+    if not hasattr(g, 'request_started'):
+        return response
+    endpoint = request.endpoint or 'unknown'
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    REQUEST_DURATION_MS.observe(total_ms, endpoint=endpoint)
+    REQUEST_DB_MS.observe(g.db_stats['db_ms'], endpoint=endpoint)
+    REQUEST_DB_QUERIES.observe(g.db_stats['queries'], endpoint=endpoint)
+    if endpoint == 'callback':
+        logger.info(
+            f"Webhook処理時間: total={total_ms:.1f}ms, db={g.db_stats['db_ms']:.1f}ms, "
+            f"operations={g.db_stats['operations']}, queries={g.db_stats['queries']}"
+        )
+    return response
 
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -85,11 +139,17 @@ def callback():
 
     # リクエストボディを取得
     body = request.get_data(as_text=True)
-    logger.info("Request body: " + body)
+    # 本文にはユーザーのメッセージが含まれるため、長さだけを記録する
+    logger.debug("Webhookを受信: %d bytes", len(body))
+
+    # 処理期限を開始する（各処理段階のタイムアウトは残り時間までに抑える）
+    start_deadline()
+    start_log_sampling()
 
     try:
         # 署名を検証し、問題なければhandleに定義されている関数を呼び出す
-        handler.handle(body, signature)
+        with start_trace('webhook', server='flask'):
+            handler.handle(body, signature)
     except InvalidSignatureError:
         # 署名検証で失敗したときは例外をあげる
         logger.error("署名検証に失敗しました")
@@ -100,75 +160,88 @@ def callback():
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
-    """テキストメッセージを処理"""
+    """テキストメッセージを処理
+
+    OpenAI・Calendar APIを呼ぶメッセージは読み込み中アニメーションを表示してから処理し、
+    REPLY_DEADLINE_SECONDS内に終われば返信、終わらなければWebhookに先に応答して処理後にpushで送る。
+    MESSAGE_COALESCE_MS内に続けて届いたメッセージは1つにまとめて処理し、1回だけ返信する。
+    """
+    logger.debug("メッセージを受信: %s", event.message.text)
+    gateway = line_bot_handler.gateway
+    user_id = event.source.user_id
+    reply_token = event.reply_token
+
+    if not line_bot_handler.expects_slow_response(event):
+        response = line_bot_handler.build_response(event)
+    else:
+        batch = None
+        if message_coalescer and line_bot_handler.coalescable(event):
+            batch = message_coalescer.join(user_id, event.message.text, reply_token)
+            if batch is None:
+                logger.info(f"ユーザー {user_id} のメッセージを直前のメッセージとまとめて処理します")
+                return
+        gateway.start_loading(user_id, Config.LOADING_ANIMATION_SECONDS)
+        if batch:
+            # 受付期間の終わりに処理用のスレッドでまとめて処理する（Webhookのリクエストのスレッドは待たせない。
+            # gunicornのsyncワーカーではリクエストのスレッドが1つのため、ここで待つと後続のメッセージを受け取れない）
+            _schedule_batch(event, batch)
+            return
+        # リクエストごとのDB集計を引き継いで処理用のスレッドで実行する
+        future = message_executor.submit(contextvars.copy_context().run, line_bot_handler.build_response, event)
+        try:
+            response = future.result(timeout=Config.REPLY_DEADLINE_SECONDS)
+        except FuturesTimeoutError:
+            logger.info(f"ユーザー {user_id} への応答は{Config.REPLY_DEADLINE_SECONDS}秒以内に終わらなかったため、処理後にpushで送信します")
+            future.add_done_callback(functools.partial(_push_when_done, user_id, reply_token))
+            return
+
+    # LINEにメッセージを送信（一時的なエラーのリトライ、reply token失効時のpushはゲートウェイが行う）
+    observe_remaining_at_reply()
+    if gateway.reply(reply_token, user_id, response):
+        logger.info("メッセージの処理が完了しました")
+
+def _push_when_done(user_id, reply_token, future):
+    """期限内に返信できなかった応答を処理の終了後にpushで送る（処理が失敗した場合はエラーメッセージを送る）"""
     try:
-        logger.info(f"メッセージを受信: {event.message.text}")
-        
-        # メッセージを処理してレスポンスを取得
-        response = line_bot_handler.handle_message(event)
-        
-        # LINEにメッセージを送信（SSLエラー対応のリトライ機能付き）
-        max_retries = 5
-        retry_delay = 2  # 秒
-        
-        for attempt in range(max_retries):
-            try:
-                line_bot_handler.line_bot_api.reply_message(
-                    event.reply_token,
-                    response
-                )
-                logger.info("メッセージの処理が完了しました")
-                break
-            except Exception as send_error:
-                error_msg = str(send_error)
-                logger.warning(f"メッセージ送信試行 {attempt + 1}/{max_retries} でエラー: {error_msg}")
-                
-                # SSLエラーの場合は特別な処理
-                if "SSL SYSCALL error" in error_msg or "EOF detected" in error_msg:
-                    logger.info(f"SSLエラーを検出、{retry_delay}秒後にリトライします")
-                    logger.info(f"SSLエラー詳細: {type(send_error).__name__}: {error_msg}")
-                    import time
-                    time.sleep(retry_delay)
-                    
-                    if attempt < max_retries - 1:
-                        retry_delay *= 2  # 指数バックオフ（次の試行用）
-                        logger.info(f"次のリトライまでの待機時間: {retry_delay}秒")
-                        continue
-                    else:
-                        logger.error("SSLエラーが継続し、最大リトライ回数に達しました")
-                        raise send_error
-                
-                # その他のエラーの場合
-                if attempt == max_retries - 1:
-                    logger.error(f"最大リトライ回数に達しました: {send_error}")
-                    raise send_error
-                
-                import time
-                time.sleep(1)  # 1秒待機してからリトライ
-        
+        response = future.result()
     except Exception as e:
-        logger.error(f"メッセージ処理でエラーが発生しました: {e}")
-        # エラーが発生した場合はエラーメッセージを送信
-        try:
-            # エラーメッセージ送信時もリトライ機能を適用
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    line_bot_handler.line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text="申し訳ございません。エラーが発生しました。しばらく時間をおいて再度お試しください。")
-                    )
-                    logger.info("エラーメッセージの送信が完了しました")
-                    break
-                except Exception as reply_error:
-                    logger.warning(f"エラーメッセージ送信試行 {attempt + 1}/{max_retries} でエラー: {reply_error}")
-                    if attempt == max_retries - 1:
-                        logger.error(f"エラーメッセージの送信に失敗しました: {reply_error}")
-                    else:
-                        import time
-                        time.sleep(1)
-        except Exception as reply_error:
-            logger.error(f"エラーメッセージの送信に失敗しました: {reply_error}")
+        logger.exception(f"ユーザー {user_id} への応答の作成に失敗しました: {e}")
+        response = TextSendMessage(text=ERROR_REPLY_TEXT)
+    line_bot_handler.gateway.push_deferred(user_id, reply_token, response)
+
+
+def _schedule_batch(event, batch):
+    """まとめ処理の受付期間が終わったら、処理用のスレッドでまとめたメッセージを処理して返信する"""
+    # トレースはこのスパンが終わるまで続ける（受付期間の待ちと処理後の返信もトレースに含める）
+    batch_span = span('coalesce', 'batch', user=user_hash(batch.user_id))
+    context = contextvars.copy_context()
+    timer = threading.Timer(
+        max(0.0, batch.closes_at - time.monotonic()),
+        message_executor.submit, args=(context.run, _respond_to_batch, event, batch, batch_span)
+    )
+    timer.daemon = True
+    timer.start()
+
+
+def _respond_to_batch(event, batch, batch_span):
+    """受付期間内に届いたメッセージをまとめて処理し、最後のメッセージのreply tokenで返信する"""
+    with batch_span:
+        text, reply_token = batch.wait()
+        batch_span.set('messages', len(batch.texts))
+        # 処理期限は受付期間が終わった時点から数える
+        start_deadline()
+        response = line_bot_handler.build_response(event, text)
+        observe_remaining_at_reply()
+        if line_bot_handler.gateway.reply(reply_token, batch.user_id, response):
+            logger.info("メッセージの処理が完了しました")
+
+@handler.add(PostbackEvent)
+def handle_postback(event):
+    """重複確認のボタン（ポストバック）を処理（OpenAIの呼び出しとpending_eventsの読み込みは行わない）"""
+    logger.debug("ポストバックを受信: %s", event.postback.data)
+    response = line_bot_handler.build_response(event)
+    observe_remaining_at_reply()
+    line_bot_handler.gateway.reply(event.reply_token, event.source.user_id, response)
 
 @app.route("/", methods=['GET'])
 def index():
@@ -241,7 +314,7 @@ def onetime_login():
         code = request.form.get('code', '').strip().upper()
         
         # ワンタイムコードを検証
-        line_user_id = db_helper.verify_onetime_code(code)
+        line_user_id = get_db().verify_onetime_code(code)
         if not line_user_id:
             html = '''
             <!DOCTYPE html>
@@ -270,10 +343,11 @@ def onetime_login():
             return render_template_string(html)
         
         # ワンタイムコードを使用済みにマーク
-        db_helper.mark_onetime_used(code)
+        get_db().mark_onetime_used(code)
         
         try:
-            # Google OAuth認証フローを開始（Flow使用）
+            # Google OAuth認証フローを開始（Flow使用、OAuthのときだけ読み込む）
+            from google_auth_oauthlib.flow import Flow
             SCOPES = ['https://www.googleapis.com/auth/calendar']
             path = os.environ.get('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
             base_url = os.getenv('BASE_URL')
@@ -296,7 +370,7 @@ def onetime_login():
                 prompt='consent'
             )
             # stateとline_user_idをDBに保存
-            db_helper.save_oauth_state(state, line_user_id)
+            get_db().save_oauth_state(state, line_user_id)
             return redirect(auth_url)
         except Exception as e:
             logging.error(f"Google OAuth認証エラー: {e}")
@@ -329,10 +403,11 @@ def oauth2callback():
     try:
         # stateからline_user_idを取得
         state = request.args.get('state')
-        line_user_id = db_helper.get_line_user_id_by_state(state)
+        line_user_id = get_db().get_line_user_id_by_state(state)
         if not line_user_id:
             return make_response("認証セッションが無効です", 400)
         # 新たにflowを生成（Flow使用、monkey patch撤去）
+        from google_auth_oauthlib.flow import Flow
         SCOPES = ['https://www.googleapis.com/auth/calendar']
         path = os.environ.get('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
         base_url = os.getenv('BASE_URL')
@@ -369,10 +444,10 @@ def oauth2callback():
         
         creds = flow.credentials
         # JSON 形式で保存（推奨）
-        db_helper.save_google_token_json(line_user_id, creds.to_json())
+        get_db().save_google_token_json(line_user_id, creds.to_json())
         
         # ワンタイムコードは state 起点で使用済みにするなど、一貫したAPIに統一
-        db_helper.mark_onetime_used_by_state(state)
+        get_db().mark_onetime_used_by_state(state)
         # 認証完了画面
         html = "<h2>Google認証が完了しました。LINEに戻って操作を続けてください。</h2>"
         return make_response(html, 200)
@@ -470,34 +545,76 @@ def debug_ai_test():
     """
     return render_template_string(test_form)
 
-@app.route('/api/send_daily_agenda', methods=['POST'])
-def api_send_daily_agenda():
-    import os
-    from flask import request, jsonify
+def _check_api_token():
+    """管理用APIのトークンを検証（不正な場合は403レスポンスを返す）"""
+    from flask import jsonify
     secret_token = os.environ.get('DAILY_AGENDA_SECRET_TOKEN')
     req_token = request.args.get('token')
     if not secret_token or req_token != secret_token:
         return jsonify({'status': 'error', 'message': 'Invalid or missing token'}), 403
+    return None
+
+@app.route('/api/send_daily_agenda', methods=['POST'])
+def api_send_daily_agenda():
+    """日次予定送信ジョブを登録し、ジョブIDを即座に返す"""
+    from flask import jsonify
+    error_response = _check_api_token()
+    if error_response:
+        return error_response
     try:
-        send_daily_agenda()
-        return jsonify({'status': 'ok'})
+        job_id = agenda_job_runner.enqueue()
+        return jsonify({
+            'status': 'accepted',
+            'job_id': job_id,
+            'status_url': url_for('api_job_status', job_id=job_id)
+        }), 202
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    """日次予定送信ジョブの進捗を返す"""
+    from flask import jsonify
+    error_response = _check_api_token()
+    if error_response:
+        return error_response
+    job = agenda_job_runner.get_status(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """プロセス内メトリクスをPrometheusテキスト形式で返す"""
+    error_response = _check_api_token()
+    if error_response:
+        return error_response
+    update_memory_gauge()
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/debug_users', methods=['GET'])
 def api_debug_users():
-    import os
-    from flask import request, jsonify
-    secret_token = os.environ.get('DAILY_AGENDA_SECRET_TOKEN')
-    req_token = request.args.get('token')
-    if not secret_token or req_token != secret_token:
-        return jsonify({'status': 'error', 'message': 'Invalid or missing token'}), 403
-    from db import DBHelper
-    db = DBHelper()
-    c = db.conn.cursor()
-    c.execute('SELECT line_user_id, LENGTH(google_token), created_at, updated_at FROM users')
-    rows = c.fetchall()
-    return jsonify({'users': rows})
+    """usersテーブルの概要をバッチ単位でストリーミング返却"""
+    error_response = _check_api_token()
+    if error_response:
+        return error_response
+
+    def generate():
+        yield '{"users": ['
+        first = True
+        for batch in get_db().iter_user_batches(authenticated_only=False):
+            for user in batch:
+                row = [
+                    user['line_user_id'],
+                    user['token_length'],
+                    user['created_at'].isoformat() if user['created_at'] else None,
+                    user['updated_at'].isoformat() if user['updated_at'] else None,
+                ]
+                yield ('' if first else ',') + json.dumps(row, ensure_ascii=False)
+                first = False
+        yield ']}'
+
+    return Response(generate(), mimetype='application/json')
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
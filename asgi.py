@@ -0,0 +1,189 @@
+"""
+ASGIのエントリーポイント（1プロセスで多数の会話を同時に処理する）
+- /callback（LINE Webhook）は1つのイベントループ上で処理する。OpenAI（AsyncOpenAI）・Calendar API（aiohttp）・
+  LINEへの送信（linebot.v3のAsyncMessagingApi）はそれぞれ接続プールを共有する非同期クライアントで待ち、
+  DBの読み書きだけを別スレッドで行う
+- それ以外のパス（OAuth・管理API・/metricsなど）は既存のFlaskアプリ（app:app）に渡す
+
+起動: uvicorn asgi:app --host 0.0.0.0 --port $PORT
+（gunicornを使う場合: gunicorn -k uvicorn.workers.UvicornWorker asgi:app）
+"""
+import asyncio
+import logging
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhook import WebhookParser
+from linebot.models import TextSendMessage
+from linebot.v3.webhooks import MessageEvent, PostbackEvent, TextMessageContent
+
+from app import app as flask_app, line_bot_handler, message_coalescer, REQUEST_DURATION_MS, REQUEST_DB_MS, REQUEST_DB_QUERIES
+from config import Config
+from db import start_request_stats
+from deadline import start_deadline, observe_remaining_at_reply
+from http_clients import start_keepalive
+from logging_config import start_log_sampling
+from tracing import start_trace
+from line_bot_handler import ERROR_REPLY_TEXT
+from line_gateway import AsyncLineGateway
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+EVENTS_IN_FLIGHT = registry.gauge('asgi_webhook_events_in_flight', 'イベントループ上で処理中のWebhookイベント数')
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _respond(send, status, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class LineWebhookApp:
+    """/callbackを非同期で処理し、それ以外をFlaskアプリに渡すASGIアプリ"""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.parser = WebhookParser(Config.LINE_CHANNEL_SECRET)
+        self.gateway = None
+        self._deferred = set()  # 期限を過ぎてpushで送る応答のタスク
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == '/callback' and scope['method'] == 'POST':
+            await self._callback(scope, receive, send)
+        else:
+            await self.fallback(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # 非同期クライアントはイベントループ内で作成する
+                self.gateway = AsyncLineGateway()
+                start_keepalive()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self._close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _close(self):
+        """非同期クライアントの接続を閉じる"""
+        if self.gateway:
+            await self.gateway.aclose()
+        if line_bot_handler.ai_service:
+            await line_bot_handler.ai_service.aclose()
+        if line_bot_handler.calendar_service:
+            await line_bot_handler.calendar_service.aclose()
+
+    async def _callback(self, scope, receive, send):
+        """LINE Webhookのコールバック（署名を検証し、イベントを並行して処理してから200を返す）"""
+        started = time.perf_counter()
+        db_stats = start_request_stats()
+        start_deadline()
+        start_log_sampling()
+        signature = dict(scope['headers']).get(b'x-line-signature', b'').decode('latin-1')
+        if not signature:
+            logger.error('X-Line-Signature ヘッダがありません')
+            await _respond(send, 400, b'Bad Request')
+            return
+
+        body = (await _read_body(receive)).decode('utf-8')
+        try:
+            events = self.parser.parse(body, signature)
+        except InvalidSignatureError:
+            logger.error("署名検証に失敗しました")
+            await _respond(send, 400, b'Bad Request')
+            return
+
+        with start_trace('webhook', server='asgi', events=len(events)):
+            await asyncio.gather(*(self._handle_event(event) for event in events))
+        await _respond(send, 200, b'OK')
+
+        total_ms = (time.perf_counter() - started) * 1000
+        REQUEST_DURATION_MS.observe(total_ms, endpoint='callback')
+        REQUEST_DB_MS.observe(db_stats['db_ms'], endpoint='callback')
+        REQUEST_DB_QUERIES.observe(db_stats['queries'], endpoint='callback')
+        logger.info(
+            f"Webhook処理時間: total={total_ms:.1f}ms, db={db_stats['db_ms']:.1f}ms, "
+            f"operations={db_stats['operations']}, queries={db_stats['queries']}"
+        )
+
+    async def _handle_event(self, event):
+        """テキストメッセージと重複確認のボタン（ポストバック）を処理して返信する
+
+        OpenAI・Calendar APIを呼ぶメッセージは読み込み中アニメーションを表示してから処理し、
+        REPLY_DEADLINE_SECONDS内に終われば返信、終わらなければWebhookに先に応答して処理後にpushで送る。
+        MESSAGE_COALESCE_MS内に続けて届いたメッセージは1つにまとめて処理し、1回だけ返信する。
+        """
+        if isinstance(event, PostbackEvent):
+            logger.debug("ポストバックを受信: %s", event.postback.data)
+        elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            logger.debug("メッセージを受信: %s", event.message.text)
+        else:
+            return
+        user_id = event.source.user_id
+        reply_token = event.reply_token
+        text = None
+        slow = await asyncio.to_thread(line_bot_handler.expects_slow_response, event)
+        if slow:
+            batch = None
+            if message_coalescer and line_bot_handler.coalescable(event):
+                batch = message_coalescer.join(user_id, event.message.text, reply_token)
+                if batch is None:
+                    logger.info(f"ユーザー {user_id} のメッセージを直前のメッセージとまとめて処理します")
+                    return
+            self.gateway.start_loading(user_id, Config.LOADING_ANIMATION_SECONDS)
+            if batch:
+                # 受付期間内に届いたメッセージをまとめ、最後のメッセージのreply tokenで返信する
+                text, reply_token = await batch.wait_async()
+        task = asyncio.get_running_loop().create_task(self._build_response(event, text))
+        try:
+            if slow:
+                response = await asyncio.wait_for(asyncio.shield(task), Config.REPLY_DEADLINE_SECONDS)
+            else:
+                response = await task
+        except asyncio.TimeoutError:
+            logger.info(f"ユーザー {user_id} への応答は{Config.REPLY_DEADLINE_SECONDS}秒以内に終わらなかったため、処理後にpushで送信します")
+            self._push_when_done(task, user_id, reply_token)
+            return
+        observe_remaining_at_reply()
+        if await self.gateway.reply(reply_token, user_id, response):
+            logger.info("メッセージの処理が完了しました")
+
+    async def _build_response(self, event, text=None):
+        EVENTS_IN_FLIGHT.inc()
+        try:
+            return await line_bot_handler.build_response_async(event, text)
+        finally:
+            EVENTS_IN_FLIGHT.dec()
+
+    def _push_when_done(self, task, user_id, reply_token):
+        async def push():
+            try:
+                response = await task
+            except Exception as e:
+                logger.exception(f"ユーザー {user_id} への応答の作成に失敗しました: {e}")
+                response = TextSendMessage(text=ERROR_REPLY_TEXT)
+            await self.gateway.push_deferred(user_id, reply_token, response)
+        deferred = asyncio.get_running_loop().create_task(push())
+        self._deferred.add(deferred)
+        deferred.add_done_callback(self._deferred.discard)
+
+
+app = LineWebhookApp(WsgiToAsgi(flask_app))
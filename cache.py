@@ -0,0 +1,91 @@
+"""
+プロセス内のTTL付きキャッシュ
+DBHelperの読み取り結果（認証状態・確認待ちの予定など）を短時間保持する
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry
+
+CACHE_REQUESTS = registry.counter('cache_requests_total', 'キャッシュの参照数（cache別、result=hit/miss）')
+
+_MISSING = object()
+
+
+class TTLCache:
+    """有効期限と最大件数を持つスレッドセーフなキャッシュ
+
+    読み込み中に無効化された値を保存しないよう、load前にversion()を取得して
+    put()に渡す（その間にinvalidate/clearがあれば保存しない）。
+    """
+
+    def __init__(self, name, ttl_seconds, max_entries=10000):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (有効期限, 値)
+        self._lock = threading.Lock()
+        self._version = 0
+
+    @property
+    def enabled(self):
+        return self.ttl_seconds > 0
+
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        """(ヒットしたか, 値) を返す"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                CACHE_REQUESTS.inc(cache=self.name, result='hit')
+                return True, entry[1]
+            if entry is not _MISSING:
+                del self._entries[key]
+        CACHE_REQUESTS.inc(cache=self.name, result='miss')
+        return False, None
+
+    def put(self, key, value, version=None):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_entries:
+                self._evict(now)
+            self._entries[key] = (now + self.ttl_seconds, value)
+
+    def _evict(self, now):
+        # 期限切れを捨て、それでも満杯なら古い順に捨てる
+        for key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """キャッシュになければloader()で読み込んで保存する"""
+        hit, value = self.get(key)
+        if hit:
+            return value
+        version = self._version
+        value = loader()
+        self.put(key, value, version)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
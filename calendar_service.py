@@ -1,143 +1,157 @@
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google.auth.exceptions import TransportError
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
 from datetime import datetime, timedelta
+from urllib.parse import quote
+import asyncio
 import os
+import requests
 import json
 import pytz
 from config import Config
+from deadline import DeadlineExceeded, stage_timed_out, stage_timeout
 from dateutil import parser
-from db import DBHelper
+from db import get_db
+from http_clients import GoogleHttp, google_session
+from tracing import span
 import logging
 
 logger = logging.getLogger("calendar_service")
-logger.setLevel(logging.INFO)
-if not logger.hasHandlers():
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+# _get_user_credentials にトークンが渡されなかったことを表す（Noneは「トークンなし」）
+TOKEN_NOT_LOADED = object()
+
+# 非同期版（*_async）で直接呼び出すCalendar APIのURL
+CALENDAR_API_BASE = 'https://www.googleapis.com/calendar/v3'
+
+class CalendarAuthError(Exception):
+    """ユーザーのGoogle認証情報が存在しない・失効している場合の例外"""
+    pass
+
+class CalendarApiError(Exception):
+    """Calendar API（非同期版）がエラーを返した場合の例外"""
+    def __init__(self, status, body):
+        super().__init__(f"Calendar APIエラー ({status}): {body[:200]}")
+        self.status = status
+
+def _event_summary(event):
+    """Calendar APIのイベントを {'title', 'start', 'end'} にまとめる"""
+    return {
+        'title': event.get('summary', 'タイトルなし'),
+        'start': event['start'].get('dateTime', event['start'].get('date')),
+        'end': event['end'].get('dateTime', event['end'].get('date'))
+    }
+
+def _execute(operation, request):
+    """Calendar APIのリクエストを実行する（トレースのスパンで計測する）"""
+    with span('calendar', operation):
+        return request.execute()
 
 class GoogleCalendarService:
     def __init__(self):
         self.SCOPES = ['https://www.googleapis.com/auth/calendar']
-        self.db_helper = DBHelper()
         self.creds = None
         self.service = None
+        self._http = None  # 非同期版で使うaiohttpのセッション
         self._authenticate()
     
+    @property
+    def db_helper(self):
+        """プロセス共有のDBHelper"""
+        return get_db()
+    
     def _authenticate(self):
         """Google Calendar APIの認証を行います（非推奨のpickle形式は使用しない）"""
         # このメソッドは非推奨。ユーザーごとの認証は_get_user_credentialsを使用
         self.creds = None
         self.service = None
     
-    def _get_user_credentials(self, line_user_id):
-        """ユーザーの認証トークンをDBから取得（JSON形式対応）"""
+    def _get_user_credentials(self, line_user_id, token_data=TOKEN_NOT_LOADED):
+        """ユーザーの認証トークンから認証情報を作成（JSON形式・古いpickle形式に対応）
+
+        token_dataに一括取得済みのトークン（DBHelper.get_google_tokens）を渡すとDBを読まない。
+        """
         try:
-            print(f"[DEBUG] _get_user_credentials開始: line_user_id={line_user_id}")
-            
-            # まずJSON形式で取得を試行
-            json_data = self.db_helper.get_google_token_json(line_user_id)
-            if json_data:
-                try:
-                    print(f"[DEBUG] JSON形式のトークンデータを取得")
-                    # バイト列の場合は文字列に変換
-                    if isinstance(json_data, bytes):
-                        json_data = json_data.decode('utf-8')
-                    elif hasattr(json_data, 'tobytes'):  # memoryviewの場合
-                        json_data = json_data.tobytes().decode('utf-8')
-                    
-                    credentials = Credentials.from_authorized_user_info(json.loads(json_data))
-                    print(f"[DEBUG] JSON形式のトークンデータのデシリアライズ完了: credentials={credentials is not None}")
-                    
-                    # トークンの有効期限をチェック
-                    if credentials and credentials.expired and credentials.refresh_token:
-                        print(f"[DEBUG] トークンのリフレッシュ開始")
-                        credentials.refresh(Request())
-                        print(f"[DEBUG] トークンのリフレッシュ完了")
-                        # 更新されたトークンをDBに保存
-                        self.db_helper.save_google_token_json(line_user_id, credentials.to_json())
-                        print(f"[DEBUG] 更新されたトークンをDBに保存完了")
-                    
-                    return credentials
-                    
-                except Exception as e:
-                    print(f"[DEBUG] JSON形式のトークン読み込みエラー: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    # JSON形式で失敗した場合は古いpickle形式を試行
-                    pass
-            
-            # 古いpickle形式のトークンを取得（後方互換性）
-            token_data = self.db_helper.get_google_token(line_user_id)
-            print(f"[DEBUG] DBから取得したトークンデータ: {token_data is not None}")
+            logger.debug("_get_user_credentials開始: line_user_id=%s", line_user_id)
+            if token_data is TOKEN_NOT_LOADED:
+                token_data = self.db_helper.get_google_token(line_user_id)
+            logger.debug("トークンデータ: %s", token_data is not None)
             
             if not token_data:
-                print(f"[DEBUG] トークンデータが取得できませんでした")
+                logger.debug("トークンデータが取得できませんでした")
                 return None
             
+            # memoryview（PostgreSQLのbytea）の場合はバイト列に変換
+            if hasattr(token_data, 'tobytes'):
+                token_data = token_data.tobytes()
+            
+            credentials = None
             try:
-                print(f"[DEBUG] 古いpickle形式のトークンデータのデシリアライズ開始")
-                import pickle
-                
-                # データの型を確認して適切に処理
-                if isinstance(token_data, bytes):
-                    # バイト列の場合はそのままpickle.loads
-                    credentials = pickle.loads(token_data)
-                elif hasattr(token_data, 'tobytes'):  # memoryviewの場合
-                    credentials = pickle.loads(token_data.tobytes())
-                else:
-                    # その他の場合は文字列として扱う
-                    credentials = pickle.loads(token_data)
-                
-                print(f"[DEBUG] 古いpickle形式のトークンデータのデシリアライズ完了: credentials={credentials is not None}")
-                
-                # トークンの有効期限をチェック
-                if credentials and credentials.expired and credentials.refresh_token:
-                    print(f"[DEBUG] トークンのリフレッシュ開始")
-                    credentials.refresh(Request())
-                    print(f"[DEBUG] トークンのリフレッシュ完了")
-                    # 更新されたトークンをJSON形式で保存（移行）
-                    self.db_helper.save_google_token_json(line_user_id, credentials.to_json())
-                    print(f"[DEBUG] 更新されたトークンをJSON形式でDBに保存完了")
-                
-                return credentials
-                
+                # まずJSON形式として読み込む
+                json_data = token_data.decode('utf-8') if isinstance(token_data, bytes) else token_data
+                credentials = Credentials.from_authorized_user_info(json.loads(json_data))
+                logger.debug("JSON形式のトークンデータのデシリアライズ完了: credentials=%s", credentials is not None)
             except Exception as e:
-                print(f"[DEBUG] 古いpickle形式のトークン読み込みエラー: {e}")
-                import traceback
-                traceback.print_exc()
-                return None
+                logger.warning("JSON形式のトークン読み込みエラー: %s", e)
+            
+            if credentials is None:
+                # JSON形式で失敗した場合は古いpickle形式を試行（後方互換性）
+                try:
+                    logger.debug("古いpickle形式のトークンデータのデシリアライズ開始")
+                    import pickle
+                    credentials = pickle.loads(token_data)
+                    logger.debug("古いpickle形式のトークンデータのデシリアライズ完了: credentials=%s", credentials is not None)
+                except Exception as e:
+                    logger.exception("古いpickle形式のトークン読み込みエラー: %s", e)
+                    return None
+            
+            # トークンの有効期限をチェック
+            if credentials and credentials.expired and credentials.refresh_token:
+                logger.debug("トークンのリフレッシュ開始")
+                with span('calendar', 'token.refresh'):
+                    credentials.refresh(Request(session=google_session()))
+                logger.debug("トークンのリフレッシュ完了")
+                # 更新されたトークンをJSON形式でDBに保存（pickle形式からの移行を兼ねる）
+                self.db_helper.save_google_token_json(line_user_id, credentials.to_json())
+                logger.debug("更新されたトークンをJSON形式でDBに保存完了")
+            
+            return credentials
                 
+        except TransportError:
+            # ネットワーク起因のリフレッシュ失敗は認証切れと区別するため呼び出し元に伝える
+            raise
         except Exception as e:
-            print(f"[DEBUG] _get_user_credentialsで例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("_get_user_credentialsで例外発生: %s", e)
             return None
     
-    def _get_calendar_service(self, line_user_id):
+    def _get_calendar_service(self, line_user_id, token_data=TOKEN_NOT_LOADED):
         """ユーザーごとのGoogle Calendarサービスを取得"""
         try:
-            print(f"[DEBUG] _get_calendar_service開始: line_user_id={line_user_id}")
-            credentials = self._get_user_credentials(line_user_id)
-            print(f"[DEBUG] 認証情報取得結果: credentials={credentials is not None}")
+            logger.debug("_get_calendar_service開始: line_user_id=%s", line_user_id)
+            credentials = self._get_user_credentials(line_user_id, token_data)
+            logger.debug("認証情報取得結果: credentials=%s", credentials is not None)
             
             if not credentials:
-                print(f"[DEBUG] 認証情報が取得できませんでした")
-                raise Exception("ユーザーの認証トークンが見つかりません。認証を完了してください。")
+                logger.debug("認証情報が取得できませんでした")
+                raise CalendarAuthError("ユーザーの認証トークンが見つかりません。認証を完了してください。")
             
-            print(f"[DEBUG] Google Calendar APIサービス構築開始")
-            service = build('calendar', 'v3', credentials=credentials)
-            print(f"[DEBUG] Google Calendar APIサービス構築完了")
+            logger.debug("Google Calendar APIサービス構築開始")
+            # タイムアウトは処理期限の残り時間までに抑える
+            http = GoogleHttp(stage_timeout('calendar', Config.GOOGLE_API_TIMEOUT_SECONDS))
+            service = build('calendar', 'v3', http=AuthorizedHttp(credentials, http=http))
+            logger.debug("Google Calendar APIサービス構築完了")
             return service
             
         except Exception as e:
-            print(f"[DEBUG] _get_calendar_serviceで例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("_get_calendar_serviceで例外発生: %s", e)
             raise e
     
+    def get_calendar_service(self, line_user_id, token_data=TOKEN_NOT_LOADED):
+        """ユーザーごとのGoogle Calendarサービスを取得（認証情報の読み込みと予定取得を分けて扱う場合用）"""
+        return self._get_calendar_service(line_user_id, token_data)
+    
     def check_availability(self, start_time, end_time):
         """指定された時間帯の空き時間を確認します"""
         try:
@@ -148,13 +162,13 @@ class GoogleCalendarService:
                 s = dt.isoformat()
                 return s if s.endswith(("+09:00", "+00:00", "-0")) else s + "Z"
             # 指定された時間帯のイベントを取得
-            events_result = self.service.events().list(
+            events_result = _execute('events.list', self.service.events().list(
                 calendarId=Config.GOOGLE_CALENDAR_ID,  # 'primary'（各ユーザーのメインカレンダー）
                 timeMin=iso_no_z(start_time),
                 timeMax=iso_no_z(end_time),
                 singleEvents=True,
                 orderBy='startTime'
-            ).execute()
+            ))
             events = events_result.get('items', [])
             if not events:
                 return True, "指定された時間帯は空いています。"
@@ -182,7 +196,7 @@ class GoogleCalendarService:
             # 既存の予定をチェック（force_addがFalseのときのみ）
             if not force_add:
                 events = self.get_events_for_time_range(start_time, end_time, line_user_id)
-                logger.info(f"[DEBUG] add_event: 追加前に取得したevents = {events}")
+                logger.debug("add_event: 追加前に取得したevents = %s", events)
                 if events and len(events) > 0:
                     conflicting_events = []
                     for event in events:
@@ -194,40 +208,52 @@ class GoogleCalendarService:
                             'start': event['start'].get('dateTime', event['start'].get('date')) if isinstance(event['start'], dict) else event['start'],
                             'end': event['end'].get('dateTime', event['end'].get('date')) if isinstance(event['end'], dict) else event['end']
                         })
-                    logger.info(f"[DEBUG] 既存の予定があるため追加しません: {conflicting_events}")
+                    logger.debug("既存の予定があるため追加しません: %s", conflicting_events)
                     if conflicting_events:
                         return False, "指定された時間に既存の予定があります", conflicting_events
             # イベントを作成
-            event = {
-                'summary': title,
-                'description': description,
-                'start': {
-                    'dateTime': start_time.isoformat(),
-                    'timeZone': 'Asia/Tokyo',
-                },
-                'end': {
-                    'dateTime': end_time.isoformat(),
-                    'timeZone': 'Asia/Tokyo',
-                },
-            }
-            logger.info(f"[DEBUG] Google Calendar APIへイベント追加リクエスト: {event}")
+            event = self._event_body(title, start_time, end_time, description)
+            logger.debug("Google Calendar APIへイベント追加リクエスト: %s", event)
             # イベントを追加
-            event = service.events().insert(
+            event = _execute('events.insert', service.events().insert(
                 calendarId=Config.GOOGLE_CALENDAR_ID,  # 'primary'（各ユーザーのメインカレンダー）
                 body=event
-            ).execute()
-            logger.info(f"[DEBUG] Google Calendar APIレスポンス: {event}")
+            ))
+            logger.debug("Google Calendar APIレスポンス: %s", event)
             return True, "✅予定を追加しました", {
                 'title': title,
                 'start': start_time.isoformat(),
                 'end': end_time.isoformat()
             }
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"[ERROR] add_eventで例外発生: {e}")
+            if isinstance(e, (TimeoutError, requests.exceptions.Timeout)):
+                stage_timed_out('calendar')
             return False, f"エラーが発生しました: {str(e)}", None
     
-    def get_events_for_dates(self, dates, line_user_id=None):
-        """指定された日付のイベントを取得します（ユーザーごとの認証トークン対応、JST日付で正確に抽出）"""
+    def _event_body(self, title, start_time, end_time, description):
+        """Calendar APIに追加するイベント"""
+        return {
+            'summary': title,
+            'description': description,
+            'start': {
+                'dateTime': start_time.isoformat(),
+                'timeZone': 'Asia/Tokyo',
+            },
+            'end': {
+                'dateTime': end_time.isoformat(),
+                'timeZone': 'Asia/Tokyo',
+            },
+        }
+
+    def get_events_for_dates(self, dates, line_user_id=None, raise_errors=False, service=None):
+        """指定された日付のイベントを取得します（ユーザーごとの認証トークン対応、JST日付で正確に抽出）
+
+        raise_errors=Trueの場合、取得時の例外を結果に埋め込まずそのまま送出します。
+        serviceを渡した場合は、認証情報を読み込まずにそのサービスで取得します。
+        """
         import pytz
         events_info = []
         jst = pytz.timezone('Asia/Tokyo')
@@ -238,7 +264,8 @@ class GoogleCalendarService:
             start_of_day_utc = start_of_day_jst.astimezone(pytz.UTC)
             end_of_day_utc = end_of_day_jst.astimezone(pytz.UTC)
             try:
-                service = self._get_calendar_service(line_user_id) if line_user_id else self.service
+                if service is None:
+                    service = self._get_calendar_service(line_user_id) if line_user_id else self.service
                 if not service:
                     events_info.append({
                         'date': date.strftime('%Y-%m-%d'),
@@ -246,15 +273,15 @@ class GoogleCalendarService:
                         'error': 'Google認証が必要です。'
                     })
                     continue
-                events_result = service.events().list(
+                events_result = _execute('events.list', service.events().list(
                     calendarId=Config.GOOGLE_CALENDAR_ID,
                     timeMin=start_of_day_utc.isoformat(),
                     timeMax=end_of_day_utc.isoformat(),
                     singleEvents=True,
                     orderBy='startTime'
-                ).execute()
-                print(f"[DEBUG] Google Calendar APIレスポンス: {events_result}")
+                ))
                 events = events_result.get('items', [])
+                logger.debug("get_events_for_dates: date=%s, 取得イベント数=%s", date, len(events))
                 if events:
                     day_events = []
                     for event in events:
@@ -276,6 +303,8 @@ class GoogleCalendarService:
                         'events': []
                     })
             except Exception as e:
+                if raise_errors:
+                    raise
                 events_info.append({
                     'date': date.strftime('%Y-%m-%d'),
                     'error': str(e)
@@ -285,8 +314,8 @@ class GoogleCalendarService:
     def get_events_for_time_range(self, start_time, end_time, line_user_id):
         """指定された時間範囲のイベントを取得します"""
         try:
-            print(f"[DEBUG] get_events_for_time_range開始")
-            print(f"[DEBUG] 入力: start_time={start_time}, end_time={end_time}, line_user_id={line_user_id}")
+            logger.debug("get_events_for_time_range開始")
+            logger.debug("入力: start_time=%s, end_time=%s, line_user_id=%s", start_time, end_time, line_user_id)
             
             jst = pytz.timezone('Asia/Tokyo')
             # タイムゾーンなしならJSTを付与
@@ -295,38 +324,38 @@ class GoogleCalendarService:
             if end_time.tzinfo is None:
                 end_time = jst.localize(end_time)
             
-            print(f"[DEBUG] タイムゾーン調整後: start_time={start_time}, end_time={end_time}")
+            logger.debug("タイムゾーン調整後: start_time=%s, end_time=%s", start_time, end_time)
             
             service = self._get_calendar_service(line_user_id)
-            print(f"[DEBUG] カレンダーサービス取得完了")
+            logger.debug("カレンダーサービス取得完了")
             
             # タイムゾーンをUTCに変換
             utc_start = start_time.astimezone(pytz.UTC)
             utc_end = end_time.astimezone(pytz.UTC)
             
-            print(f"[DEBUG] UTC変換後: utc_start={utc_start}, utc_end={utc_end}")
-            print(f"[DEBUG] Google Calendar APIリクエスト: calendarId={Config.GOOGLE_CALENDAR_ID}, timeMin={utc_start.isoformat()}, timeMax={utc_end.isoformat()}")
+            logger.debug("UTC変換後: utc_start=%s, utc_end=%s", utc_start, utc_end)
+            logger.debug("Google Calendar APIリクエスト: calendarId=%s, timeMin=%s, timeMax=%s", Config.GOOGLE_CALENDAR_ID, utc_start.isoformat(), utc_end.isoformat())
             
-            events_result = service.events().list(
+            events_result = _execute('events.list', service.events().list(
                 calendarId=Config.GOOGLE_CALENDAR_ID,  # 'primary'（各ユーザーのメインカレンダー）
                 timeMin=utc_start.isoformat(),
                 timeMax=utc_end.isoformat(),
                 singleEvents=True,
                 orderBy='startTime'
-            ).execute()
+            ))
             
-            print(f"[DEBUG] Google Calendar APIレスポンス: {events_result}")
+            logger.debug("Google Calendar APIレスポンス: %s", events_result)
             
             events = events_result.get('items', [])
-            print(f"[DEBUG] 取得イベント数: {len(events) if events else 0}")
+            logger.debug("取得イベント数: %s", len(events) if events else 0)
             
             if not events:
-                print(f"[DEBUG] イベントなし、空リストを返す")
+                logger.debug("イベントなし、空リストを返す")
                 return []
             
             event_list = []
             for i, event in enumerate(events):
-                print(f"[DEBUG] イベント{i+1}処理: {event}")
+                logger.debug("イベント%s処理: %s", i+1, event)
                 start = event['start'].get('dateTime', event['start'].get('date'))
                 end = event['end'].get('dateTime', event['end'].get('date'))
                 title = event.get('summary', 'タイトルなし')
@@ -337,24 +366,112 @@ class GoogleCalendarService:
                     'end': end
                 }
                 event_list.append(event_data)
-                print(f"[DEBUG] イベント{i+1}追加: {event_data}")
+                logger.debug("イベント%s追加: %s", i+1, event_data)
             
-            print(f"[DEBUG] 最終イベントリスト: {event_list}")
+            logger.debug("最終イベントリスト: %s", event_list)
             return event_list
             
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            print(f"[DEBUG] get_events_for_time_rangeで例外発生: {e}")
-            import traceback
-            traceback.print_exc()
-            logging.error(f"イベント取得エラー: {e}")
+            logger.exception("get_events_for_time_rangeで例外発生: %s", e)
+            if isinstance(e, (TimeoutError, requests.exceptions.Timeout)):
+                stage_timed_out('calendar')
             return []
     
+    # --- 非同期版（asgi.pyの処理経路で使う。Calendar APIはaiohttpで直接呼び出す） ---
+    def _http_session(self):
+        """Calendar API用のaiohttpセッション（イベントループ内で最初に使われたときに作成し、接続を使い回す）"""
+        if self._http is None or self._http.closed:
+            import aiohttp
+            self._http = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=Config.GOOGLE_API_TIMEOUT_SECONDS)
+            )
+        return self._http
+
+    async def aclose(self):
+        """aiohttpセッションを閉じる"""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def get_access_token_async(self, line_user_id):
+        """ユーザーのアクセストークンを返す（DBの読み込みと期限切れ時のリフレッシュは別スレッドで行う）"""
+        credentials = await asyncio.to_thread(self._get_user_credentials, line_user_id)
+        if not credentials:
+            raise CalendarAuthError("ユーザーの認証トークンが見つかりません。認証を完了してください。")
+        return credentials.token
+
+    async def _request_async(self, method, path, access_token, **kwargs):
+        import aiohttp
+        url = f"{CALENDAR_API_BASE}/calendars/{quote(Config.GOOGLE_CALENDAR_ID, safe='')}/{path}"
+        headers = {'Authorization': f'Bearer {access_token}'}
+        # タイムアウトは処理期限の残り時間までに抑える
+        timeout = aiohttp.ClientTimeout(total=stage_timeout('calendar', Config.GOOGLE_API_TIMEOUT_SECONDS))
+        with span('calendar', f"{method} {path}") as s:
+            try:
+                async with self._http_session().request(method, url, headers=headers, timeout=timeout, **kwargs) as response:
+                    s.set('status', response.status)
+                    if response.status >= 400:
+                        raise CalendarApiError(response.status, await response.text())
+                    return await response.json()
+            except asyncio.TimeoutError:
+                stage_timed_out('calendar')
+                raise
+
+    async def get_events_for_time_range_async(self, start_time, end_time, line_user_id, access_token=None):
+        """get_events_for_time_rangeの非同期版（access_tokenを渡すと認証情報を読み込まない）"""
+        try:
+            jst = pytz.timezone('Asia/Tokyo')
+            if start_time.tzinfo is None:
+                start_time = jst.localize(start_time)
+            if end_time.tzinfo is None:
+                end_time = jst.localize(end_time)
+            access_token = access_token or await self.get_access_token_async(line_user_id)
+            events_result = await self._request_async('GET', 'events', access_token, params={
+                'timeMin': start_time.astimezone(pytz.UTC).isoformat(),
+                'timeMax': end_time.astimezone(pytz.UTC).isoformat(),
+                'singleEvents': 'true',
+                'orderBy': 'startTime',
+            })
+            return [_event_summary(event) for event in events_result.get('items', [])]
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error(f"イベント取得エラー: {e}")
+            return []
+
+    async def add_event_async(self, title, start_time, end_time, description="", line_user_id=None, force_add=False, access_token=None):
+        """add_eventの非同期版（access_tokenを渡すと認証情報を読み込まない）"""
+        try:
+            if not line_user_id:
+                return False, "ユーザーIDが必要です", None
+            access_token = access_token or await self.get_access_token_async(line_user_id)
+            if not force_add:
+                events = await self.get_events_for_time_range_async(start_time, end_time, line_user_id, access_token)
+                if events:
+                    return False, "指定された時間に既存の予定があります", events
+            await self._request_async(
+                'POST', 'events', access_token,
+                json=self._event_body(title, start_time, end_time, description)
+            )
+            return True, "✅予定を追加しました", {
+                'title': title,
+                'start': start_time.isoformat(),
+                'end': end_time.isoformat()
+            }
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error(f"[ERROR] add_event_asyncで例外発生: {e}")
+            return False, f"エラーが発生しました: {str(e)}", None
+
     def find_free_slots_for_day(self, start_dt, end_dt, events):
         """指定枠(start_dt, end_dt)内で既存予定を除いた空き時間帯リストを返す"""
         try:
-            logger.info(f"[DEBUG] find_free_slots_for_day開始")
-            logger.info(f"[DEBUG] 検索枠: {start_dt} 〜 {end_dt}")
-            logger.info(f"[DEBUG] 既存予定数: {len(events) if events else 0}")
+            logger.debug("find_free_slots_for_day開始")
+            logger.debug("検索枠: %s 〜 %s", start_dt, end_dt)
+            logger.debug("既存予定数: %s", len(events) if events else 0)
             
             jst = pytz.timezone('Asia/Tokyo')
             if start_dt.tzinfo is None:
@@ -364,7 +481,7 @@ class GoogleCalendarService:
                 
             # eventsがNoneや空の場合は必ず再取得
             if events is None or len(events) == 0:
-                logger.info(f"[DEBUG] 既存予定なし、全日空き時間として返す")
+                logger.debug("既存予定なし、全日空き時間として返す")
                 return [{
                     'start': start_dt.strftime('%H:%M'),
                     'end': end_dt.strftime('%H:%M')
@@ -372,53 +489,53 @@ class GoogleCalendarService:
                 
             # 既存予定を時間順にbusy_timesへ
             busy_times = []
-            logger.info(f"[DEBUG] 既存予定の処理開始")
+            logger.debug("既存予定の処理開始")
             
             for i, event in enumerate(events):
-                logger.info(f"[DEBUG] 予定{i+1}: {event}")
+                logger.debug("予定%s: %s", i+1, event)
                 
                 start = event['start'] if isinstance(event['start'], str) else event['start'].get('dateTime', event['start'].get('date'))
                 end = event['end'] if isinstance(event['end'], str) else event['end'].get('dateTime', event['end'].get('date'))
                 
-                logger.info(f"[DEBUG] 予定{i+1}の時間: {start} 〜 {end}")
+                logger.debug("予定%sの時間: %s 〜 %s", i+1, start, end)
                 
                 if 'T' in start:  # dateTime形式
                     start_ev = datetime.fromisoformat(start.replace('Z', '+00:00'))
                     end_ev = datetime.fromisoformat(end.replace('Z', '+00:00'))
                     
-                    logger.info(f"[DEBUG] 予定{i+1}のパース後: {start_ev} 〜 {end_ev}")
+                    logger.debug("予定%sのパース後: %s 〜 %s", i+1, start_ev, end_ev)
                     
                     # 枠外の予定は除外
                     if end_ev <= start_dt or start_ev >= end_dt:
-                        logger.info(f"[DEBUG] 予定{i+1}は枠外のため除外")
+                        logger.debug("予定%sは枠外のため除外", i+1)
                         continue
                         
                     busy_start = max(start_ev, start_dt)
                     busy_end = min(end_ev, end_dt)
                     busy_times.append((busy_start, busy_end))
-                    logger.info(f"[DEBUG] 予定{i+1}をbusy_timesに追加: {busy_start} 〜 {busy_end}")
+                    logger.debug("予定%sをbusy_timesに追加: %s 〜 %s", i+1, busy_start, busy_end)
                     
                 else:  # date型（終日予定）
                     allday_start = jst.localize(datetime.combine(datetime.strptime(start, "%Y-%m-%d"), datetime.min.time()))
                     allday_end = allday_start + timedelta(days=1)
                     
-                    logger.info(f"[DEBUG] 予定{i+1}は終日予定: {allday_start} 〜 {allday_end}")
+                    logger.debug("予定%sは終日予定: %s 〜 %s", i+1, allday_start, allday_end)
                     
                     if allday_end <= start_dt or allday_start >= end_dt:
-                        logger.info(f"[DEBUG] 予定{i+1}は枠外のため除外")
+                        logger.debug("予定%sは枠外のため除外", i+1)
                         continue
                         
                     busy_start = max(allday_start, start_dt)
                     busy_end = min(allday_end, end_dt)
                     busy_times.append((busy_start, busy_end))
-                    logger.info(f"[DEBUG] 予定{i+1}をbusy_timesに追加: {busy_start} 〜 {busy_end}")
+                    logger.debug("予定%sをbusy_timesに追加: %s 〜 %s", i+1, busy_start, busy_end)
             
-            logger.info(f"[DEBUG] busy_times: {busy_times}")
+            logger.debug("busy_times: %s", busy_times)
             
             # 空き時間を計算
             free_slots = []
             if not busy_times:
-                logger.info(f"[DEBUG] busy_timesが空、全日空き時間として返す")
+                logger.debug("busy_timesが空、全日空き時間として返す")
                 free_slots.append({
                     'start': start_dt.strftime('%H:%M'),
                     'end': end_dt.strftime('%H:%M')
@@ -427,13 +544,13 @@ class GoogleCalendarService:
                 
             # busy_timesを開始時刻順に明示的にソート
             busy_times = sorted(busy_times, key=lambda x: x[0])
-            logger.info(f"[DEBUG] ソート後のbusy_times: {busy_times}")
+            logger.debug("ソート後のbusy_times: %s", busy_times)
             
             current_time = start_dt
-            logger.info(f"[DEBUG] 空き時間計算開始、current_time: {current_time}")
+            logger.debug("空き時間計算開始、current_time: %s", current_time)
             
             for i, (busy_start, busy_end) in enumerate(busy_times):
-                logger.info(f"[DEBUG] busy_times[{i}]処理: {busy_start} 〜 {busy_end}")
+                logger.debug("busy_times[%s]処理: %s 〜 %s", i, busy_start, busy_end)
                 
                 if current_time < busy_start:
                     free_slot = {
@@ -441,10 +558,10 @@ class GoogleCalendarService:
                         'end': busy_start.strftime('%H:%M')
                     }
                     free_slots.append(free_slot)
-                    logger.info(f"[DEBUG] 空き時間を追加: {free_slot}")
+                    logger.debug("空き時間を追加: %s", free_slot)
                     
                 current_time = max(current_time, busy_end)
-                logger.info(f"[DEBUG] current_time更新: {current_time}")
+                logger.debug("current_time更新: %s", current_time)
                 
             if current_time < end_dt:
                 free_slot = {
@@ -452,9 +569,9 @@ class GoogleCalendarService:
                     'end': end_dt.strftime('%H:%M')
                 }
                 free_slots.append(free_slot)
-                logger.info(f"[DEBUG] 最後の空き時間を追加: {free_slot}")
+                logger.debug("最後の空き時間を追加: %s", free_slot)
                 
-            logger.info(f"[DEBUG] 最終的な空き時間: {free_slots}")
+            logger.debug("最終的な空き時間: %s", free_slots)
             return free_slots 
             
         except Exception as e:
@@ -0,0 +1,70 @@
+"""
+ユーザーごとのメッセージのまとめ処理
+短い間隔で分けて送られたテキストメッセージ（「7/10 9-10時」「7/11 9-10時」…）を、
+最初のメッセージから MESSAGE_COALESCE_MS 以内に届いたものまで1つの入力にまとめ、
+日時抽出（OpenAI）とCalendar APIの呼び出し・返信を1回にする。
+
+まとめるのはプロセス内で受け取ったメッセージだけ（複数プロセスに分かれて届いたメッセージはまとめない）。
+"""
+import asyncio
+import threading
+import time
+
+from metrics import registry
+
+COALESCED_MESSAGES = registry.counter('message_coalesced_total', '直前のメッセージとまとめて処理したメッセージ数')
+
+
+class MessageBatch:
+    """1人のユーザーの、まとめて処理するメッセージ"""
+
+    def __init__(self, coalescer, user_id, text, reply_token, closes_at):
+        self._coalescer = coalescer
+        self.user_id = user_id
+        self.texts = [text]
+        # 返信には最後に届いたメッセージのreply tokenを使う（有効期限が最も長い）
+        self.reply_token = reply_token
+        self.closes_at = closes_at
+
+    def wait(self):
+        """受付期間が終わるまで待ち、(まとめたテキスト, reply token) を返す"""
+        time.sleep(max(0.0, self.closes_at - time.monotonic()))
+        return self._coalescer._close(self)
+
+    async def wait_async(self):
+        """waitの非同期版"""
+        await asyncio.sleep(max(0.0, self.closes_at - time.monotonic()))
+        return self._coalescer._close(self)
+
+
+class MessageCoalescer:
+    """ユーザーごとに、window_ms以内に続けて届いたテキストメッセージを1つの入力にまとめる"""
+
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def join(self, user_id, text, reply_token):
+        """メッセージを受け付ける
+
+        受付中のまとめがなければ新しく作って返す（呼び出し元がwaitして処理する）。
+        受付中のまとめに追加した場合はNoneを返す（呼び出し元は返信しない）。
+        """
+        with self._lock:
+            now = time.monotonic()
+            batch = self._batches.get(user_id)
+            if batch is not None and now < batch.closes_at:
+                batch.texts.append(text)
+                batch.reply_token = reply_token
+                COALESCED_MESSAGES.inc()
+                return None
+            batch = MessageBatch(self, user_id, text, reply_token, now + self.window)
+            self._batches[user_id] = batch
+            return batch
+
+    def _close(self, batch):
+        with self._lock:
+            if self._batches.get(batch.user_id) is batch:
+                del self._batches[batch.user_id]
+            return '\n'.join(batch.texts), batch.reply_token
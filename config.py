@@ -21,6 +21,59 @@ class Config:
     # アプリケーション設定
     TIMEZONE = os.getenv('TIMEZONE', 'Asia/Tokyo')
     DEFAULT_EVENT_DURATION = int(os.getenv('DEFAULT_EVENT_DURATION', '60'))  # 分
+    GOOGLE_API_TIMEOUT_SECONDS = float(os.getenv('GOOGLE_API_TIMEOUT_SECONDS', '15'))  # Calendar APIのタイムアウト（秒）
+    OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '20'))  # OpenAI APIのタイムアウト（秒）
+    
+    # ログ設定（logging_config.py）
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # 全体のログレベル
+    LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # モジュールごとのログレベル（例: calendar_service=DEBUG,linebot=WARNING）
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text または json
+    LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1.0'))  # DEBUGログを出力するリクエストの割合（0〜1）
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # 書き出し待ちのログの上限（超えた分は捨てる）
+    
+    # トレース設定（tracing.py）
+    TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '')  # jsonl または otlp（空ならスパンを書き出さず、1行のまとめのログだけ出力する）
+    TRACE_JSONL_PATH = os.getenv('TRACE_JSONL_PATH', 'traces.jsonl')  # jsonlの書き出し先
+    TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')  # OTLP/HTTPのコレクター
+    
+    # LINE送信（line_gateway.py）設定
+    LINE_REPLY_RATE_PER_SECOND = float(os.getenv('LINE_REPLY_RATE_PER_SECOND', '100'))  # replyの送信レート上限（0で無制限）
+    LINE_PUSH_RATE_PER_SECOND = float(os.getenv('LINE_PUSH_RATE_PER_SECOND', '100'))  # pushの送信レート上限（0で無制限）
+    LINE_SEND_MAX_ATTEMPTS = int(os.getenv('LINE_SEND_MAX_ATTEMPTS', '4'))  # 一時的なエラーの最大試行回数
+    LINE_SEND_RETRY_BASE_SECONDS = float(os.getenv('LINE_SEND_RETRY_BASE_SECONDS', '0.5'))  # リトライの初回待機時間（指数バックオフ）
+    LINE_SEND_WORKERS = int(os.getenv('LINE_SEND_WORKERS', '4'))  # バックグラウンドでリトライするスレッド数
+    LINE_API_TIMEOUT_SECONDS = float(os.getenv('LINE_API_TIMEOUT_SECONDS', '10'))  # LINE APIのタイムアウト（秒）
+
+    # 時間がかかるメッセージ（OpenAI・Calendar API）の応答設定
+    LOADING_ANIMATION_SECONDS = int(os.getenv('LOADING_ANIMATION_SECONDS', '20'))  # 読み込み中アニメーションの表示秒数（5〜60）
+    REPLY_DEADLINE_SECONDS = float(os.getenv('REPLY_DEADLINE_SECONDS', '10'))  # この秒数内に終われば返信、過ぎたらpushで送る
+    MESSAGE_WORKERS = int(os.getenv('MESSAGE_WORKERS', '8'))  # 時間がかかるメッセージを処理するスレッド数（Flask）
+    MESSAGE_COALESCE_MS = int(os.getenv('MESSAGE_COALESCE_MS', '0'))  # この時間内に続けて届いたメッセージを1つにまとめる（ミリ秒、0で無効）
+    MESSAGE_DEADLINE_SECONDS = float(os.getenv('MESSAGE_DEADLINE_SECONDS', '25'))  # Webhook受信から応答までの処理期限（秒）
+    DEADLINE_OPTIONAL_MIN_SECONDS = float(os.getenv('DEADLINE_OPTIONAL_MIN_SECONDS', '3'))  # 残り時間がこれより少なければ省略できる処理を飛ばす
+    HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(MESSAGE_WORKERS + LINE_SEND_WORKERS)))  # 外部APIごとのkeep-alive接続プールの大きさ
+    HTTP_WARMUP_ON_BOOT = os.getenv('HTTP_WARMUP_ON_BOOT', '1') == '1'  # ワーカーの起動時に外部APIへの接続を確立する
+    HTTP_KEEPALIVE_INTERVAL_SECONDS = float(os.getenv('HTTP_KEEPALIVE_INTERVAL_SECONDS', '240'))  # 接続を保つためのリクエストの間隔（0で無効）
+
+    # 日次予定送信（タスク分散）設定
+    AGENDA_LEASE_SECONDS = int(os.getenv('AGENDA_LEASE_SECONDS', '300'))  # タスクのリース期間（秒）
+    AGENDA_CLAIM_BATCH_SIZE = int(os.getenv('AGENDA_CLAIM_BATCH_SIZE', '20'))  # 1回に確保するタスク数
+    AGENDA_MAX_ATTEMPTS = int(os.getenv('AGENDA_MAX_ATTEMPTS', '3'))  # リース切れで再確保する最大回数
+    AGENDA_LOCAL_WORKERS = int(os.getenv('AGENDA_LOCAL_WORKERS', '1'))  # Webプロセス内のワーカースレッド数
+    AGENDA_WORKER_POLL_SECONDS = int(os.getenv('AGENDA_WORKER_POLL_SECONDS', '30'))  # 専用ワーカーのポーリング間隔
+    AGENDA_RETRY_ATTEMPTS = int(os.getenv('AGENDA_RETRY_ATTEMPTS', '3'))  # 一時的なエラーの最大試行回数
+    AGENDA_RETRY_BASE_SECONDS = float(os.getenv('AGENDA_RETRY_BASE_SECONDS', '1.0'))  # リトライの初回待機時間（指数バックオフ）
+    REAUTH_NOTICE_INTERVAL_DAYS = int(os.getenv('REAUTH_NOTICE_INTERVAL_DAYS', '3'))  # 再認証案内の最短送信間隔（日）
+    
+    # 期限切れデータの定期削除（janitor）設定
+    JANITOR_INTERVAL_MINUTES = int(os.getenv('JANITOR_INTERVAL_MINUTES', '15'))  # 実行間隔（分）
+    JANITOR_BATCH_SIZE = int(os.getenv('JANITOR_BATCH_SIZE', '500'))  # 1トランザクションで削除する最大行数
+    JANITOR_MAX_BATCHES = int(os.getenv('JANITOR_MAX_BATCHES', '100'))  # 1回の実行でテーブルごとに処理する最大バッチ数
+    JANITOR_BATCH_PAUSE_SECONDS = float(os.getenv('JANITOR_BATCH_PAUSE_SECONDS', '0.1'))  # バッチ間の待機時間
+    JANITOR_STATEMENT_TIMEOUT_MS = int(os.getenv('JANITOR_STATEMENT_TIMEOUT_MS', '2000'))  # 1バッチの実行時間の上限（PostgreSQL）
+    OAUTH_STATE_TTL_MINUTES = int(os.getenv('OAUTH_STATE_TTL_MINUTES', '60'))  # OAuth stateの保持期間（分）
+    PENDING_EVENT_TTL_HOURS = int(os.getenv('PENDING_EVENT_TTL_HOURS', '24'))  # 確認待ちの予定の保持期間（時間）
+    CACHE_INVALIDATION_TTL_MINUTES = int(os.getenv('CACHE_INVALIDATION_TTL_MINUTES', '10'))  # キャッシュ無効化ログの保持期間（分）
     
     @classmethod
     def validate_config(cls):
@@ -7,10 +7,13 @@ import os
 import time
 import schedule
 from send_daily_agenda import send_daily_agenda
+from janitor import run_janitor
+from config import Config
+from logging_config import configure_logging
 import logging
 
 # ログ設定
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 def main():
@@ -22,6 +25,10 @@ def main():
     
     logger.info("スケジュール設定完了: 毎日19:00に明日の予定一覧を送信")
     
+    # 期限切れのワンタイムコード・OAuth state・確認待ちの予定を定期的に削除
+    schedule.every(Config.JANITOR_INTERVAL_MINUTES).minutes.do(run_janitor)
+    logger.info(f"スケジュール設定完了: {Config.JANITOR_INTERVAL_MINUTES}分ごとに期限切れデータを削除")
+    
     # メインループ
     while True:
         schedule.run_pending()
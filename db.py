@@ -1,213 +1,731 @@
+import contextvars
+import json
 import os
+import queue
 import sqlite3
-from datetime import datetime, timedelta
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import secrets
 import string
 import logging
+import threading
+import time
+import weakref
+
+import migrations
+import queries as q
+from cache import TTLCache
+from metrics import registry
+from sql import StatementRunner, is_missing_prepared, statement_stats
+from tracing import current_span, span
 
 logger = logging.getLogger(__name__)
 
 try:
     import psycopg2
     import psycopg2.extras
-    import psycopg2.pool
     PG_BINARY = psycopg2.Binary
+    RETRYABLE_DB_ERRORS = (psycopg2.InterfaceError, psycopg2.OperationalError)
 except ImportError:
     psycopg2 = None
     PG_BINARY = lambda x: x
+    RETRYABLE_DB_ERRORS = ()
 
 DB_PATH = 'line_calendar.db'
 
+# PostgreSQL接続プール設定
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))  # 起動時に開く接続数
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))  # 最大接続数（返却された接続はこの数まで閉じずに再利用する）
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv('DB_POOL_TIMEOUT_SECONDS', '10'))  # 空き接続を待つ最大時間
+DB_CONN_VALIDATE_IDLE_SECONDS = float(os.getenv('DB_CONN_VALIDATE_IDLE_SECONDS', '30'))  # これ以上アイドルだった接続のみ疎通確認
+DB_CONN_MAX_LIFETIME_SECONDS = float(os.getenv('DB_CONN_MAX_LIFETIME_SECONDS', '1800'))  # これより古い接続は作り直す
+# 頻繁に実行する文をプリペアドステートメントにする（PgBouncerのtransactionモード経由では0にする）
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', '1') == '1'
+
+# この時間（ミリ秒）以上かかったSQL文をパラメーターの形（値は出さない）と一緒にログに出す
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '200'))
+
+# 読み取りレプリカ（DATABASE_REPLICA_URL設定時）
+# ユーザー自身の書き込みからこの秒数の間は、そのユーザーの読み取りをプライマリで行う
+REPLICA_READ_YOUR_WRITES_SECONDS = float(os.getenv('REPLICA_READ_YOUR_WRITES_SECONDS', '10'))
+
+# SQLite設定（DATABASE_URL未設定時）
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))  # 他プロセスの書き込みロックを待つ最大時間
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '20000'))  # 接続ごとのページキャッシュ
+SQLITE_WRITE_BATCH_SIZE = int(os.getenv('SQLITE_WRITE_BATCH_SIZE', '100'))  # 1回のCOMMITでまとめる書き込み操作の最大数
+
+# ユーザーごとの読み取りキャッシュ設定（0で無効）
+AUTH_CACHE_TTL_SECONDS = float(os.getenv('AUTH_CACHE_TTL_SECONDS', '60'))  # 認証状態（user_exists）
+PENDING_CACHE_TTL_SECONDS = float(os.getenv('PENDING_CACHE_TTL_SECONDS', '30'))  # 確認待ちの予定（get_pending_event）
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+CACHE_INVALIDATION_POLL_SECONDS = float(os.getenv('CACHE_INVALIDATION_POLL_SECONDS', '1'))  # 他プロセスの変更ログを確認する間隔
+CACHE_INVALIDATION_OVERLAP_SECONDS = 5  # コミット順の前後を取りこぼさないよう前回確認時刻から遡る秒数
+
+POOL_IN_USE = registry.gauge('db_pool_connections_in_use', '使用中のDB接続数')
+POOL_MAX = registry.gauge('db_pool_connections_max', 'DB接続プールの最大接続数')
+POOL_WAITS = registry.counter('db_pool_waits_total', '空き接続を待ったチェックアウト数')
+POOL_WAIT_MS = registry.histogram('db_pool_wait_ms', 'チェックアウトで空き接続を待った時間（ミリ秒）')
+POOL_TIMEOUTS = registry.counter('db_pool_timeouts_total', '空き接続を待ちきれずに失敗したチェックアウト数')
+POOL_RECYCLED = registry.counter('db_pool_connections_recycled_total', '作り直したDB接続数（reason別）')
+DB_OPERATION_MS = registry.histogram('db_operation_duration_ms', 'DBHelperの操作ごとの実行時間（ミリ秒、リトライ・接続待ちを含む）')
+DB_OPERATION_ERRORS = registry.counter('db_operation_errors_total', '例外で終わったDBHelperの操作数（operation / error別）')
+DB_RETRIES = registry.counter('db_retries_total', '接続エラーでリトライしたDBHelperの操作数')
+DB_RECONNECTS = registry.counter('db_reconnects_total', '壊れていたため閉じて作り直したDB接続数')
+DB_SLOW_QUERIES = registry.counter('db_slow_queries_total', 'DB_SLOW_QUERY_MS以上かかったSQL文の数')
+REPLICA_READS = registry.counter('db_replica_reads_total', 'レプリカ対象の読み取り数（target=replica/primary）')
+REPLICA_FALLBACKS = registry.counter('db_replica_fallbacks_total', 'レプリカに接続できずプライマリで実行した読み取り数')
+SQLITE_WRITE_QUEUE = registry.gauge('sqlite_write_queue_depth', 'SQLiteの書き込み待ちの操作数')
+SQLITE_WRITE_BATCH = registry.histogram('sqlite_write_batch_size', 'SQLiteの1回のCOMMITでまとめた書き込み操作数',
+                                        buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+class PoolTimeoutError(Exception):
+    """接続プールに空きがなく、タイムアウトした場合の例外"""
+    pass
+
+
+class PostgresPool:
+    """PostgreSQLの接続プール
+
+    - 返却された接続は閉じずにアイドル接続として保持し、最大接続数まで再利用する
+    - 最大接続数を超えるチェックアウトは例外にせず空きが出るまで待つ
+    - 毎回SELECT 1で確認せず、一定時間アイドルだった接続だけ疎通確認する
+    - 一定時間より古い接続は閉じて作り直す
+    - 使用中の接続数・待ち回数を記録する
+    """
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, name='primary'):
+        self.dsn = dsn
+        self.name = name
+        self.maxconn = maxconn
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle = []  # 返却された接続（最後に返却したものから使う）
+        # 接続ごとの状態は接続オブジェクトをキーにする（閉じた接続が破棄されると一緒に消える）
+        self._born = weakref.WeakKeyDictionary()  # 接続 -> 作成時刻
+        self._last_used = weakref.WeakKeyDictionary()  # 接続 -> 最後に返却された時刻
+        self.on_discard = None  # 接続を閉じたときに呼ぶ関数
+        self.in_use = 0
+        self._closed = False
+        for _ in range(min(minconn, maxconn)):
+            self._idle.append(self._connect())
+        POOL_MAX.set(maxconn, pool=name)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=psycopg2.extras.DictCursor)
+        self._born[conn] = time.monotonic()
+        return conn
+
+    def getconn(self):
+        if not self._slots.acquire(blocking=False):
+            POOL_WAITS.inc(pool=self.name)
+            started = time.monotonic()
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT_SECONDS):
+                POOL_TIMEOUTS.inc(pool=self.name)
+                raise PoolTimeoutError(f"DB接続プール（{self.name}）に空きがありません（最大{self.maxconn}接続）")
+            POOL_WAIT_MS.observe((time.monotonic() - started) * 1000, pool=self.name)
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+            POOL_IN_USE.set(self.in_use, pool=self.name)
+        return conn
+
+    def _checkout(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            return self._connect()
+        now = time.monotonic()
+        born = self._born.get(conn, now)
+        if conn.closed:
+            return self._replace(conn, 'closed')
+        if now - born > DB_CONN_MAX_LIFETIME_SECONDS:
+            return self._replace(conn, 'max_lifetime')
+        if now - self._last_used.get(conn, born) > DB_CONN_VALIDATE_IDLE_SECONDS:
+            try:
+                with conn.cursor() as c:
+                    c.execute('SELECT 1')
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"アイドル接続の疎通確認に失敗したため作り直します: {e}")
+                return self._replace(conn, 'validation_failed')
+        return conn
+
+    def _replace(self, conn, reason):
+        POOL_RECYCLED.inc(reason=reason, pool=self.name)
+        self._discard(conn)
+        return self._checkout()
+
+    def _discard(self, conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+        if self.on_discard:
+            self.on_discard(conn)
+
+    def putconn(self, conn, close=False):
+        try:
+            if close or self._closed or conn.closed:
+                self._discard(conn)
+                return
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # commit / rollbackされずに返却された接続はトランザクションを終わらせてから保持する
+                conn.rollback()
+            self._last_used[conn] = time.monotonic()
+            with self._lock:
+                self._idle.append(conn)
+        except Exception as e:
+            logger.warning(f"返却された接続を再利用できないため閉じます: {e}")
+            self._discard(conn)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+                POOL_IN_USE.set(self.in_use, pool=self.name)
+            self._slots.release()
+
+    def idle_count(self):
+        with self._lock:
+            return len(self._idle)
+
+    def stats(self):
+        """使用中の接続数と飽和率を返す"""
+        return {
+            'in_use': self.in_use,
+            'idle': self.idle_count(),
+            'max': self.maxconn,
+            'saturation': round(self.in_use / self.maxconn, 2) if self.maxconn else None
+        }
+
+    def closeall(self):
+        """アイドル接続を閉じる（使用中の接続は返却時に閉じる）"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+# リクエスト（コンテキスト）ごとのDB操作の集計（start_request_statsで開始する）
+_request_stats = contextvars.ContextVar('db_request_stats', default=None)
+
+
+def start_request_stats():
+    """このコンテキストでのDB操作の集計を開始し、集計用のdictを返す（Webhookなどのリクエスト開始時に呼ぶ）"""
+    stats = {'operations': 0, 'queries': 0, 'db_ms': 0.0}
+    _request_stats.set(stats)
+    return stats
+
+
+def _operation_name(operation):
+    """operationを定義したメソッド名（DBHelper.user_exists.<locals>.operation -> user_exists）"""
+    qualname = getattr(operation, '__qualname__', type(operation).__name__)
+    return qualname.split('.<locals>')[0].rsplit('.', 1)[-1]
+
+
+def _param_shape(value):
+    if value is None or isinstance(value, (int, float, bool)):
+        return type(value).__name__
+    if isinstance(value, (str, bytes, bytearray, memoryview, list, tuple)):
+        return f'{type(value).__name__}({len(value)})'
+    return type(value).__name__
+
+
+def param_shapes(params):
+    """ログ用にパラメーターの型と長さだけを返す（トークンなどの値は出さない）"""
+    if isinstance(params, list) and params and isinstance(params[0], (list, tuple)):
+        # 一括INSERTの行
+        return f'{len(params)} rows x ({", ".join(_param_shape(v) for v in params[0])})'
+    return '(' + ', '.join(_param_shape(v) for v in params or ()) + ')'
+
+
+def connect_sqlite(db_path, readonly=False):
+    """本番用の設定でSQLiteに接続する（トランザクションは呼び出し側で明示的に開始する）"""
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    if readonly:
+        conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+class SQLiteWriter:
+    """SQLiteへの書き込みを1つのスレッドに集めて実行する
+
+    - 書き込み操作はキューに入れ、専用スレッドが1つの接続で順に実行する
+    - キューに溜まった操作はまとめて1回のCOMMITで確定する
+      （操作ごとにSAVEPOINTで区切り、例外になった操作だけ取り消す）
+    - 呼び出し元にはCOMMIT後に結果を返す
+    """
+
+    def __init__(self, db_path, batch_size=SQLITE_WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._conn = connect_sqlite(db_path)
+        # WALはDBファイルに記録され、以降の接続（読み取り用も含む）にも適用される
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, operation):
+        """書き込み操作（カーソルを受け取る関数）を実行し、COMMIT後にその戻り値を返す"""
+        if threading.current_thread() is self._thread:
+            # 書き込み操作の中からの呼び出しは同じトランザクション内でそのまま実行する
+            return operation(self._conn.cursor())
+        future = Future()
+        # 書き込みスレッドでも呼び出し元のコンテキスト（リクエストごとの集計など）で実行する
+        context = contextvars.copy_context()
+        self._queue.put((lambda c: context.run(operation, c), future))
+        SQLITE_WRITE_QUEUE.set(self._queue.qsize())
+        return future.result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            SQLITE_WRITE_QUEUE.set(self._queue.qsize())
+            self._execute_batch(batch)
+
+    def _execute_batch(self, batch):
+        SQLITE_WRITE_BATCH.observe(len(batch))
+        c = self._conn.cursor()
+        results = []
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            for operation, future in batch:
+                c.execute('SAVEPOINT write_op')
+                try:
+                    result = operation(c)
+                except Exception as e:
+                    c.execute('ROLLBACK TO write_op')
+                    c.execute('RELEASE write_op')
+                    results.append((future, None, e))
+                else:
+                    c.execute('RELEASE write_op')
+                    results.append((future, result, None))
+            c.execute('COMMIT')
+        except Exception as e:
+            # BEGIN / SAVEPOINT / COMMIT自体の失敗はバッチ全体を失敗にする
+            logger.error(f"SQLiteの書き込みバッチに失敗しました（{len(batch)}件）: {e}")
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            c.close()
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._conn.close()
+
+
 class DBHelper:
-    def __init__(self, db_path=DB_PATH):
+    def __init__(self, db_path=DB_PATH, init_schema=None):
         db_url = os.getenv('DATABASE_URL')
+        replica_url = os.getenv('DATABASE_REPLICA_URL')
         self.is_postgres = False
+        self.replica_pool = None
         self.db_url = db_url
         self.db_path = db_path
         
         if db_url and psycopg2 is not None:
             self.is_postgres = True
-            # 接続プールを作成
-            self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=db_url,
-                cursor_factory=psycopg2.extras.DictCursor
-            )
-            self.conn = self._get_connection()
+            # 接続プールを作成（各操作ごとにチェックアウトして返却する）
+            self.pool = PostgresPool(db_url)
+            if replica_url:
+                # 遅延を許容する読み取りはレプリカで行う
+                self.replica_pool = PostgresPool(replica_url, name='replica')
         else:
-            self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        
-        self._init_tables()
+            # SQLiteはWALで、読み取りはスレッドごとの接続、書き込みは専用スレッドにまとめて実行する
+            self._writer = SQLiteWriter(db_path)
+            self._readers = threading.local()
+            self._reader_conns = []
+            self._readers_lock = threading.Lock()
 
-    def _get_connection(self):
-        """データベース接続を取得（再接続機能付き）"""
-        if not self.is_postgres:
-            return self.conn
+        # SQL文（queries.py）を方言に合わせて実行する
+        self._statements = StatementRunner(self.is_postgres, use_prepared=DB_PREPARED_STATEMENTS,
+                                           on_execute=self._on_statement)
+        if self.is_postgres:
+            # PREPAREは接続ごとに有効なため、閉じた接続の記録を捨てる
+            self.pool.on_discard = self._statements.forget_connection
+            if self.replica_pool:
+                self.replica_pool.on_discard = self._statements.forget_connection
+
+        # ユーザーごとの最後の書き込み時刻（read-your-writes用）
+        self._recent_writes = {}  # line_user_id -> time.monotonic()
+        self._recent_writes_lock = threading.Lock()
         
+        # ユーザーごとの読み取りキャッシュ（他プロセスでの更新は cache_invalidations で通知される）
+        self._caches = {
+            'auth': TTLCache('auth', AUTH_CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES),
+            'pending': TTLCache('pending', PENDING_CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES),
+        }
+        self._invalidation_lock = threading.Lock()
+        self._invalidation_polled_at = 0.0
+        self._invalidation_since = None  # DB側の時刻（前回確認時）
+        self._seen_invalidations = {}  # id -> DB側の時刻
+        
+        # PostgreSQLのスキーマはデプロイ時に `python db.py init` で作成する
+        # （ローカル開発用のSQLiteは起動時に自動で作成する）
+        if init_schema is None:
+            init_schema = not self.is_postgres
+        if init_schema:
+            self._init_tables()
+
+    @contextmanager
+    def _connection(self, pool=None):
+        """1操作分の接続をプールから取り出し、終了後に返却する（PostgreSQL）"""
+        pool = pool or self.pool
+        conn = pool.getconn()
+        broken = False
         try:
-            # 接続プールから接続を取得
-            conn = self.connection_pool.getconn()
-            # 接続が有効かテスト
-            conn.cursor().execute('SELECT 1')
-            return conn
-        except Exception as e:
-            logger.warning(f"データベース接続エラー: {e}")
-            # 接続プールを再作成
+            yield conn
+        except RETRYABLE_DB_ERRORS as e:
+            # 接続自体が壊れている可能性があるためプールに戻さず閉じる
+            # （プリペアドステートメントの破棄はOperationalErrorだが接続は正常なため、ロールバックして戻す）
+            if not is_missing_prepared(e):
+                broken = True
+                DB_RECONNECTS.inc(pool=pool.name)
+            raise
+        finally:
+            pool.putconn(conn, close=broken)
+
+    @contextmanager
+    def _cursor(self, pool=None):
+        """1操作分のカーソルを返す（正常終了でcommit、例外でrollback）"""
+        with self._connection(pool) as conn:
+            c = conn.cursor()
             try:
-                self.connection_pool.closeall()
-            except:
-                pass
-            self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=self.db_url,
-                cursor_factory=psycopg2.extras.DictCursor
-            )
-            return self.connection_pool.getconn()
+                yield c
+                conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                c.close()
 
-    def _execute_with_retry(self, operation):
-        """データベース操作をリトライ機能付きで実行"""
+    def _reader_connection(self):
+        """このスレッドのSQLite読み取り用接続（初回に作成する）"""
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = self._readers.conn = connect_sqlite(self.db_path, readonly=True)
+            with self._readers_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _execute_sqlite(self, operation, readonly):
+        if not readonly:
+            return self._writer.submit(operation)
+        # 読み取りは1つのスナップショットで行う（WALのため書き込み中でも待たない）
+        conn = self._reader_connection()
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN')
+            try:
+                return operation(c)
+            finally:
+                conn.rollback()
+        finally:
+            c.close()
+
+    def note_user_write(self, line_user_id):
+        """ユーザーの書き込みを記録し、REPLICA_READ_YOUR_WRITES_SECONDSの間はそのユーザーの読み取りをプライマリで行う"""
+        if self.replica_pool is None:
+            return
+        now = time.monotonic()
+        with self._recent_writes_lock:
+            self._recent_writes[line_user_id] = now
+            if len(self._recent_writes) > CACHE_MAX_ENTRIES:
+                self._recent_writes = {
+                    user_id: written_at for user_id, written_at in self._recent_writes.items()
+                    if now - written_at < REPLICA_READ_YOUR_WRITES_SECONDS
+                }
+
+    def _read_pool(self, user_ids):
+        """レプリカ対象の読み取りに使うプールを返す（user_idsの誰かが最近書き込んでいればプライマリ）"""
+        if self.replica_pool is None:
+            return self.pool
+        now = time.monotonic()
+        for user_id in user_ids or ():
+            written_at = self._recent_writes.get(user_id)
+            if written_at is not None and now - written_at < REPLICA_READ_YOUR_WRITES_SECONDS:
+                REPLICA_READS.inc(target='primary')
+                return self.pool
+        REPLICA_READS.inc(target='replica')
+        return self.replica_pool
+
+    def _execute_with_retry(self, operation, readonly=False, replica=False, user_ids=None):
+        """データベース操作をリトライ機能付きで実行（operationはカーソルを受け取る）
+
+        readonly=Trueは書き込みを行わない操作（SQLiteでは読み取り用接続で実行する）。
+        replica=Trueは数秒の遅延を許容する読み取りで、DATABASE_REPLICA_URL設定時はレプリカで実行する
+        （user_idsのユーザーが直近に書き込んでいた場合はプライマリで実行する）。
+        操作ごとの実行時間はoperationを定義したメソッド名で記録する。
+        """
+        name = _operation_name(operation)
+        started = time.perf_counter()
+        try:
+            with span('db', name):
+                if not self.is_postgres:
+                    return self._execute_sqlite(operation, readonly)
+                return self._execute_postgres(name, operation, readonly, replica, user_ids)
+        except Exception as e:
+            DB_OPERATION_ERRORS.inc(operation=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            DB_OPERATION_MS.observe(elapsed_ms, operation=name)
+            stats = _request_stats.get()
+            if stats is not None:
+                stats['operations'] += 1
+                stats['db_ms'] += elapsed_ms
+
+    def _execute_postgres(self, name, operation, readonly, replica, user_ids):
+        pool = self._read_pool(user_ids) if readonly and replica else self.pool
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                return operation()
-            except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
-                if "connection already closed" in str(e) or "connection" in str(e).lower():
-                    logger.warning(f"データベース接続エラー (試行 {attempt + 1}/{max_retries}): {e}")
-                    if attempt < max_retries - 1:
-                        # 接続を再取得
-                        if self.is_postgres:
-                            try:
-                                self.connection_pool.putconn(self.conn)
-                            except:
-                                pass
-                            self.conn = self._get_connection()
-                        import time
-                        time.sleep(1)
-                        continue
-                raise e
-        return operation()
+                with self._cursor(pool) as c:
+                    return operation(c)
+            except RETRYABLE_DB_ERRORS + (PoolTimeoutError,) as e:
+                if is_missing_prepared(e):
+                    if attempt > 0:
+                        raise
+                    # トランザクションの途中でプリペアドステートメントが破棄されていた場合は操作ごと1回やり直す
+                    # （この接続のPREPAREの記録は捨て済みのため、次の試行でPREPAREし直す）
+                    logger.warning(f"プリペアドステートメントが破棄されていたため再実行します ({name}): {e}")
+                    DB_RETRIES.inc(operation=name)
+                    continue
+                if pool is not self.pool:
+                    # レプリカに接続できない場合はプライマリで読む
+                    logger.warning(f"読み取りレプリカでエラーのためプライマリで実行します: {e}")
+                    REPLICA_FALLBACKS.inc()
+                    current_span().set('replica_fallback', True)
+                    pool = self.pool
+                    continue
+                if isinstance(e, PoolTimeoutError):
+                    raise
+                message = str(e).lower()
+                if attempt < max_retries - 1 and ("connection" in message or "ssl" in message):
+                    logger.warning(f"データベース接続エラー ({name} 試行 {attempt + 1}/{max_retries}): {e}")
+                    DB_RETRIES.inc(operation=name)
+                    current_span().set('retries', attempt + 1)
+                    # 壊れた接続は返却時に破棄されているため、次の試行は別の接続で行う
+                    time.sleep(0.5 * (attempt + 1))
+                    continue
+                raise
+
+    def _on_statement(self, stmt, params, elapsed_ms):
+        """SQL文の実行ごとに呼ばれる（リクエストごとのクエリ数・遅いクエリのログ）"""
+        stats = _request_stats.get()
+        if stats is not None:
+            stats['queries'] += 1
+        if elapsed_ms >= DB_SLOW_QUERY_MS:
+            DB_SLOW_QUERIES.inc(statement=stmt.name)
+            logger.warning(f"遅いクエリ: {stmt.name} {elapsed_ms:.1f}ms params={param_shapes(params)}")
+
+    def _run(self, c, stmt, params=()):
+        """queries.pyの文を実行してカーソルを返す"""
+        return self._statements.execute(c, stmt, params)
+
+    def _run_bulk(self, c, stmt, rows):
+        """queries.pyの一括INSERT文をrowsの全行分実行する"""
+        return self._statements.execute_bulk(c, stmt, rows)
+
+    def _binary(self, data):
+        return PG_BINARY(data) if self.is_postgres else data
+
+    def statement_stats(self):
+        """このプロセスで実行したSQL文ごとの実行回数・時間を返す"""
+        return statement_stats(q.all_statements())
+
+    def _ts(self, dt):
+        """日時をカラムの型に合わせて変換（PostgreSQL: timestamptz / SQLite: エポック秒）"""
+        return dt if self.is_postgres else int(dt.timestamp())
+
+    def _from_ts(self, value):
+        """カラムの値をUTCのdatetimeに変換"""
+        if value is None or self.is_postgres:
+            return value
+        return datetime.fromtimestamp(value, timezone.utc)
+
+    # --- cache ---
+    def _cached(self, cache_name, key, loader):
+        """キャッシュから読み、なければloader()でDBから読んで保存する"""
+        cache = self._caches[cache_name]
+        if not cache.enabled:
+            return loader()
+        self._poll_cache_invalidations()
+        return cache.get_or_load(key, loader)
+
+    def _log_cache_invalidation(self, c, cache_name, key):
+        """他プロセスのキャッシュを無効化するため変更ログに記録（書き込みと同じトランザクションで実行）"""
+        self._run(c, q.INSERT_CACHE_INVALIDATION, (cache_name, key))
+
+    def _poll_cache_invalidations(self):
+        """CACHE_INVALIDATION_POLL_SECONDSごとに変更ログを読み、他プロセスで更新されたキーを無効化する"""
+        if time.monotonic() - self._invalidation_polled_at < CACHE_INVALIDATION_POLL_SECONDS:
+            return
+        # 他のスレッドが確認中なら待たずに進む
+        if not self._invalidation_lock.acquire(blocking=False):
+            return
+        try:
+            self._invalidation_polled_at = time.monotonic()
+            since = self._invalidation_since
+            def operation(c):
+                db_now = self._run(c, q.SELECT_DB_NOW).fetchone()[0]
+                if since is None:
+                    return db_now, []
+                overlap = CACHE_INVALIDATION_OVERLAP_SECONDS
+                if self.is_postgres:
+                    overlap = timedelta(seconds=overlap)
+                return db_now, self._run(c, q.SELECT_CACHE_INVALIDATIONS, (since - overlap,)).fetchall()
+
+            try:
+                db_now, rows = self._execute_with_retry(operation, readonly=True)
+            except Exception as e:
+                # 変更を取りこぼした可能性があるため全て捨てる
+                logger.warning(f"キャッシュ無効化ログの取得に失敗したためキャッシュをクリアします: {e}")
+                for cache in self._caches.values():
+                    cache.clear()
+                return
+            for invalidation_id, cache_name, key in rows:
+                if invalidation_id in self._seen_invalidations:
+                    continue
+                self._seen_invalidations[invalidation_id] = db_now
+                cache = self._caches.get(cache_name)
+                if cache:
+                    cache.invalidate(key)
+                self.note_user_write(key)
+            self._invalidation_since = db_now
+            # 遡り範囲を過ぎたIDは再び読まれないため忘れる
+            self._seen_invalidations = {
+                invalidation_id: seen_at for invalidation_id, seen_at in self._seen_invalidations.items()
+                if self._ts_diff_seconds(db_now, seen_at) <= CACHE_INVALIDATION_OVERLAP_SECONDS * 2
+            }
+        finally:
+            self._invalidation_lock.release()
+
+    def _ts_diff_seconds(self, later, earlier):
+        if self.is_postgres:
+            return (later - earlier).total_seconds()
+        return later - earlier
+
+    def invalidate_user_cache(self, line_user_id):
+        """このプロセスのユーザーごとのキャッシュを捨てる"""
+        for cache in self._caches.values():
+            cache.invalidate(line_user_id)
+
+    def init_schema(self):
+        """テーブルとインデックスを作成する（何度実行してもよい）"""
+        self._init_tables()
+
+    def pool_stats(self):
+        """接続プールの使用状況を返す（SQLiteの場合はNone、レプリカ設定時は replica にレプリカの状況を含める）"""
+        if not self.is_postgres:
+            return None
+        stats = self.pool.stats()
+        if self.replica_pool:
+            stats['replica'] = self.replica_pool.stats()
+        return stats
 
     def _init_tables(self):
-        def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                # PostgreSQL: SERIAL型やIF NOT EXISTSの書き方に注意
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        line_user_id TEXT PRIMARY KEY,
-                        google_token BYTEA,
-                        created_at TEXT,
-                        updated_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS onetimes (
-                        code TEXT PRIMARY KEY,
-                        line_user_id TEXT,
-                        expires_at TEXT,
-                        used INTEGER DEFAULT 0,
-                        created_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS pending_events (
-                        line_user_id TEXT PRIMARY KEY,
-                        event_json TEXT,
-                        created_at TEXT
-                    )
-                ''')
-            else:
-                # SQLite
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        line_user_id TEXT PRIMARY KEY,
-                        google_token BLOB,
-                        created_at TEXT,
-                        updated_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS onetimes (
-                        code TEXT PRIMARY KEY,
-                        line_user_id TEXT,
-                        expires_at TEXT,
-                        used INTEGER DEFAULT 0,
-                        created_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS pending_events (
-                        line_user_id TEXT PRIMARY KEY,
-                        event_json TEXT,
-                        created_at TEXT
-                    )
-                ''')
-            self.conn.commit()
-        
-        self._execute_with_retry(operation)
+        """未適用のマイグレーションを適用してスキーマを最新にする"""
+        migrations.migrate(self)
 
     # --- users ---
     def save_google_token(self, line_user_id, google_token_bytes):
-        now = datetime.utcnow().isoformat()
-        print(f"[DEBUG] save_google_token: line_user_id={line_user_id}, token_length={len(google_token_bytes) if google_token_bytes else 0}, time={now}")
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO users (line_user_id, google_token, created_at, updated_at)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (line_user_id) DO UPDATE SET google_token=EXCLUDED.google_token, updated_at=EXCLUDED.updated_at
-            ''', (line_user_id, PG_BINARY(google_token_bytes), now, now))
-        else:
-            c.execute('''
-                INSERT INTO users (line_user_id, google_token, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(line_user_id) DO UPDATE SET google_token=excluded.google_token, updated_at=excluded.updated_at
-            ''', (line_user_id, google_token_bytes, now, now))
-        self.conn.commit()
+        now = self._ts(datetime.now(timezone.utc))
+        logger.debug("save_google_token: line_user_id=%s, token_length=%d", line_user_id, len(google_token_bytes) if google_token_bytes else 0)
+        def operation(c):
+            self._run(c, q.UPSERT_GOOGLE_TOKEN, (line_user_id, self._binary(google_token_bytes), now, now))
+            self._log_cache_invalidation(c, 'auth', line_user_id)
+
+        self._execute_with_retry(operation)
+        self._caches['auth'].invalidate(line_user_id)
+        self.note_user_write(line_user_id)
 
     def save_google_token_json(self, line_user_id, json_str):
         """JSON形式でGoogle認証情報を保存（推奨）"""
-        now = datetime.utcnow().isoformat()
-        print(f"[DEBUG] save_google_token_json: line_user_id={line_user_id}, json_length={len(json_str) if json_str else 0}, time={now}")
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO users (line_user_id, google_token, created_at, updated_at)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (line_user_id) DO UPDATE SET google_token=EXCLUDED.google_token, updated_at=EXCLUDED.updated_at
-            ''', (line_user_id, PG_BINARY(json_str.encode('utf-8')), now, now))
-        else:
-            c.execute('''
-                INSERT INTO users (line_user_id, google_token, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(line_user_id) DO UPDATE SET google_token=excluded.google_token, updated_at=excluded.updated_at
-            ''', (line_user_id, json_str.encode('utf-8'), now, now))
-        self.conn.commit()
+        now = self._ts(datetime.now(timezone.utc))
+        logger.debug("save_google_token_json: line_user_id=%s, json_length=%d", line_user_id, len(json_str) if json_str else 0)
+        def operation(c):
+            self._run(c, q.UPSERT_GOOGLE_TOKEN, (line_user_id, self._binary(json_str.encode('utf-8')), now, now))
+            self._log_cache_invalidation(c, 'auth', line_user_id)
+
+        self._execute_with_retry(operation)
+        self._caches['auth'].invalidate(line_user_id)
+        self.note_user_write(line_user_id)
 
     def get_google_token(self, line_user_id):
-        def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT google_token FROM users WHERE line_user_id=%s', (line_user_id,))
-            else:
-                c.execute('SELECT google_token FROM users WHERE line_user_id=?', (line_user_id,))
-            row = c.fetchone()
-            print(f"[DEBUG] get_google_token: line_user_id={line_user_id}, token_found={row is not None}, token_length={len(row[0]) if row and row[0] else 0}")
+        def operation(c):
+            row = self._run(c, q.SELECT_GOOGLE_TOKEN, (line_user_id,)).fetchone()
             return row[0] if row else None
-        
-        return self._execute_with_retry(operation)
+
+        return self._execute_with_retry(operation, readonly=True, replica=True, user_ids=(line_user_id,))
+
+    def get_google_tokens(self, line_user_ids):
+        """複数ユーザーの認証トークンを1回のクエリで取得し {line_user_id: トークン} を返す（トークンがないユーザーは含まない）"""
+        line_user_ids = list(line_user_ids)
+        if not line_user_ids:
+            return {}
+        params = (line_user_ids,) if self.is_postgres else (json.dumps(line_user_ids),)
+        def operation(c):
+            return {row[0]: row[1] for row in self._run(c, q.SELECT_GOOGLE_TOKENS, params).fetchall() if row[1]}
+
+        return self._execute_with_retry(operation, readonly=True, replica=True, user_ids=line_user_ids)
+
+    def iter_google_tokens(self, batch_size=500):
+        """認証済みユーザーの (line_user_id, トークン) をline_user_id順のキーセットページングでバッチごとに返すジェネレーター
+
+        トークンはget_google_tokenと同じ形式（JSON形式または古いpickle形式のバイト列）で返す。
+        """
+        last_user_id = ''
+        while True:
+            def operation(c):
+                return self._run(c, q.SELECT_GOOGLE_TOKEN_PAGE, (last_user_id, batch_size)).fetchall()
+
+            rows = self._execute_with_retry(operation, readonly=True, replica=True)
+            if not rows:
+                return
+            yield [(row[0], row[1]) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_user_id = rows[-1][0]
 
     def get_google_token_json(self, line_user_id):
         """JSON形式でGoogle認証情報を取得"""
-        def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT google_token FROM users WHERE line_user_id=%s', (line_user_id,))
-            else:
-                c.execute('SELECT google_token FROM users WHERE line_user_id=?', (line_user_id,))
-            row = c.fetchone()
+        def operation(c):
+            row = self._run(c, q.SELECT_GOOGLE_TOKEN, (line_user_id,)).fetchone()
             if row and row[0]:
                 try:
                     # バイト列を文字列に変換
@@ -231,252 +749,465 @@ class DBHelper:
                     # 古いpickle形式や無効なJSONの場合はNoneを返す
                     return None
             return None
-        
-        return self._execute_with_retry(operation)
+
+        return self._execute_with_retry(operation, readonly=True, replica=True, user_ids=(line_user_id,))
 
     # --- onetimes ---
     def create_onetime_code(self, line_user_id, code, expires_minutes=10):
-        now = datetime.utcnow()
-        expires_at = (now + timedelta(minutes=expires_minutes)).isoformat()
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
-                VALUES (%s, %s, %s, 0, %s)
-            ''', (code, line_user_id, expires_at, now.isoformat()))
-        else:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
-                VALUES (?, ?, ?, 0, ?)
-            ''', (code, line_user_id, expires_at, now.isoformat()))
-        self.conn.commit()
+        now = datetime.now(timezone.utc)
+        expires_at = self._ts(now + timedelta(minutes=expires_minutes))
+        def operation(c):
+            self._run(c, q.INSERT_ONETIME, (code, line_user_id, expires_at, self._ts(now)))
+
+        self._execute_with_retry(operation)
 
     def get_onetime_code(self, code):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('SELECT code, line_user_id, expires_at, used FROM onetimes WHERE code=%s', (code,))
-        else:
-            c.execute('SELECT code, line_user_id, expires_at, used FROM onetimes WHERE code=?', (code,))
-        row = c.fetchone()
-        if row:
-            return {
-                'code': row[0],
-                'line_user_id': row[1],
-                'expires_at': row[2],
-                'used': bool(row[3])
-            }
-        return None
+        def operation(c):
+            row = self._run(c, q.SELECT_ONETIME, (code,)).fetchone()
+            if row:
+                return {
+                    'code': row[0],
+                    'line_user_id': row[1],
+                    'expires_at': self._from_ts(row[2]),
+                    'used': bool(row[3])
+                }
+            return None
+
+        return self._execute_with_retry(operation, readonly=True)
 
     def mark_onetime_code_used(self, code):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('UPDATE onetimes SET used=1 WHERE code=%s', (code,))
-        else:
-            c.execute('UPDATE onetimes SET used=1 WHERE code=?', (code,))
-        self.conn.commit()
+        def operation(c):
+            self._run(c, q.MARK_ONETIME_USED, (code,))
+
+        self._execute_with_retry(operation)
 
     def generate_onetime_code(self, line_user_id, expires_minutes=10):
         """ワンタイムコードを生成してDBに保存"""
         # 8文字のランダムコードを生成
         code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
-        expires_at = (datetime.now() + timedelta(minutes=expires_minutes)).isoformat()
-        created_at = datetime.now().isoformat()
-        
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, created_at)
-                VALUES (%s, %s, %s, %s)
-            ''', (code, line_user_id, expires_at, created_at))
-        else:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, created_at)
-                VALUES (?, ?, ?, ?)
-            ''', (code, line_user_id, expires_at, created_at))
-        self.conn.commit()
-        
+        self.create_onetime_code(line_user_id, code, expires_minutes)
         return code
 
+    def get_valid_onetime_code(self, line_user_id):
+        """ユーザーの未使用かつ有効期限内のワンタイムコードがあれば返す（なければNone）"""
+        now = self._ts(datetime.now(timezone.utc))
+        def operation(c):
+            row = self._run(c, q.SELECT_VALID_ONETIME, (line_user_id, now)).fetchone()
+            return row[0] if row else None
+
+        return self._execute_with_retry(operation, readonly=True)
+
     def verify_onetime_code(self, code):
         """ワンタイムコードを検証（有効期限・使用済みチェック）"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                SELECT line_user_id, expires_at, used 
-                FROM onetimes 
-                WHERE code = %s
-            ''', (code,))
-        else:
-            c.execute('''
-                SELECT line_user_id, expires_at, used 
-                FROM onetimes 
-                WHERE code = ?
-            ''', (code,))
-        result = c.fetchone()
-        
-        if not result:
+        onetime = self.get_onetime_code(code)
+        if not onetime:
             return None  # コードが存在しない
-        
-        line_user_id, expires_at, used = result
-        
-        if used:
+        if onetime['used']:
             return None  # 既に使用済み
-        
         # 有効期限チェック
-        expires_datetime = datetime.fromisoformat(expires_at)
-        if datetime.now() > expires_datetime:
+        expires_datetime = onetime['expires_at']
+        if expires_datetime is None or datetime.now(timezone.utc) > expires_datetime:
             return None  # 期限切れ
-        
-        return line_user_id
+        return onetime['line_user_id']
 
     def mark_onetime_used(self, code):
         """ワンタイムコードを使用済みにマーク"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('UPDATE onetimes SET used = 1 WHERE code = %s', (code,))
-        else:
-            c.execute('UPDATE onetimes SET used = 1 WHERE code = ?', (code,))
-        self.conn.commit()
+        self.mark_onetime_code_used(code)
 
     def mark_onetime_used_by_state(self, state):
         """stateからワンタイムコードを使用済みにマーク（統一API）"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                UPDATE onetimes SET used = 1 
-                WHERE code IN (
-                    SELECT code FROM onetimes o 
-                    JOIN oauth_states os ON o.line_user_id = os.line_user_id 
-                    WHERE os.state = %s
-                )
-            ''', (state,))
-        else:
-            c.execute('''
-                UPDATE onetimes SET used = 1 
-                WHERE code IN (
-                    SELECT o.code FROM onetimes o 
-                    JOIN oauth_states os ON o.line_user_id = os.line_user_id 
-                    WHERE os.state = ?
-                )
-            ''', (state,))
-        self.conn.commit()
-
-    def cleanup_expired_onetimes(self):
-        """期限切れのワンタイムコードを削除"""
-        c = self.conn.cursor()
-        now = datetime.now().isoformat()
-        if self.is_postgres:
-            c.execute('DELETE FROM onetimes WHERE expires_at < %s', (now,))
-        else:
-            c.execute('DELETE FROM onetimes WHERE expires_at < ?', (now,))
-        self.conn.commit()
+        def operation(c):
+            self._run(c, q.MARK_ONETIME_USED_BY_STATE, (state,))
+
+        self._execute_with_retry(operation)
+
+    def cleanup_expired_onetimes(self, batch_size=500):
+        """期限切れのワンタイムコードをバッチごとに削除し、削除件数を返す"""
+        now = datetime.now(timezone.utc)
+        total = 0
+        while True:
+            deleted = self.purge_expired_rows('onetimes', now, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    # 期限切れ行を削除するテーブル
+    TTL_TABLES = tuple(q.PURGE_EXPIRED)
+
+    def purge_expired_rows(self, table, cutoff, batch_size=500, statement_timeout_ms=None):
+        """日時列がcutoffより前の行を最大batch_size件削除し、削除件数を返す
+
+        1バッチを1トランザクションで削除し、ロックを長時間保持しないようにする。
+        PostgreSQLではstatement_timeout_msで1バッチの実行時間に上限を設ける。
+        """
+        stmt = q.PURGE_EXPIRED[table]
+        cutoff = self._ts(cutoff)
+        def operation(c):
+            if self.is_postgres and statement_timeout_ms:
+                c.execute('SET LOCAL statement_timeout = %s', (int(statement_timeout_ms),))
+            return self._run(c, stmt, (cutoff, batch_size)).rowcount
 
-    def user_exists(self, line_user_id):
-        """ユーザーが認証済みかどうかを判定"""
-        def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT 1 FROM users WHERE line_user_id = %s', (line_user_id,))
-            else:
-                c.execute('SELECT 1 FROM users WHERE line_user_id = ?', (line_user_id,))
-            return c.fetchone() is not None
-        
         return self._execute_with_retry(operation)
 
+    def user_exists(self, line_user_id):
+        """ユーザーが認証済みかどうかを判定（AUTH_CACHE_TTL_SECONDSの間キャッシュする）"""
+        def operation(c):
+            return self._run(c, q.USER_EXISTS, (line_user_id,)).fetchone() is not None
+
+        return self._cached('auth', line_user_id, lambda: self._execute_with_retry(operation, readonly=True, replica=True, user_ids=(line_user_id,)))
+
     def get_all_user_ids(self):
         """認証済みユーザーのLINEユーザーID一覧を返す（google_tokenがNULLや空でないユーザーのみ）"""
-        def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT line_user_id FROM users WHERE google_token IS NOT NULL AND octet_length(google_token) > 0')
-            else:
-                c.execute('SELECT line_user_id FROM users WHERE google_token IS NOT NULL AND length(google_token) > 0')
-            rows = c.fetchall()
-            return [row[0] for row in rows]
-        
-        return self._execute_with_retry(operation)
+        def operation(c):
+            return [row[0] for row in self._run(c, q.SELECT_AUTHENTICATED_USER_IDS).fetchall()]
+
+        return self._execute_with_retry(operation, readonly=True, replica=True)
+
+    def count_users(self, authenticated_only=True):
+        """ユーザー数を返す（authenticated_only=Trueならgoogle_tokenを持つユーザーのみ）"""
+        stmt = q.COUNT_AUTHENTICATED_USERS if authenticated_only else q.COUNT_USERS
+        def operation(c):
+            return self._run(c, stmt).fetchone()[0]
+
+        return self._execute_with_retry(operation, readonly=True, replica=True)
+
+    def iter_user_batches(self, batch_size=500, authenticated_only=True):
+        """usersテーブルをline_user_id順のキーセットページングでバッチごとに返すジェネレーター
+
+        各バッチは短いクエリで取得するため、呼び出し側がバッチ処理中に
+        同じ接続で書き込み・コミットしてもカーソルが無効にならない。
+        created_at / updated_at はUTCのdatetime。
+        """
+        stmt = q.SELECT_AUTHENTICATED_USER_PAGE if authenticated_only else q.SELECT_USER_PAGE
+        last_user_id = ''
+        while True:
+            def operation(c):
+                return self._run(c, stmt, (last_user_id, batch_size)).fetchall()
+
+            rows = self._execute_with_retry(operation, readonly=True, replica=True)
+            if not rows:
+                return
+            yield [
+                {
+                    'line_user_id': row[0],
+                    'token_length': row[1] or 0,
+                    'created_at': self._from_ts(row[2]),
+                    'updated_at': self._from_ts(row[3])
+                }
+                for row in rows
+            ]
+            if len(rows) < batch_size:
+                return
+            last_user_id = rows[-1][0]
+
+    def iter_user_ids(self, batch_size=500, authenticated_only=True):
+        """iter_user_batchesをLINEユーザーID単位で返すジェネレーター"""
+        for batch in self.iter_user_batches(batch_size, authenticated_only):
+            for user in batch:
+                yield user['line_user_id']
 
     def close(self):
         if self.is_postgres:
             try:
-                self.connection_pool.putconn(self.conn)
-                self.connection_pool.closeall()
+                self.pool.closeall()
+                if self.replica_pool:
+                    self.replica_pool.closeall()
             except:
                 pass
         else:
-            self.conn.close()
+            self._writer.close()
+            with self._readers_lock:
+                for conn in self._reader_conns:
+                    conn.close()
+                self._reader_conns = []
 
     def save_oauth_state(self, state, line_user_id):
         """OAuth stateとLINEユーザーIDを紐付けて保存"""
-        c = self.conn.cursor()
-        now = datetime.now().isoformat()
-        if self.is_postgres:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS oauth_states (
-                    state TEXT PRIMARY KEY,
-                    line_user_id TEXT,
-                    created_at TEXT
-                )
-            ''')
-            c.execute('''
-                INSERT INTO oauth_states (state, line_user_id, created_at)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (state) DO UPDATE SET line_user_id=EXCLUDED.line_user_id, created_at=EXCLUDED.created_at
-            ''', (state, line_user_id, now))
-        else:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS oauth_states (
-                    state TEXT PRIMARY KEY,
-                    line_user_id TEXT,
-                    created_at TEXT
-                )
-            ''')
-            c.execute('''
-                INSERT OR REPLACE INTO oauth_states (state, line_user_id, created_at)
-                VALUES (?, ?, ?)
-            ''', (state, line_user_id, now))
-        self.conn.commit()
+        now = self._ts(datetime.now(timezone.utc))
+        def operation(c):
+            self._run(c, q.UPSERT_OAUTH_STATE, (state, line_user_id, now))
+
+        self._execute_with_retry(operation)
 
     def get_line_user_id_by_state(self, state):
         """stateからLINEユーザーIDを取得"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('SELECT line_user_id FROM oauth_states WHERE state = %s', (state,))
-        else:
-            c.execute('SELECT line_user_id FROM oauth_states WHERE state = ?', (state,))
-        result = c.fetchone()
-        return result[0] if result else None
+        def operation(c):
+            result = self._run(c, q.SELECT_LINE_USER_ID_BY_STATE, (state,)).fetchone()
+            return result[0] if result else None
+
+        return self._execute_with_retry(operation, readonly=True)
 
     def save_pending_event(self, line_user_id, event_json):
-        now = datetime.utcnow().isoformat()
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO pending_events (line_user_id, event_json, created_at)
-                VALUES (%s, %s, %s)
-                ON CONFLICT(line_user_id) DO UPDATE SET event_json=EXCLUDED.event_json, created_at=EXCLUDED.created_at
-            ''', (line_user_id, event_json, now))
-        else:
-            c.execute('''
-                INSERT INTO pending_events (line_user_id, event_json, created_at)
-                VALUES (?, ?, ?)
-                ON CONFLICT(line_user_id) DO UPDATE SET event_json=excluded.event_json, created_at=excluded.created_at
-            ''', (line_user_id, event_json, now))
-        self.conn.commit()
+        now = self._ts(datetime.now(timezone.utc))
+        def operation(c):
+            self._run(c, q.UPSERT_PENDING_EVENT, (line_user_id, event_json, now))
+            self._log_cache_invalidation(c, 'pending', line_user_id)
+
+        self._execute_with_retry(operation)
+        self._caches['pending'].invalidate(line_user_id)
+        self.note_user_write(line_user_id)
 
     def get_pending_event(self, line_user_id):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('SELECT event_json FROM pending_events WHERE line_user_id=%s', (line_user_id,))
-        else:
-            c.execute('SELECT event_json FROM pending_events WHERE line_user_id=?', (line_user_id,))
-        row = c.fetchone()
-        return row[0] if row else None
+        """確認待ちの予定（JSON）を返す（PENDING_CACHE_TTL_SECONDSの間キャッシュする）"""
+        def operation(c):
+            row = self._run(c, q.SELECT_PENDING_EVENT, (line_user_id,)).fetchone()
+            return row[0] if row else None
+
+        return self._cached('pending', line_user_id, lambda: self._execute_with_retry(operation, readonly=True, replica=True, user_ids=(line_user_id,)))
 
     def delete_pending_event(self, line_user_id):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('DELETE FROM pending_events WHERE line_user_id=%s', (line_user_id,))
-        else:
-            c.execute('DELETE FROM pending_events WHERE line_user_id=?', (line_user_id,))
-        self.conn.commit()
\ No newline at end of file
+        def operation(c):
+            self._run(c, q.DELETE_PENDING_EVENT, (line_user_id,))
+            self._log_cache_invalidation(c, 'pending', line_user_id)
+
+        self._execute_with_retry(operation)
+        self._caches['pending'].invalidate(line_user_id)
+        self.note_user_write(line_user_id)
+
+    # --- postback_nonces ---
+    def consume_postback_nonce(self, nonce, line_user_id):
+        """確認ボタンのnonceを使用済みにする。初めて使われた場合だけTrueを返す（同時に押されても1回だけTrue）"""
+        now = self._ts(datetime.now(timezone.utc))
+        def operation(c):
+            return self._run(c, q.INSERT_POSTBACK_NONCE, (nonce, line_user_id, now)).rowcount > 0
+
+        return self._execute_with_retry(operation)
+
+    def release_postback_nonce(self, nonce):
+        """予定を追加できなかった場合に、同じボタンでやり直せるようnonceを未使用に戻す"""
+        def operation(c):
+            self._run(c, q.DELETE_POSTBACK_NONCE, (nonce,))
+
+        self._execute_with_retry(operation)
+
+    # --- agenda_jobs ---
+    def create_agenda_job(self, job_id):
+        """日次予定送信ジョブを登録（既に存在する場合は何もしない）"""
+        now = datetime.utcnow().isoformat()
+        def operation(c):
+            self._run(c, q.INSERT_AGENDA_JOB, (job_id, now))
+
+        self._execute_with_retry(operation)
+
+    def start_agenda_job(self, job_id):
+        """ジョブを実行中にする（開始時刻は最初の開始時のみ記録）"""
+        now = datetime.utcnow().isoformat()
+        def operation(c):
+            self._run(c, q.START_AGENDA_JOB, (now, job_id))
+
+        self._execute_with_retry(operation)
+
+    def finish_agenda_job(self, job_id, status, error=None):
+        """ジョブを終了状態（completed / failed）にする。既に同じ状態なら更新しない"""
+        now = datetime.utcnow().isoformat()
+        def operation(c):
+            return self._run(c, q.FINISH_AGENDA_JOB, (status, error, now, job_id, status)).rowcount > 0
+
+        updated = self._execute_with_retry(operation)
+        return updated
+
+    def get_agenda_job(self, job_id):
+        """ジョブの状態を取得"""
+        def operation(c):
+            row = self._run(c, q.SELECT_AGENDA_JOB, (job_id,)).fetchone()
+            if not row:
+                return None
+            return {
+                'job_id': row[0],
+                'status': row[1],
+                'error': row[2],
+                'created_at': row[3],
+                'started_at': row[4],
+                'finished_at': row[5]
+            }
+
+        return self._execute_with_retry(operation, readonly=True)
+
+    def get_active_agenda_job_ids(self):
+        """未完了（queued / running）のジョブID一覧を返す"""
+        def operation(c):
+            return [row[0] for row in self._run(c, q.SELECT_ACTIVE_AGENDA_JOB_IDS).fetchall()]
+
+        return self._execute_with_retry(operation, readonly=True)
+
+    # --- agenda_tasks ---
+    def enqueue_agenda_tasks(self, run_id):
+        """認証済みユーザーごとの送信タスクを登録（登録済みのユーザーはスキップ）し、追加件数を返す"""
+        now = datetime.utcnow().isoformat()
+        def operation(c):
+            return self._run(c, q.ENQUEUE_AGENDA_TASKS, (run_id, now)).rowcount
+
+        inserted = self._execute_with_retry(operation)
+        return inserted
+
+    def claim_agenda_tasks(self, run_id, owner, limit, lease_seconds, max_attempts):
+        """未処理またはリース切れのタスクをlimit件まで確保し、LINEユーザーIDのリストを返す
+
+        PostgreSQLは FOR UPDATE SKIP LOCKED で複数プロセスが重複なく確保する。
+        SQLiteは書き込みスレッドのトランザクション（BEGIN IMMEDIATE）内で選択・更新する。
+        max_attempts回リースが切れたタスクは失敗として確定する。
+        """
+        now = datetime.utcnow()
+        now_str = now.isoformat()
+        lease_expires_at = (now + timedelta(seconds=lease_seconds)).isoformat()
+
+        def operation(c):
+            self._run(c, q.FAIL_EXPIRED_AGENDA_TASKS, (now_str, run_id, now_str, max_attempts))
+            if self.is_postgres:
+                self._run(c, q.CLAIM_AGENDA_TASKS, (owner, lease_expires_at, now_str, run_id, run_id, now_str, limit))
+                return [row[0] for row in c.fetchall()]
+            user_ids = [row[0] for row in self._run(c, q.SELECT_CLAIMABLE_AGENDA_TASKS, (run_id, now_str, limit)).fetchall()]
+            for user_id in user_ids:
+                self._run(c, q.LEASE_AGENDA_TASK, (owner, lease_expires_at, now_str, run_id, user_id))
+            return user_ids
+
+        return self._execute_with_retry(operation)
+
+    def renew_agenda_task_lease(self, run_id, line_user_id, owner, lease_seconds):
+        """確保したタスクのリースを今からlease_seconds秒に延長する。リースを失っていた場合はFalseを返す"""
+        now = datetime.utcnow()
+        lease_expires_at = (now + timedelta(seconds=lease_seconds)).isoformat()
+        def operation(c):
+            return self._run(c, q.RENEW_AGENDA_TASK_LEASE, (
+                lease_expires_at, now.isoformat(), run_id, line_user_id, owner
+            )).rowcount > 0
+
+        return self._execute_with_retry(operation)
+
+    def complete_agenda_task(self, run_id, line_user_id, owner, status, error=None):
+        """確保したタスクを完了（done / failed）にする。リースを失っていた場合はFalseを返す"""
+        now = datetime.utcnow().isoformat()
+        def operation(c):
+            return self._run(c, q.COMPLETE_AGENDA_TASK, (status, error, now, run_id, line_user_id, owner)).rowcount > 0
+
+        updated = self._execute_with_retry(operation)
+        return updated
+
+    def get_agenda_task_counts(self, run_id):
+        """ジョブのタスク件数をステータスごとに返す"""
+        def operation(c):
+            counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+            for status, count in self._run(c, q.COUNT_AGENDA_TASKS_BY_STATUS, (run_id,)).fetchall():
+                counts[status] = count
+            return counts
+
+        return self._execute_with_retry(operation, readonly=True)
+
+    # --- agenda_task_metrics / agenda_run_reports ---
+    def save_agenda_task_metrics(self, run_id, line_user_id, stage_ms, total_ms, error_class=None):
+        """ユーザーごとの段階別処理時間（ミリ秒）を保存"""
+        self.save_agenda_task_metrics_bulk(run_id, [(line_user_id, stage_ms, total_ms, error_class)])
+
+    def save_agenda_task_metrics_bulk(self, run_id, results):
+        """複数ユーザーの段階別処理時間を1回で保存（resultsは (line_user_id, stage_ms, total_ms, error_class) のリスト）"""
+        rows = [
+            (
+                run_id,
+                line_user_id,
+                stage_ms.get('credential_load'),
+                stage_ms.get('calendar_fetch'),
+                stage_ms.get('render'),
+                stage_ms.get('push'),
+                total_ms,
+                error_class
+            )
+            for line_user_id, stage_ms, total_ms, error_class in results
+        ]
+        def operation(c):
+            self._run_bulk(c, q.UPSERT_AGENDA_TASK_METRICS, rows)
+
+        self._execute_with_retry(operation)
+
+    def iter_agenda_task_metrics(self, run_id, batch_size=1000):
+        """ジョブの段階別処理時間をline_user_id順のキーセットページングで1件ずつ返すジェネレーター"""
+        last_user_id = ''
+        while True:
+            def operation(c):
+                return self._run(c, q.SELECT_AGENDA_TASK_METRICS_PAGE, (run_id, last_user_id, batch_size)).fetchall()
+
+            rows = self._execute_with_retry(operation, readonly=True)
+            for row in rows:
+                yield {
+                    'line_user_id': row[0],
+                    'stage_ms': {
+                        'credential_load': row[1],
+                        'calendar_fetch': row[2],
+                        'render': row[3],
+                        'push': row[4]
+                    },
+                    'total_ms': row[5],
+                    'error_class': row[6]
+                }
+            if len(rows) < batch_size:
+                return
+            last_user_id = rows[-1][0]
+
+    def save_agenda_run_report(self, job_id, report_json):
+        """ジョブの集計レポート（JSON文字列）を保存"""
+        now = datetime.utcnow().isoformat()
+        def operation(c):
+            self._run(c, q.UPSERT_AGENDA_RUN_REPORT, (job_id, report_json, now))
+
+        self._execute_with_retry(operation)
+
+    def get_agenda_run_report(self, job_id):
+        """ジョブの集計レポート（JSON文字列）を取得"""
+        def operation(c):
+            row = self._run(c, q.SELECT_AGENDA_RUN_REPORT, (job_id,)).fetchone()
+            return row[0] if row else None
+
+        return self._execute_with_retry(operation, readonly=True)
+
+    # --- reauth_notices ---
+    def get_reauth_notice_sent_at(self, line_user_id):
+        """再認証案内を最後に送信した日時（UTC）を返す（未送信ならNone）"""
+        def operation(c):
+            row = self._run(c, q.SELECT_REAUTH_NOTICE_SENT_AT, (line_user_id,)).fetchone()
+            return self._from_ts(row[0]) if row else None
+
+        return self._execute_with_retry(operation, readonly=True)
+
+    def record_reauth_notice(self, line_user_id, code):
+        """再認証案内の送信を記録"""
+        now = self._ts(datetime.now(timezone.utc))
+        def operation(c):
+            self._run(c, q.UPSERT_REAUTH_NOTICE, (line_user_id, code, now))
+
+        self._execute_with_retry(operation)
+
+
+_shared_db = None
+_shared_db_pid = None
+_shared_db_lock = threading.Lock()
+
+
+def get_db():
+    """プロセスで共有するDBHelperを返す
+
+    初回呼び出し時に作成する（gunicornのfork後のワーカーで接続プールを作るため）。
+    fork元から引き継いだインスタンスは使わずに作り直す。
+    """
+    global _shared_db, _shared_db_pid
+    pid = os.getpid()
+    if _shared_db is not None and _shared_db_pid == pid:
+        return _shared_db
+    with _shared_db_lock:
+        if _shared_db is None or _shared_db_pid != pid:
+            # 親プロセスの接続は閉じると親側のセッションまで切断されるため、参照を捨てるだけにする
+            _shared_db = DBHelper()
+            _shared_db_pid = pid
+        return _shared_db
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == 'init':
+        # デプロイ時（Railwayの preDeployCommand / Procfileの release）に実行する
+        db = DBHelper(init_schema=True)
+        logger.info(f"データベースのスキーマを更新しました: version={migrations.current_version(db)}")
+        db.close()
+    else:
+        print("使い方: python db.py init")
+        sys.exit(1)
@@ -0,0 +1,100 @@
+"""
+リクエストごとの処理期限（Deadline）
+- /callbackでWebhookを受け取った時点で作成し、コンテキスト（ContextVar）で各処理段階に引き継ぐ
+  （処理用のスレッド・asyncio.to_thread・asyncioのタスクにもコンテキストごと引き継がれる）
+- 外部API（OpenAI・Calendar API）の呼び出しは残り時間をタイムアウトの上限にする（stage_timeout）
+- 残り時間が少ない場合は省略できる処理（正規表現による日時の補完・移動時間を含む重複チェック）を飛ばす（allows_optional）
+- 期限切れ・タイムアウト・省略した処理は段階（stage）ごとにメトリクスに記録する
+"""
+import contextvars
+import logging
+import time
+
+from config import Config
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+STAGE_TIMEOUTS = registry.counter('message_stage_timeouts_total', '処理段階ごとのタイムアウト・期限切れの数（stage別）')
+OPTIONAL_SKIPS = registry.counter('message_optional_skips_total', '残り時間が少ないため省略した処理の数（stage別）')
+REMAINING_AT_REPLY_MS = registry.histogram('message_deadline_remaining_ms', '応答を送る時点での処理期限までの残り時間（ミリ秒）')
+
+
+class DeadlineExceeded(Exception):
+    """処理期限を過ぎたため、その段階を実行しなかった"""
+
+    def __init__(self, stage):
+        super().__init__(f"処理期限を過ぎました（{stage}）")
+        self.stage = stage
+
+
+class Deadline:
+    """処理期限（time.monotonicの時刻）"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """期限までの残り秒数（過ぎていれば0）"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+# リクエスト（コンテキスト）ごとの処理期限（start_deadlineで開始する）
+_current = contextvars.ContextVar('message_deadline', default=None)
+
+
+def start_deadline(seconds=None):
+    """このコンテキストの処理期限を開始して返す（Webhookのリクエスト開始時に呼ぶ）"""
+    deadline = Deadline(Config.MESSAGE_DEADLINE_SECONDS if seconds is None else seconds)
+    _current.set(deadline)
+    return deadline
+
+
+def current_deadline():
+    """このコンテキストの処理期限（期限のない処理ではNone）"""
+    return _current.get()
+
+
+def _record_timeout(stage):
+    STAGE_TIMEOUTS.inc(stage=stage)
+    logger.warning(f"{stage} の処理がタイムアウトしました")
+
+
+def stage_timed_out(stage):
+    """段階のタイムアウトを記録する。期限のある処理ではDeadlineExceededを送出して残りの段階を打ち切る"""
+    _record_timeout(stage)
+    if _current.get() is not None:
+        raise DeadlineExceeded(stage)
+
+
+def stage_timeout(stage, default):
+    """外部API呼び出しのタイムアウト（既定値と残り時間の短い方）。期限を過ぎていればDeadlineExceededを送出する"""
+    deadline = _current.get()
+    if deadline is None:
+        return default
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        _record_timeout(stage)
+        raise DeadlineExceeded(stage)
+    return min(default, remaining)
+
+
+def allows_optional(stage):
+    """省略できる処理を実行する残り時間があるか（ない場合は省略として記録する）"""
+    deadline = _current.get()
+    if deadline is None or deadline.remaining() >= Config.DEADLINE_OPTIONAL_MIN_SECONDS:
+        return True
+    OPTIONAL_SKIPS.inc(stage=stage)
+    logger.info(f"処理期限まで{deadline.remaining():.1f}秒のため {stage} を省略します")
+    return False
+
+
+def observe_remaining_at_reply():
+    """応答を送る時点での残り時間を記録する"""
+    deadline = _current.get()
+    if deadline is not None:
+        REMAINING_AT_REPLY_MS.observe(deadline.remaining() * 1000)
@@ -0,0 +1,22 @@
+"""
+gunicornの設定（Procfile・railway.jsonの起動コマンドで -c gunicorn.conf.py として読み込む）
+- preload_app: 重いライブラリ（linebot・openai・googleapiclientなど）のimportとapp.pyの初期化をマスターで1回だけ行い、
+  ワーカーはfork後にメモリをコピーオンライトで共有する（ワーカーの起動が速くなり、ワーカーごとのメモリが減る）
+- DB接続プール・LINE/OpenAIのクライアント・バックグラウンドのスレッドはfork前には作らず、
+  各ワーカーで最初に使われたときに作成する（get_db / get_gateway / AIService.clientはプロセスごとに作り直す）
+- 外部API（OpenAI・Google・LINE）への接続はfork後の各ワーカーで確立し、keep-aliveで保つ（http_clients.start_keepalive）
+- ワーカー数は WEB_CONCURRENCY で指定する（gunicornの既定の動作）
+"""
+preload_app = True
+
+
+def when_ready(server):
+    from startup import resident_memory_bytes
+    server.log.info(f"マスターの起動が完了しました: RSS={resident_memory_bytes() / 1024 / 1024:.1f}MiB")
+
+
+def post_fork(server, worker):
+    from http_clients import start_keepalive
+    from startup import resident_memory_bytes
+    server.log.info(f"ワーカーを起動しました: pid={worker.pid}, RSS={resident_memory_bytes() / 1024 / 1024:.1f}MiB")
+    start_keepalive()
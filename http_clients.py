@@ -0,0 +1,184 @@
+"""
+外部API（OpenAI・Google・LINE）のHTTPクライアントの共有
+- プロセスごとに1つずつ作り、接続プール（keep-alive）を全リクエストで使い回す
+  （gunicornの--preloadではfork後のワーカーで最初に使われたときに作成する）
+- 接続プールの大きさはワーカー内の同時実行数（HTTP_POOL_SIZE）に合わせる
+- start_keepalive(): ワーカー起動時に各APIへ接続を確立し（HTTP_WARMUP_ON_BOOT）、
+  以降は HTTP_KEEPALIVE_INTERVAL_SECONDS ごとに軽いリクエストを送って接続が切れないようにする
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+from config import Config
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+WARMUP_MS = registry.histogram('http_warmup_ms', '外部APIへの接続の確立（ウォームアップ・keep-alive）にかかった時間（ミリ秒、api別）')
+WARMUP_FAILURES = registry.counter('http_warmup_failures_total', '外部APIへのウォームアップ・keep-aliveの失敗数（api別）')
+
+# ウォームアップ・keep-aliveで送るリクエスト（認証なしで送れるもの。応答のステータスは問わない）
+OPENAI_PING_URL = 'https://api.openai.com/v1/models'
+GOOGLE_PING_URLS = (
+    'https://www.googleapis.com/calendar/v3/',
+    'https://oauth2.googleapis.com/token',
+)
+LINE_PING_URL = 'https://api.line.me/v2/bot/info'
+PING_TIMEOUT_SECONDS = 5
+
+# googleapiclientのbuild_httpと同じく、308はリダイレクトとして扱わない（resumable uploadで使う）
+GOOGLE_REDIRECT_CODES = frozenset((300, 301, 302, 303, 307))
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+_keepalive_started_pid = None
+
+
+def _shared(name, factory):
+    """プロセスで共有するクライアントを返す（fork後のプロセスでは作り直す）"""
+    global _clients, _clients_pid
+    pid = os.getpid()
+    if _clients_pid == pid and name in _clients:
+        return _clients[name]
+    with _clients_lock:
+        if _clients_pid != pid:
+            _clients = {}
+            _clients_pid = pid
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=Config.HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def line_session():
+    """LINE Messaging APIへの送信で共有するrequests.Session"""
+    return _shared('line', _new_session)
+
+
+def google_session():
+    """Calendar API・トークンのリフレッシュで共有するrequests.Session"""
+    return _shared('google', _new_session)
+
+
+def _new_openai_http():
+    import httpx
+    import openai
+    return openai.DefaultHttpxClient(limits=httpx.Limits(
+        max_connections=Config.HTTP_POOL_SIZE,
+        max_keepalive_connections=Config.HTTP_POOL_SIZE,
+    ))
+
+
+def _openai_http():
+    return _shared('openai_http', _new_openai_http)
+
+
+def openai_client():
+    """プロセスで共有するOpenAIの同期クライアント"""
+    def create():
+        import openai
+        return openai.OpenAI(api_key=Config.OPENAI_API_KEY, http_client=_openai_http())
+    return _shared('openai', create)
+
+
+class SessionHttpClient(RequestsHttpClient):
+    """LineBotApiに渡すHTTPクライアント（line_sessionの接続プールで送信する）"""
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = line_session().get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = line_session().post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = line_session().put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = line_session().delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+
+class GoogleHttp:
+    """googleapiclient（AuthorizedHttp）に渡すhttplib2互換のクライアント（google_sessionの接続プールで送信する）
+
+    httplib2.Httpと違いスレッド間で共有できる。タイムアウトはbuildのたびに処理期限に合わせて指定する。
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.redirect_codes = GOOGLE_REDIRECT_CODES
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+        response = google_session().request(
+            method, uri, data=body, headers=headers, timeout=self.timeout, allow_redirects=redirections > 0
+        )
+        # requestsが展開済みの本文に合わせて、圧縮・長さのヘッダーは渡さない
+        info = {
+            key.lower(): value for key, value in response.headers.items()
+            if key.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')
+        }
+        info['status'] = str(response.status_code)
+        info['reason'] = response.reason
+        return httplib2.Response(info), response.content
+
+
+def _ping(api, send):
+    started = time.perf_counter()
+    try:
+        send()
+    except Exception as e:
+        WARMUP_FAILURES.inc(api=api)
+        logger.warning(f"{api} への接続を確立できませんでした: {e}")
+        return
+    WARMUP_MS.observe((time.perf_counter() - started) * 1000, api=api)
+
+
+def warm_up():
+    """各APIへの接続を確立する（接続プールに1本ずつkeep-aliveの接続を作る）"""
+    if Config.OPENAI_API_KEY:
+        _ping('openai', lambda: _openai_http().head(OPENAI_PING_URL, timeout=PING_TIMEOUT_SECONDS))
+    for url in GOOGLE_PING_URLS:
+        _ping('google', lambda: google_session().head(url, timeout=PING_TIMEOUT_SECONDS))
+    _ping('line', lambda: line_session().head(LINE_PING_URL, timeout=PING_TIMEOUT_SECONDS))
+
+
+def _keepalive_loop():
+    if Config.HTTP_WARMUP_ON_BOOT:
+        warm_up()
+    interval = Config.HTTP_KEEPALIVE_INTERVAL_SECONDS
+    while interval > 0:
+        time.sleep(interval)
+        warm_up()
+
+
+def start_keepalive():
+    """ウォームアップとkeep-aliveのバックグラウンドスレッドを開始する（ワーカーの起動時に1回呼ぶ）"""
+    global _keepalive_started_pid
+    if not Config.HTTP_WARMUP_ON_BOOT and Config.HTTP_KEEPALIVE_INTERVAL_SECONDS <= 0:
+        return
+    pid = os.getpid()
+    with _clients_lock:
+        if _keepalive_started_pid == pid:
+            return
+        _keepalive_started_pid = pid
+    threading.Thread(target=_keepalive_loop, name='http-keepalive', daemon=True).start()
@@ -0,0 +1,74 @@
+"""
+期限切れデータの定期削除
+期限切れのワンタイムコード、古いOAuth state、放置された確認待ちの予定、処理済みのキャッシュ無効化ログ、
+期限切れの確認ボタンのnonceを小さなバッチ（1バッチ=1トランザクション）で削除する。cron.py から定期的に実行される。
+"""
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import Config
+from db import get_db
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+ROWS_PURGED = registry.counter('janitor_rows_purged_total', '期限切れで削除した行数（table別）')
+LAST_RUN_SECONDS = registry.gauge('janitor_last_run_seconds', '直近の期限切れデータ削除の所要時間（秒）')
+
+
+def _cutoffs(now):
+    """テーブルごとの削除基準日時（これより前の行を削除する）"""
+    return {
+        'onetimes': now,  # expires_at を過ぎたもの
+        'oauth_states': now - timedelta(minutes=Config.OAUTH_STATE_TTL_MINUTES),
+        'pending_events': now - timedelta(hours=Config.PENDING_EVENT_TTL_HOURS),
+        'cache_invalidations': now - timedelta(minutes=Config.CACHE_INVALIDATION_TTL_MINUTES),
+        # ボタンはPENDING_EVENT_TTL_HOURSで期限切れになるため、それより古いnonceは不要
+        'postback_nonces': now - timedelta(hours=Config.PENDING_EVENT_TTL_HOURS),
+    }
+
+
+def purge_table(db, table, cutoff):
+    """1テーブル分の期限切れ行をバッチごとに削除し、削除件数を返す"""
+    purged = 0
+    for _ in range(Config.JANITOR_MAX_BATCHES):
+        deleted = db.purge_expired_rows(
+            table,
+            cutoff,
+            Config.JANITOR_BATCH_SIZE,
+            Config.JANITOR_STATEMENT_TIMEOUT_MS
+        )
+        purged += deleted
+        if deleted < Config.JANITOR_BATCH_SIZE:
+            break
+        # 他のトランザクションにロックを譲る
+        time.sleep(Config.JANITOR_BATCH_PAUSE_SECONDS)
+    else:
+        logger.info(f"削除対象が残っているため次回に持ち越します: table={table}")
+    if purged:
+        ROWS_PURGED.inc(purged, table=table)
+    return purged
+
+
+def run_janitor(db=None):
+    """全テーブルの期限切れ行を削除し、テーブルごとの削除件数を返す"""
+    db = db or get_db()
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    results = {}
+    for table, cutoff in _cutoffs(now).items():
+        try:
+            results[table] = purge_table(db, table, cutoff)
+        except Exception as e:
+            logger.error(f"期限切れデータの削除に失敗しました: table={table}, error={e}")
+            results[table] = None
+    elapsed = time.monotonic() - started
+    LAST_RUN_SECONDS.set(round(elapsed, 3))
+    logger.info(f"期限切れデータを削除しました: {results}, 所要時間={elapsed:.2f}秒")
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_janitor()
@@ -1,18 +1,39 @@
-from linebot import LineBotApi, WebhookHandler
+from linebot import WebhookHandler
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, QuickReply, QuickReplyButton, PostbackAction
 from datetime import datetime, timedelta
 from dateutil import parser
+import asyncio
+import json
 import pytz
 import re
 from calendar_service import GoogleCalendarService
 from ai_service import AIService
 from config import Config
-from db import DBHelper
+from db import get_db
+from line_gateway import get_gateway
+from deadline import DeadlineExceeded, allows_optional
+from postback import ACTION_ADD, ACTION_CANCEL, InvalidPostback, encode_confirmation, decode_confirmation
+from tracing import span, user_hash
 import logging
 
 logger = logging.getLogger("line_bot_handler")
 
+# 確認待ちの予定を追加する返答
+CONFIRM_WORDS = ["はい", "追加", "OK", "Yes", "yes"]
+
+GUIDANCE_TEXT = "日時の送信で空き時間が分かります！\n日時と内容の送信で予定を追加します！\n\n例：\n・「明日の空き時間」\n・「7/15 15:00〜16:00の空き時間」\n・「明日の午前9時から会議を追加して」\n・「来週月曜日の14時から打ち合わせ」"
+
+ERROR_REPLY_TEXT = "申し訳ございません。エラーが発生しました。しばらく時間をおいて再度お試しください。"
+
+POSTBACK_EXPIRED_TEXT = "この確認は有効期限が切れています。もう一度予定を送信してください。"
+
+POSTBACK_USED_TEXT = "この予定はすでに追加しています。"
+
+DEADLINE_EXCEEDED_TEXT = "申し訳ございません。処理に時間がかかったため中断しました。しばらく時間をおいて再度お試しください。"
+
+EVENT_NOT_RECOGNIZED_TEXT = "イベント情報を正しく認識できませんでした。\n\n例: 「明日の午前9時から会議を追加して」\n「来週月曜日の14時から打ち合わせ」"
+
 class LineBotHandler:
     def __init__(self):
         # LINE Bot API クライアント初期化（標準）
@@ -21,52 +42,36 @@ class LineBotHandler:
         if not Config.LINE_CHANNEL_SECRET:
             raise ValueError("LINE_CHANNEL_SECRET environment variable is not set")
             
-        self.line_bot_api = LineBotApi(Config.LINE_CHANNEL_ACCESS_TOKEN)
         self.handler = WebhookHandler(Config.LINE_CHANNEL_SECRET)
         
-        # カスタムセッション設定をグローバルに適用
-        import requests
-        from requests.adapters import HTTPAdapter
-        from urllib3.util.retry import Retry
-        
-        # リトライ戦略を設定（より詳細な設定）
-        retry_strategy = Retry(
-            total=5,  # 最大リトライ回数を増加
-            backoff_factor=2,  # バックオフ係数を増加
-            status_forcelist=[429, 500, 502, 503, 504, 520, 521, 522, 523, 524],  # リトライするHTTPステータスコードを拡張
-            allowed_methods=["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE", "POST"],  # 全HTTPメソッドでリトライ
-            raise_on_status=False,  # ステータスエラーで例外を発生させない
-        )
-        
-        # アダプターを設定
-        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=10, pool_maxsize=20)
-        
-        # グローバルセッション設定
-        session = requests.Session()
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
-        session.timeout = (15, 45)  # (接続タイムアウト, 読み取りタイムアウト) を増加
-        
-        # LINE Bot SDKの内部セッションを置き換え
-        self.line_bot_api._session = session
-        
-        # DBヘルパーの初期化
-        self.db_helper = DBHelper()
-        
         try:
             self.calendar_service = GoogleCalendarService()
         except Exception as e:
-            print(f"Google Calendarサービス初期化エラー: {e}")
+            logger.error(f"Google Calendarサービス初期化エラー: {e}")
             self.calendar_service = None
             
         try:
             self.ai_service = AIService()
         except Exception as e:
-            print(f"AIサービス初期化エラー: {e}")
+            logger.error(f"AIサービス初期化エラー: {e}")
             self.ai_service = None
             
         self.jst = pytz.timezone('Asia/Tokyo')
     
+    @property
+    def gateway(self):
+        """LINEへの送信はゲートウェイ経由で行う（レート制限・リトライ・メトリクス。fork後のワーカーでは作り直す）"""
+        return get_gateway()
+
+    @property
+    def line_bot_api(self):
+        return self.gateway.line_bot_api
+
+    @property
+    def db_helper(self):
+        """プロセス共有のDBHelper"""
+        return get_db()
+    
     def _check_user_auth(self, line_user_id):
         """ユーザーの認証状態をチェック"""
         return self.db_helper.user_exists(line_user_id)
@@ -97,9 +102,65 @@ class LineBotHandler:
 """
         return TextSendMessage(text=message)
     
-    def handle_message(self, event):
-        """メッセージを処理します"""
-        user_message = event.message.text
+    def expects_slow_response(self, event):
+        """OpenAIまたはCalendar APIを呼ぶ（数秒かかる）メッセージか（1対1のチャットのみ判定する）
+
+        認証状態と確認待ちの予定はキャッシュから読むため、handle_messageの前に呼んでも負荷は増えない。
+        """
+        if getattr(event, 'type', None) != 'message' or getattr(event.source, 'type', None) != 'user':
+            return False
+        try:
+            line_user_id = event.source.user_id
+            if not self._check_user_auth(line_user_id):
+                return False
+            if self.db_helper.get_pending_event(line_user_id):
+                # 「はい」なら予定の追加、それ以外はキャンセルのみ
+                return event.message.text.strip() in CONFIRM_WORDS
+            return True
+        except Exception as e:
+            logger.warning(f"処理時間の見込みを判定できませんでした: {e}")
+            return False
+
+    def coalescable(self, event):
+        """続けて届いたメッセージとまとめて日時抽出してよいか（expects_slow_responseがTrueのメッセージについて呼ぶ）"""
+        # 確認待ちの予定への「はい」は単独で処理する
+        return event.message.text.strip() not in CONFIRM_WORDS
+
+    def build_response(self, event, text=None):
+        """handle_message（ポストバックはhandle_postback）を実行して応答を返す（例外の場合はエラーメッセージ）"""
+        with span('handler', event.type, user=user_hash(event.source.user_id)) as s:
+            try:
+                if event.type == 'postback':
+                    return self.handle_postback(event)
+                return self.handle_message(event, text)
+            except DeadlineExceeded as e:
+                s.fail(e)
+                logger.warning(f"メッセージ処理を中断しました: {e}")
+                return TextSendMessage(text=DEADLINE_EXCEEDED_TEXT)
+            except Exception as e:
+                s.fail(e)
+                logger.error(f"メッセージ処理でエラーが発生しました: {e}")
+                return TextSendMessage(text=ERROR_REPLY_TEXT)
+
+    async def build_response_async(self, event, text=None):
+        """build_responseの非同期版"""
+        with span('handler', event.type, user=user_hash(event.source.user_id)) as s:
+            try:
+                if event.type == 'postback':
+                    return await self.handle_postback_async(event)
+                return await self.handle_message_async(event, text)
+            except DeadlineExceeded as e:
+                s.fail(e)
+                logger.warning(f"メッセージ処理を中断しました: {e}")
+                return TextSendMessage(text=DEADLINE_EXCEEDED_TEXT)
+            except Exception as e:
+                s.fail(e)
+                logger.error(f"メッセージ処理でエラーが発生しました: {e}")
+                return TextSendMessage(text=ERROR_REPLY_TEXT)
+
+    def handle_message(self, event, text=None):
+        """メッセージを処理します（textを渡した場合はメッセージ本文の代わりに使う）"""
+        user_message = event.message.text if text is None else text
         line_user_id = event.source.user_id
 
         # Google認証未完了なら必ず認証案内を返す
@@ -107,418 +168,627 @@ class LineBotHandler:
             return self._send_auth_guide(line_user_id)
 
         # 「はい」返答による強制追加判定
-        if user_message.strip() in ["はい", "追加", "OK", "Yes", "yes"]:
+        if user_message.strip() in CONFIRM_WORDS:
             pending_json = self.db_helper.get_pending_event(line_user_id)
             if pending_json:
-                import json
-                event_info = json.loads(pending_json)
-                # 予定を強制追加
-                from dateutil import parser
-                start_datetime = parser.parse(event_info['start_datetime'])
-                end_datetime = parser.parse(event_info['end_datetime'])
-                # 既にタイムゾーンが設定されている場合はそのまま使用、そうでなければJSTを設定
-                if start_datetime.tzinfo is None:
-                    start_datetime = self.jst.localize(start_datetime)
-                if end_datetime.tzinfo is None:
-                    end_datetime = self.jst.localize(end_datetime)
-                if not self.calendar_service or not self.ai_service:
-                    return TextSendMessage(text="カレンダーサービスまたはAIサービスが初期化されていません。")
-                
-                # 移動時間フラグをチェック
-                has_travel = event_info.get('has_travel', False)
-                print(f"[DEBUG] 強制追加: 移動時間フラグ = {has_travel}")
-                
-                success, message, result = self.calendar_service.add_event(
-                    event_info['title'],
-                    start_datetime,
-                    end_datetime,
-                    event_info.get('description', ''),
-                    line_user_id=line_user_id,
-                    force_add=True
-                )
-                
-                # 移動時間フラグがある場合は、移動時間も追加
-                if success and has_travel:
-                    print(f"[DEBUG] 移動時間を追加開始")
-                    # 移動時間の予定を作成
-                    from datetime import timedelta
-                    import pytz
-                    jst = pytz.timezone('Asia/Tokyo')
-                    
-                    # 往路（1時間前）
-                    travel_before_start = start_datetime - timedelta(hours=1)
-                    travel_before_end = start_datetime
-                    
-                    # 復路（1時間後）
-                    travel_after_start = end_datetime
-                    travel_after_end = end_datetime + timedelta(hours=1)
-                    
-                    # 往路を追加
-                    travel_success1, travel_message1, travel_result1 = self.calendar_service.add_event(
-                        "移動時間（往路）",
-                        travel_before_start,
-                        travel_before_end,
-                        "移動のための時間",
-                        line_user_id=line_user_id,
-                        force_add=True
-                    )
-                    print(f"[DEBUG] 往路追加結果: {travel_success1}")
-                    
-                    # 復路を追加
-                    travel_success2, travel_message2, travel_result2 = self.calendar_service.add_event(
-                        "移動時間（復路）",
-                        travel_after_start,
-                        travel_after_end,
-                        "移動のための時間",
-                        line_user_id=line_user_id,
-                        force_add=True
-                    )
-                    print(f"[DEBUG] 復路追加結果: {travel_success2}")
-                
-                self.db_helper.delete_pending_event(line_user_id)
-                response_text = self.ai_service.format_event_confirmation(success, message, result)
-                return TextSendMessage(text=response_text)
+                return self._add_pending_event(json.loads(pending_json), line_user_id)
         else:
             # 「はい」以外の返答でpending_eventsがあれば削除し、キャンセルメッセージを返す
             pending_json = self.db_helper.get_pending_event(line_user_id)
             if pending_json:
                 self.db_helper.delete_pending_event(line_user_id)
                 return TextSendMessage(text="予定追加をキャンセルしました。")
-        
+
         try:
-            # 環境変数が設定されていない場合の処理
-            if not Config.LINE_CHANNEL_ACCESS_TOKEN or not Config.LINE_CHANNEL_SECRET:
-                return TextSendMessage(text="LINE Botの設定が完了していません。環境変数を設定してください。")
-            
-            if not self.ai_service:
-                return TextSendMessage(text="AIサービスの初期化に失敗しました。OpenAI APIキーを設定してください。")
-            
+            unavailable = self._unavailable_response()
+            if unavailable:
+                return unavailable
+
             # AIを使ってメッセージの意図を判断
             ai_result = self.ai_service.extract_dates_and_times(user_message)
-            print(f"[DEBUG] ai_result: {ai_result}")
-            
+            logger.debug("ai_result: %s", ai_result)
+
             if 'error' in ai_result:
                 # AI処理に失敗した場合、ガイダンスメッセージを返す
-                return TextSendMessage(text="日時の送信で空き時間が分かります！\n日時と内容の送信で予定を追加します！\n\n例：\n・「明日の空き時間」\n・「7/15 15:00〜16:00の空き時間」\n・「明日の午前9時から会議を追加して」\n・「来週月曜日の14時から打ち合わせ」")
-            
+                return TextSendMessage(text=GUIDANCE_TEXT)
+
             # タスクタイプに基づいて処理
             task_type = ai_result.get('task_type', 'add_event')
-            
+
             if task_type == 'availability_check':
-                print(f"[DEBUG] dates_info: {ai_result.get('dates', [])}")
+                logger.debug("dates_info: %s", ai_result.get('dates', []))
                 return self._handle_availability_check(ai_result.get('dates', []), line_user_id)
             elif task_type == 'add_event':
                 # 予定追加時の重複確認ロジック（複数予定対応）
                 if not self.calendar_service:
                     return TextSendMessage(text="カレンダーサービスが初期化されていません。")
-                
+
                 dates = ai_result.get('dates', [])
                 if not dates:
-                    return TextSendMessage(text="イベント情報を正しく認識できませんでした。\n\n例: 「明日の午前9時から会議を追加して」\n「来週月曜日の14時から打ち合わせ」")
-                
+                    return TextSendMessage(text=EVENT_NOT_RECOGNIZED_TEXT)
+
                 # 複数の予定を処理
                 return self._handle_multiple_events(dates, line_user_id)
             else:
                 # 未対応コマンドの場合もガイダンスメッセージ
-                return TextSendMessage(text="日時の送信で空き時間が分かります！\n日時と内容の送信で予定を追加します！\n\n例：\n・「明日の空き時間」\n・「7/15 15:00〜16:00の空き時間」\n・「明日の午前9時から会議を追加して」\n・「来週月曜日の14時から打ち合わせ」")
+                return TextSendMessage(text=GUIDANCE_TEXT)
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             return TextSendMessage(text=f"エラーが発生しました: {str(e)}")
-    
+
+    async def handle_message_async(self, event, text=None):
+        """handle_messageの非同期版（asgi.pyから呼ばれる）
+
+        OpenAI・Calendar APIの呼び出しはイベントループ上で待ち、DBの読み書きは別スレッドで行う。
+        """
+        user_message = event.message.text if text is None else text
+        line_user_id = event.source.user_id
+
+        # Google認証未完了なら必ず認証案内を返す
+        if not await asyncio.to_thread(self._check_user_auth, line_user_id):
+            return await asyncio.to_thread(self._send_auth_guide, line_user_id)
+
+        pending_json = await asyncio.to_thread(self.db_helper.get_pending_event, line_user_id)
+        if pending_json:
+            if user_message.strip() in CONFIRM_WORDS:
+                return await self._add_pending_event_async(json.loads(pending_json), line_user_id)
+            await asyncio.to_thread(self.db_helper.delete_pending_event, line_user_id)
+            return TextSendMessage(text="予定追加をキャンセルしました。")
+
+        try:
+            unavailable = self._unavailable_response()
+            if unavailable:
+                return unavailable
+
+            ai_result = await self.ai_service.extract_dates_and_times_async(user_message)
+            if 'error' in ai_result:
+                return TextSendMessage(text=GUIDANCE_TEXT)
+
+            task_type = ai_result.get('task_type', 'add_event')
+            if task_type == 'availability_check':
+                return await self._handle_availability_check_async(ai_result.get('dates', []), line_user_id)
+            elif task_type == 'add_event':
+                if not self.calendar_service:
+                    return TextSendMessage(text="カレンダーサービスが初期化されていません。")
+                dates = ai_result.get('dates', [])
+                if not dates:
+                    return TextSendMessage(text=EVENT_NOT_RECOGNIZED_TEXT)
+                return await self._handle_multiple_events_async(dates, line_user_id)
+            else:
+                return TextSendMessage(text=GUIDANCE_TEXT)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.exception(f"メッセージ処理でエラーが発生しました: {e}")
+            return TextSendMessage(text=f"エラーが発生しました: {str(e)}")
+
+    def handle_postback(self, event):
+        """重複確認のボタン（ポストバック）を処理します（pending_eventsは読まず、データに含まれる予定を追加する）"""
+        line_user_id = event.source.user_id
+        try:
+            action, event_info = decode_confirmation(event.postback.data, line_user_id)
+        except (InvalidPostback, ValueError, TypeError, IndexError) as e:
+            logger.warning(f"ポストバックを処理できませんでした: {e}")
+            return TextSendMessage(text=POSTBACK_EXPIRED_TEXT)
+        if action == ACTION_CANCEL:
+            return TextSendMessage(text="予定追加をキャンセルしました。")
+        # 同じボタンの2回目以降（連打・Webhookの再送）は追加しない
+        if not self.db_helper.consume_postback_nonce(event_info['nonce'], line_user_id):
+            return TextSendMessage(text=POSTBACK_USED_TEXT)
+        return self._add_confirmed_event(event_info, line_user_id, postback_nonce=event_info['nonce'])
+
+    async def handle_postback_async(self, event):
+        """handle_postbackの非同期版"""
+        line_user_id = event.source.user_id
+        try:
+            action, event_info = decode_confirmation(event.postback.data, line_user_id)
+        except (InvalidPostback, ValueError, TypeError, IndexError) as e:
+            logger.warning(f"ポストバックを処理できませんでした: {e}")
+            return TextSendMessage(text=POSTBACK_EXPIRED_TEXT)
+        if action == ACTION_CANCEL:
+            return TextSendMessage(text="予定追加をキャンセルしました。")
+        if not await asyncio.to_thread(self.db_helper.consume_postback_nonce, event_info['nonce'], line_user_id):
+            return TextSendMessage(text=POSTBACK_USED_TEXT)
+        return await self._add_confirmed_event_async(event_info, line_user_id, postback_nonce=event_info['nonce'])
+
+    def _unavailable_response(self):
+        """設定・サービスが揃っていない場合の案内（揃っていればNone）"""
+        # 環境変数が設定されていない場合の処理
+        if not Config.LINE_CHANNEL_ACCESS_TOKEN or not Config.LINE_CHANNEL_SECRET:
+            return TextSendMessage(text="LINE Botの設定が完了していません。環境変数を設定してください。")
+        if not self.ai_service:
+            return TextSendMessage(text="AIサービスの初期化に失敗しました。OpenAI APIキーを設定してください。")
+        return None
+
+    def _localize(self, dt):
+        """タイムゾーンが設定されていなければJSTを設定"""
+        return dt if dt.tzinfo is not None else self.jst.localize(dt)
+
+    def _travel_events(self, start_datetime, end_datetime):
+        """移動時間（往路は1時間前、復路は1時間後）の予定 (タイトル, 開始, 終了) のリスト"""
+        return [
+            ("移動時間（往路）", start_datetime - timedelta(hours=1), start_datetime),
+            ("移動時間（復路）", end_datetime, end_datetime + timedelta(hours=1)),
+        ]
+
+    def _add_pending_event(self, event_info, line_user_id):
+        """確認待ちの予定を強制追加します"""
+        response = self._add_confirmed_event(event_info, line_user_id)
+        self.db_helper.delete_pending_event(line_user_id)
+        return response
+
+    def _add_confirmed_event(self, event_info, line_user_id, postback_nonce=None):
+        """重複を確認済みの予定（移動時間フラグがあれば往路・復路も）を追加します
+
+        postback_nonceを渡すと、予定を追加できなかった場合にnonceを未使用に戻す（同じボタンでやり直せる）。
+        """
+        success = False
+        try:
+            success, response = self._insert_confirmed_event(event_info, line_user_id)
+        finally:
+            if postback_nonce and not success:
+                self.db_helper.release_postback_nonce(postback_nonce)
+        return response
+
+    def _insert_confirmed_event(self, event_info, line_user_id):
+        """_add_confirmed_eventの本体。(追加できたか, 応答) を返す"""
+        start_datetime = self._localize(parser.parse(event_info['start_datetime']))
+        end_datetime = self._localize(parser.parse(event_info['end_datetime']))
+        if not self.calendar_service or not self.ai_service:
+            return False, TextSendMessage(text="カレンダーサービスまたはAIサービスが初期化されていません。")
+
+        # 移動時間フラグをチェック
+        has_travel = event_info.get('has_travel', False)
+        logger.debug("強制追加: 移動時間フラグ = %s", has_travel)
+
+        success, message, result = self.calendar_service.add_event(
+            event_info['title'],
+            start_datetime,
+            end_datetime,
+            event_info.get('description', ''),
+            line_user_id=line_user_id,
+            force_add=True
+        )
+
+        # 移動時間フラグがある場合は、移動時間（往路・復路）も追加
+        if success and has_travel:
+            for title, travel_start, travel_end in self._travel_events(start_datetime, end_datetime):
+                travel_success, _, _ = self.calendar_service.add_event(
+                    title,
+                    travel_start,
+                    travel_end,
+                    "移動のための時間",
+                    line_user_id=line_user_id,
+                    force_add=True
+                )
+                logger.debug("%s追加結果: %s", title, travel_success)
+
+        response_text = self.ai_service.format_event_confirmation(success, message, result)
+        return success, TextSendMessage(text=response_text)
+
+    async def _add_pending_event_async(self, event_info, line_user_id):
+        """_add_pending_eventの非同期版"""
+        response = await self._add_confirmed_event_async(event_info, line_user_id)
+        await asyncio.to_thread(self.db_helper.delete_pending_event, line_user_id)
+        return response
+
+    async def _add_confirmed_event_async(self, event_info, line_user_id, postback_nonce=None):
+        """_add_confirmed_eventの非同期版（移動時間の予定は並行して追加する）"""
+        success = False
+        try:
+            success, response = await self._insert_confirmed_event_async(event_info, line_user_id)
+        finally:
+            if postback_nonce and not success:
+                await asyncio.to_thread(self.db_helper.release_postback_nonce, postback_nonce)
+        return response
+
+    async def _insert_confirmed_event_async(self, event_info, line_user_id):
+        """_insert_confirmed_eventの非同期版"""
+        start_datetime = self._localize(parser.parse(event_info['start_datetime']))
+        end_datetime = self._localize(parser.parse(event_info['end_datetime']))
+        if not self.calendar_service or not self.ai_service:
+            return False, TextSendMessage(text="カレンダーサービスまたはAIサービスが初期化されていません。")
+
+        access_token = await self.calendar_service.get_access_token_async(line_user_id)
+        success, message, result = await self.calendar_service.add_event_async(
+            event_info['title'],
+            start_datetime,
+            end_datetime,
+            event_info.get('description', ''),
+            line_user_id=line_user_id,
+            force_add=True,
+            access_token=access_token
+        )
+        if success and event_info.get('has_travel', False):
+            await asyncio.gather(*(
+                self.calendar_service.add_event_async(
+                    title, travel_start, travel_end, "移動のための時間",
+                    line_user_id=line_user_id, force_add=True, access_token=access_token
+                )
+                for title, travel_start, travel_end in self._travel_events(start_datetime, end_datetime)
+            ))
+
+        response_text = self.ai_service.format_event_confirmation(success, message, result)
+        return success, TextSendMessage(text=response_text)
+
+    def _prepare_event(self, date_info):
+        """予定1件分の日時・移動時間の有無・重複チェックの範囲を組み立てます（日時が不完全な場合はNone）"""
+        date_str = date_info.get('date')
+        time_str = date_info.get('time')
+        end_time_str = date_info.get('end_time')
+        title = date_info.get('title', '予定')
+        description = date_info.get('description', '')
+
+        if not date_str or not time_str:
+            logger.debug("不完全な予定情報をスキップ: %s", date_info)
+            return None
+
+        # 終了時間が設定されていない場合は1時間後に設定（元の設定を維持）
+        if not end_time_str or end_time_str == time_str:
+            time_obj = datetime.strptime(time_str, "%H:%M")
+            end_time_obj = time_obj + timedelta(hours=1)
+            end_time_str = end_time_obj.strftime("%H:%M")
+            logger.debug("終了時間を自動設定: %s -> %s", time_str, end_time_str)
+
+        # 日時文字列を構築
+        start_datetime_str = f"{date_str}T{time_str}:00+09:00"
+        end_datetime_str = f"{date_str}T{end_time_str}:00+09:00"
+
+        logger.debug("予定追加処理: %s - %s to %s", title, start_datetime_str, end_datetime_str)
+
+        start_datetime = self._localize(parser.parse(start_datetime_str))
+        end_datetime = self._localize(parser.parse(end_datetime_str))
+
+        # 移動キーワードをチェック
+        travel_keywords = ['移動', '移動あり', '移動時間', '移動必要']
+        has_travel = any(keyword in title or keyword in description for keyword in travel_keywords)
+
+        # チェックする時間範囲を決定
+        check_start = start_datetime
+        check_end = end_datetime
+
+        # 移動時間を含む場合は、往路（1時間前）と復路（1時間後）も含めてチェック（処理期限が近い場合は省略）
+        travel_checked = has_travel and allows_optional('travel_conflict_check')
+        if travel_checked:
+            check_start = start_datetime - timedelta(hours=1)  # 往路
+            check_end = end_datetime + timedelta(hours=1)     # 復路
+            logger.debug("移動時間を含む重複チェック: %s 〜 %s", check_start, check_end)
+
+        return {
+            'title': title,
+            'description': description,
+            'time_str': time_str,
+            'end_time_str': end_time_str,
+            'start_datetime_str': start_datetime_str,
+            'end_datetime_str': end_datetime_str,
+            'start_datetime': start_datetime,
+            'end_datetime': end_datetime,
+            'has_travel': has_travel,
+            'travel_checked': travel_checked,
+            'check_start': check_start,
+            'check_end': check_end,
+        }
+
+    def _conflict_response(self, prepared, events, line_user_id):
+        """重複予定の確認メッセージと、pending_eventsに保存する予定情報（JSON）を返します
+
+        予定情報を確認ボタン（クイックリプライのポストバック）のデータに収められる場合はボタンを付け、
+        pending_eventsには保存しない（予定情報はNone）。
+        """
+        logger.debug("重複予定を検出: %s", prepared['title'])
+        response_text = "⚠️ この時間帯に既に予定が存在します:\n"
+        for event in events:
+            # 時間をフォーマット
+            start_time = event.get('start', '')
+            end_time = event.get('end', '')
+            if 'T' in start_time:
+                start_dt = parser.parse(start_time).astimezone(self.jst)
+                end_dt = parser.parse(end_time).astimezone(self.jst)
+                time_str = f"{start_dt.strftime('%H:%M')}~{end_dt.strftime('%H:%M')}"
+            else:
+                time_str = f"{start_time}~{end_time}"
+
+            response_text += f"- {event.get('title', '予定なし')}\n({time_str})\n"
+
+        if prepared['travel_checked']:
+            response_text += "\n※移動時間（往路・復路）も含めて重複チェックしています。\n"
+
+        # 予定情報（移動時間フラグも含める）
+        event_info = {
+            'title': prepared['title'],
+            'start_datetime': prepared['start_datetime_str'],
+            'end_datetime': prepared['end_datetime_str'],
+            'description': prepared['description'],
+            'has_travel': prepared['has_travel']
+        }
+
+        add_data = encode_confirmation(ACTION_ADD, line_user_id, event_info)
+        if add_data:
+            response_text += "\nそれでも追加しますか？"
+            quick_reply = QuickReply(items=[
+                QuickReplyButton(action=PostbackAction(label="追加する", data=add_data, display_text="追加する")),
+                QuickReplyButton(action=PostbackAction(
+                    label="キャンセル", data=encode_confirmation(ACTION_CANCEL, line_user_id), display_text="キャンセル"
+                )),
+            ])
+            return TextSendMessage(text=response_text, quick_reply=quick_reply), None
+
+        # ボタンのデータに収まらない場合はpending_eventsに保存し、「はい」の返信で追加する
+        response_text += "\nそれでも追加しますか？\n「はい」と返信してください。"
+        return TextSendMessage(text=response_text), json.dumps(event_info)
+
+    def _record_add_result(self, prepared, success, message, added_events, failed_events):
+        """予定追加の結果をadded_events / failed_eventsに追加します"""
+        if success:
+            # 元の表示形式に合わせて日時をフォーマット
+            start_dt = prepared['start_datetime'].astimezone(self.jst)
+            end_dt = prepared['end_datetime'].astimezone(self.jst)
+            weekday = "月火水木金土日"[start_dt.weekday()]
+            date_str = f"{start_dt.month}/{start_dt.day}（{weekday}）"
+            time_str = f"{start_dt.strftime('%H:%M')}〜{end_dt.strftime('%H:%M')}"
+
+            added_events.append({
+                'title': prepared['title'],
+                'time': f"{date_str}{time_str}"
+            })
+            logger.debug("予定追加成功: %s", prepared['title'])
+        else:
+            failed_events.append({
+                'title': prepared['title'],
+                'time': f"{prepared['time_str']}-{prepared['end_time_str']}",
+                'reason': message
+            })
+            logger.warning("予定追加失敗: %s - %s", prepared['title'], message)
+
+    def _failed_event(self, date_info, error):
+        logger.warning("予定処理エラー: %s", error)
+        return {
+            'title': date_info.get('title', '予定'),
+            'time': f"{date_info.get('time', '')}-{date_info.get('end_time', '')}",
+            'reason': str(error)
+        }
+
     def _handle_multiple_events(self, dates, line_user_id):
         """複数の予定を処理します"""
         try:
-            from dateutil import parser
-            import json
-            
             added_events = []
             failed_events = []
-            
+
             for date_info in dates:
                 try:
-                    # 日時を構築
-                    date_str = date_info.get('date')
-                    time_str = date_info.get('time')
-                    end_time_str = date_info.get('end_time')
-                    title = date_info.get('title', '予定')
-                    description = date_info.get('description', '')
-                    
-                    if not date_str or not time_str:
-                        print(f"[DEBUG] 不完全な予定情報をスキップ: {date_info}")
+                    prepared = self._prepare_event(date_info)
+                    if prepared is None:
                         continue
-                    
-                    # 終了時間が設定されていない場合は1時間後に設定（元の設定を維持）
-                    if not end_time_str or end_time_str == time_str:
-                        from datetime import datetime, timedelta
-                        time_obj = datetime.strptime(time_str, "%H:%M")
-                        end_time_obj = time_obj + timedelta(hours=1)
-                        end_time_str = end_time_obj.strftime("%H:%M")
-                        print(f"[DEBUG] 終了時間を自動設定: {time_str} -> {end_time_str}")
-                    
-                    # 日時文字列を構築
-                    start_datetime_str = f"{date_str}T{time_str}:00+09:00"
-                    end_datetime_str = f"{date_str}T{end_time_str}:00+09:00"
-                    
-                    print(f"[DEBUG] 予定追加処理: {title} - {start_datetime_str} to {end_datetime_str}")
-                    
-                    # 日時をパース（タイムゾーン処理を改善）
-                    start_datetime = parser.parse(start_datetime_str)
-                    end_datetime = parser.parse(end_datetime_str)
-                    
-                    # 既にタイムゾーンが設定されている場合はそのまま使用、そうでなければJSTを設定
-                    if start_datetime.tzinfo is None:
-                        start_datetime = self.jst.localize(start_datetime)
-                    if end_datetime.tzinfo is None:
-                        end_datetime = self.jst.localize(end_datetime)
-                    
-                    # 移動時間を含む場合の重複チェック
-                    # 移動キーワードをチェック
-                    travel_keywords = ['移動', '移動あり', '移動時間', '移動必要']
-                    has_travel = any(keyword in title or keyword in description for keyword in travel_keywords)
-                    
-                    # チェックする時間範囲を決定
-                    check_start = start_datetime
-                    check_end = end_datetime
-                    
-                    if has_travel:
-                        # 移動時間を含む場合は、往路（1時間前）と復路（1時間後）も含めてチェック
-                        from datetime import timedelta
-                        check_start = start_datetime - timedelta(hours=1)  # 往路
-                        check_end = end_datetime + timedelta(hours=1)     # 復路
-                        print(f"[DEBUG] 移動時間を含む重複チェック: {check_start} 〜 {check_end}")
-                    
+
                     # 既存予定をチェック
-                    events = self.calendar_service.get_events_for_time_range(check_start, check_end, line_user_id)
+                    events = self.calendar_service.get_events_for_time_range(
+                        prepared['check_start'], prepared['check_end'], line_user_id
+                    )
                     if events:
-                        print(f"[DEBUG] 重複予定を検出: {title}")
-                        # 重複確認メッセージを表示
-                        conflicting_events = []
-                        for event in events:
-                            conflicting_events.append({
-                                'title': event.get('title', '予定なし'),
-                                'start': event.get('start', ''),
-                                'end': event.get('end', '')
-                            })
-                        
-                        # 重複確認メッセージを構築
-                        response_text = "⚠️ この時間帯に既に予定が存在します:\n"
-                        for event in conflicting_events:
-                            # 時間をフォーマット
-                            start_time = event['start']
-                            end_time = event['end']
-                            if 'T' in start_time:
-                                start_dt = parser.parse(start_time)
-                                end_dt = parser.parse(end_time)
-                                start_dt = start_dt.astimezone(self.jst)
-                                end_dt = end_dt.astimezone(self.jst)
-                                time_str = f"{start_dt.strftime('%H:%M')}~{end_dt.strftime('%H:%M')}"
-                            else:
-                                time_str = f"{start_time}~{end_time}"
-                            
-                            response_text += f"- {event['title']}\n({time_str})\n"
-                        
-                        if has_travel:
-                            response_text += "\n※移動時間（往路・復路）も含めて重複チェックしています。\n"
-                        
-                        response_text += "\nそれでも追加しますか？\n「はい」と返信してください。"
-                        
-                        # 予定情報をpending_eventsに保存（移動時間フラグも含める）
-                        event_info = {
-                            'title': title,
-                            'start_datetime': start_datetime_str,
-                            'end_datetime': end_datetime_str,
-                            'description': description,
-                            'has_travel': has_travel
-                        }
-                        import json
-                        self.db_helper.save_pending_event(line_user_id, json.dumps(event_info))
-                        
-                        return TextSendMessage(text=response_text)
-                    
+                        response, event_info = self._conflict_response(prepared, events, line_user_id)
+                        if event_info:
+                            self.db_helper.save_pending_event(line_user_id, event_info)
+                        return response
+
                     # 予定を追加
                     success, message, result = self.calendar_service.add_event(
-                        title,
-                        start_datetime,
-                        end_datetime,
-                        description,
+                        prepared['title'],
+                        prepared['start_datetime'],
+                        prepared['end_datetime'],
+                        prepared['description'],
                         line_user_id=line_user_id,
                         force_add=True
                     )
-                    
-                    if success:
-                        # 元の表示形式に合わせて日時をフォーマット
-                        from datetime import datetime
-                        import pytz
-                        jst = pytz.timezone('Asia/Tokyo')
-                        start_dt = start_datetime.astimezone(jst)
-                        end_dt = end_datetime.astimezone(jst)
-                        weekday = "月火水木金土日"[start_dt.weekday()]
-                        date_str = f"{start_dt.month}/{start_dt.day}（{weekday}）"
-                        time_str = f"{start_dt.strftime('%H:%M')}〜{end_dt.strftime('%H:%M')}"
-                        
-                        added_events.append({
-                            'title': title,
-                            'time': f"{date_str}{time_str}"
-                        })
-                        print(f"[DEBUG] 予定追加成功: {title}")
-                    else:
-                        failed_events.append({
-                            'title': title,
-                            'time': f"{time_str}-{end_time_str}",
-                            'reason': message
-                        })
-                        print(f"[DEBUG] 予定追加失敗: {title} - {message}")
-                        
+                    self._record_add_result(prepared, success, message, added_events, failed_events)
+
+                except DeadlineExceeded as e:
+                    # 残りの予定は処理せず、ここまでの結果を返す
+                    failed_events.append(self._failed_event(date_info, e))
+                    break
                 except Exception as e:
-                    print(f"[DEBUG] 予定処理エラー: {e}")
-                    failed_events.append({
-                        'title': date_info.get('title', '予定'),
-                        'time': f"{date_info.get('time', '')}-{date_info.get('end_time', '')}",
-                        'reason': str(e)
-                    })
-            
-            # 結果メッセージを構築（移動時間を含む場合は統一形式）
-            if added_events:
-                # 移動時間が含まれているかチェック
-                has_travel = any('移動時間' in event['title'] for event in added_events)
-                
-                if has_travel and len(added_events) > 1:
-                    # 移動時間を含む場合は統一形式で表示
-                    response_text = "✅予定を追加しました！\n\n"
-                    
-                    # 日付を取得（最初の予定から）
-                    first_event = added_events[0]
-                    time_str = first_event['time']
-                    # "10/18 (土)19:00〜20:00" から "10/18 (土)" を抽出
-                    date_match = re.search(r'(\d{1,2}/\d{1,2}\s*\([月火水木金土日]\)\s*)', time_str)
-                    date_part = date_match.group(1).strip() if date_match else time_str
-                    response_text += f"{date_part}\n"
-                    response_text += "────────\n"
-                    
-                    # 時間順でソート（開始時間でソート）
-                    def get_start_time(event):
-                        time_str = event['time']
-                        # "10/18 (土)19:00〜20:00" から "19:00〜20:00" を抽出
-                        time_match = re.search(r'(\d{1,2}:\d{2}〜\d{1,2}:\d{2})', time_str)
-                        time_part = time_match.group(1) if time_match else time_str
-                        start_time = time_part.split('〜')[0]  # "19:00〜20:00" -> "19:00"
-                        return start_time
-                    
-                    sorted_events = sorted(added_events, key=get_start_time)
-                    
-                    # 各予定を番号付きで表示
-                    for i, event in enumerate(sorted_events, 1):
-                        # 時間部分を抽出（"10:00~11:00" の形式）
-                        # 日付と時間の区切りを正しく処理
-                        time_str = event['time']
-                        # "10/18 (土)19:00〜20:00" から "19:00〜20:00" を抽出
-                        time_match = re.search(r'(\d{1,2}:\d{2}〜\d{1,2}:\d{2})', time_str)
-                        time_part = time_match.group(1) if time_match else time_str
-                        response_text += f"{i}. {event['title']}\n"
-                        response_text += f"🕐 {time_part}\n"
-                    
-                    response_text += "────────"
-                else:
-                    # 通常の表示形式
-                    response_text = "✅予定を追加しました！\n\n"
-                    for event in added_events:
-                        response_text += f"📅{event['title']}\n{event['time']}\n"
-                
-                if failed_events:
-                    response_text += "\n\n⚠️追加できなかった予定:\n"
-                    for event in failed_events:
-                        response_text += f"• {event['title']} ({event['time']}) - {event['reason']}\n"
+                    failed_events.append(self._failed_event(date_info, e))
+
+            return self._added_events_response(added_events, failed_events)
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.warning("複数予定処理エラー: %s", e)
+            return TextSendMessage(text=f"予定の処理中にエラーが発生しました: {str(e)}")
+
+    async def _handle_multiple_events_async(self, dates, line_user_id):
+        """_handle_multiple_eventsの非同期版"""
+        try:
+            added_events = []
+            failed_events = []
+            access_token = await self.calendar_service.get_access_token_async(line_user_id)
+
+            for date_info in dates:
+                try:
+                    prepared = self._prepare_event(date_info)
+                    if prepared is None:
+                        continue
+
+                    events = await self.calendar_service.get_events_for_time_range_async(
+                        prepared['check_start'], prepared['check_end'], line_user_id, access_token
+                    )
+                    if events:
+                        response, event_info = self._conflict_response(prepared, events, line_user_id)
+                        if event_info:
+                            await asyncio.to_thread(self.db_helper.save_pending_event, line_user_id, event_info)
+                        return response
+
+                    success, message, result = await self.calendar_service.add_event_async(
+                        prepared['title'],
+                        prepared['start_datetime'],
+                        prepared['end_datetime'],
+                        prepared['description'],
+                        line_user_id=line_user_id,
+                        force_add=True,
+                        access_token=access_token
+                    )
+                    self._record_add_result(prepared, success, message, added_events, failed_events)
+
+                except DeadlineExceeded as e:
+                    # 残りの予定は処理せず、ここまでの結果を返す
+                    failed_events.append(self._failed_event(date_info, e))
+                    break
+                except Exception as e:
+                    failed_events.append(self._failed_event(date_info, e))
+
+            return self._added_events_response(added_events, failed_events)
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.exception(f"複数予定処理エラー: {e}")
+            return TextSendMessage(text=f"予定の処理中にエラーが発生しました: {str(e)}")
+
+    def _added_events_response(self, added_events, failed_events):
+        """予定追加の結果メッセージを構築します（移動時間を含む場合は統一形式）"""
+        if added_events:
+            # 移動時間が含まれているかチェック
+            has_travel = any('移動時間' in event['title'] for event in added_events)
+
+            if has_travel and len(added_events) > 1:
+                # 移動時間を含む場合は統一形式で表示
+                response_text = "✅予定を追加しました！\n\n"
+
+                # 日付を取得（最初の予定から）
+                first_event = added_events[0]
+                time_str = first_event['time']
+                # "10/18 (土)19:00〜20:00" から "10/18 (土)" を抽出
+                date_match = re.search(r'(\d{1,2}/\d{1,2}\s*\([月火水木金土日]\)\s*)', time_str)
+                date_part = date_match.group(1).strip() if date_match else time_str
+                response_text += f"{date_part}\n"
+                response_text += "────────\n"
+
+                # 時間順でソート（開始時間でソート）
+                def get_start_time(event):
+                    time_str = event['time']
+                    # "10/18 (土)19:00〜20:00" から "19:00〜20:00" を抽出
+                    time_match = re.search(r'(\d{1,2}:\d{2}〜\d{1,2}:\d{2})', time_str)
+                    time_part = time_match.group(1) if time_match else time_str
+                    start_time = time_part.split('〜')[0]  # "19:00〜20:00" -> "19:00"
+                    return start_time
+
+                sorted_events = sorted(added_events, key=get_start_time)
+
+                # 各予定を番号付きで表示
+                for i, event in enumerate(sorted_events, 1):
+                    # 時間部分を抽出（"10:00~11:00" の形式）
+                    # 日付と時間の区切りを正しく処理
+                    time_str = event['time']
+                    # "10/18 (土)19:00〜20:00" から "19:00〜20:00" を抽出
+                    time_match = re.search(r'(\d{1,2}:\d{2}〜\d{1,2}:\d{2})', time_str)
+                    time_part = time_match.group(1) if time_match else time_str
+                    response_text += f"{i}. {event['title']}\n"
+                    response_text += f"🕐 {time_part}\n"
+
+                response_text += "────────"
             else:
-                response_text = "❌予定を追加できませんでした。\n\n"
+                # 通常の表示形式
+                response_text = "✅予定を追加しました！\n\n"
+                for event in added_events:
+                    response_text += f"📅{event['title']}\n{event['time']}\n"
+
+            if failed_events:
+                response_text += "\n\n⚠️追加できなかった予定:\n"
                 for event in failed_events:
                     response_text += f"• {event['title']} ({event['time']}) - {event['reason']}\n"
-            
-            return TextSendMessage(text=response_text)
-            
-        except Exception as e:
-            print(f"[DEBUG] 複数予定処理エラー: {e}")
-            return TextSendMessage(text=f"予定の処理中にエラーが発生しました: {str(e)}")
-    
+        else:
+            response_text = "❌予定を追加できませんでした。\n\n"
+            for event in failed_events:
+                response_text += f"• {event['title']} ({event['time']}) - {event['reason']}\n"
+
+        return TextSendMessage(text=response_text)
+
+    def _availability_precheck(self, line_user_id, dates_info, authenticated):
+        """空き時間確認の前提条件（満たしていない場合は案内メッセージ、満たしていればNone）"""
+        if not authenticated:
+            logger.debug("ユーザー認証未完了")
+            return self._send_auth_guide(line_user_id)
+
+        if not self.calendar_service:
+            logger.debug("カレンダーサービス未初期化")
+            return TextSendMessage(text="Google Calendarサービスが初期化されていません。認証ファイルを確認してください。")
+
+        if not self.ai_service:
+            logger.debug("AIサービス未初期化")
+            return TextSendMessage(text="AIサービスが初期化されていません。")
+
+        if not dates_info:
+            logger.debug("dates_infoが空")
+            return TextSendMessage(text="日付を正しく認識できませんでした。\n\n例: 「明日7/7 15:00〜15:30の空き時間を教えて」")
+        return None
+
+    def _availability_window(self, date_str, start_time, end_time):
+        """空き時間確認の枠（JST）"""
+        start_dt = self.jst.localize(datetime.strptime(f"{date_str} {start_time}", "%Y-%m-%d %H:%M"))
+        end_dt = self.jst.localize(datetime.strptime(f"{date_str} {end_time}", "%Y-%m-%d %H:%M"))
+        return start_dt, end_dt
+
+    def _free_slots_frame(self, date_str, start_time, end_time, events):
+        """枠と8:00〜22:00の重なり部分で空き時間を計算します"""
+        day_start = "08:00"
+        day_end = "22:00"
+        # 枠の範囲と8:00〜22:00の重なり部分だけを対象にする
+        slot_start = max(start_time, day_start)
+        slot_end = min(end_time, day_end)
+
+        logger.debug("%sのスロット範囲: slot_start=%s, slot_end=%s", date_str, slot_start, slot_end)
+
+        slot_start_dt, slot_end_dt = self._availability_window(date_str, slot_start, slot_end)
+
+        if slot_start < slot_end:
+            free_slots = self.calendar_service.find_free_slots_for_day(slot_start_dt, slot_end_dt, events)
+            logger.debug("%sの空き時間結果: %s", date_str, free_slots)
+        else:
+            logger.debug("%sのスロット範囲が無効: %s >= %s", date_str, slot_start, slot_end)
+            free_slots = []
+
+        return {
+            'date': date_str,
+            'start_time': slot_start,
+            'end_time': slot_end,
+            'free_slots': free_slots
+        }
+
     def _handle_availability_check(self, dates_info, line_user_id):
         """空き時間確認を処理します"""
         try:
-            print(f"[DEBUG] _handle_availability_check開始")
-            print(f"[DEBUG] dates_info: {dates_info}")
-            print(f"[DEBUG] line_user_id: {line_user_id}")
-            
+            logger.debug("_handle_availability_check開始")
+            logger.debug("dates_info: %s", dates_info)
+            logger.debug("line_user_id: %s", line_user_id)
+
             # ユーザーの認証状態をチェック
-            if not self._check_user_auth(line_user_id):
-                print(f"[DEBUG] ユーザー認証未完了")
-                return self._send_auth_guide(line_user_id)
-            
-            if not self.calendar_service:
-                print(f"[DEBUG] カレンダーサービス未初期化")
-                return TextSendMessage(text="Google Calendarサービスが初期化されていません。認証ファイルを確認してください。")
-            
-            if not self.ai_service:
-                print(f"[DEBUG] AIサービス未初期化")
-                return TextSendMessage(text="AIサービスが初期化されていません。")
-            
-            if not dates_info:
-                print(f"[DEBUG] dates_infoが空")
-                return TextSendMessage(text="日付を正しく認識できませんでした。\n\n例: 「明日7/7 15:00〜15:30の空き時間を教えて」")
-            
-            print(f"[DEBUG] 空き時間計算開始")
+            precheck = self._availability_precheck(line_user_id, dates_info, self._check_user_auth(line_user_id))
+            if precheck:
+                return precheck
+
+            logger.debug("空き時間計算開始")
             free_slots_by_frame = []
             for i, date_info in enumerate(dates_info):
-                print(f"[DEBUG] 日付{i+1}処理開始: {date_info}")
+                logger.debug("日付%s処理開始: %s", i+1, date_info)
                 date_str = date_info.get('date')
                 start_time = date_info.get('time')
                 end_time = date_info.get('end_time')
-                
-                print(f"[DEBUG] 日付{i+1}の抽出値: date={date_str}, start_time={start_time}, end_time={end_time}")
-                
+
                 if date_str and start_time and end_time:
                     try:
-                        jst = pytz.timezone('Asia/Tokyo')
-                        start_dt = jst.localize(datetime.strptime(f"{date_str} {start_time}", "%Y-%m-%d %H:%M"))
-                        end_dt = jst.localize(datetime.strptime(f"{date_str} {end_time}", "%Y-%m-%d %H:%M"))
-                        
-                        print(f"[DEBUG] 日付{i+1}のdatetime: start_dt={start_dt}, end_dt={end_dt}")
-                        
+                        start_dt, end_dt = self._availability_window(date_str, start_time, end_time)
+
                         # 枠内の予定を取得
-                        print(f"[DEBUG] 日付{i+1}の予定取得開始")
                         events = self.calendar_service.get_events_for_time_range(start_dt, end_dt, line_user_id)
-                        print(f"[DEBUG] 日付{i+1}の取得予定: {events}")
-                        
-                        # 8:00〜22:00の間で空き時間を返す
-                        day_start = "08:00"
-                        day_end = "22:00"
-                        # 枠の範囲と8:00〜22:00の重なり部分だけを対象にする
-                        slot_start = max(start_time, day_start)
-                        slot_end = min(end_time, day_end)
-                        
-                        print(f"[DEBUG] 日付{i+1}のスロット範囲: slot_start={slot_start}, slot_end={slot_end}")
-                        
-                        slot_start_dt = jst.localize(datetime.strptime(f"{date_str} {slot_start}", "%Y-%m-%d %H:%M"))
-                        slot_end_dt = jst.localize(datetime.strptime(f"{date_str} {slot_end}", "%Y-%m-%d %H:%M"))
-                        
-                        print(f"[DEBUG] 日付{i+1}のスロットdatetime: slot_start_dt={slot_start_dt}, slot_end_dt={slot_end_dt}")
-                        
-                        if slot_start < slot_end:
-                            print(f"[DEBUG] 日付{i+1}の空き時間計算開始")
-                            free_slots = self.calendar_service.find_free_slots_for_day(slot_start_dt, slot_end_dt, events)
-                            print(f"[DEBUG] 日付{i+1}の空き時間結果: {free_slots}")
-                        else:
-                            print(f"[DEBUG] 日付{i+1}のスロット範囲が無効: {slot_start} >= {slot_end}")
-                            free_slots = []
-                        
-                        free_slots_by_frame.append({
-                            'date': date_str,
-                            'start_time': slot_start,
-                            'end_time': slot_end,
-                            'free_slots': free_slots
-                        })
-                        print(f"[DEBUG] 日付{i+1}のfree_slots_by_frame追加完了")
-                        
+                        logger.debug("日付%sの取得予定: %s", i+1, events)
+
+                        free_slots_by_frame.append(self._free_slots_frame(date_str, start_time, end_time, events))
+
+                    except DeadlineExceeded:
+                        raise
                     except Exception as e:
-                        print(f"[DEBUG] 日付{i+1}処理でエラー: {e}")
-                        import traceback
-                        traceback.print_exc()
+                        logger.exception("日付%s処理でエラー: %s", i+1, e)
                         # エラーが発生しても他の日付は処理を続行
                         free_slots_by_frame.append({
                             'date': date_str,
@@ -527,22 +797,62 @@ class LineBotHandler:
                             'free_slots': []
                         })
                 else:
-                    print(f"[DEBUG] 日付{i+1}の必須項目が不足: date_str={date_str}, start_time={start_time}, end_time={end_time}")
-            
-            print(f"[DEBUG] 全日付処理完了、free_slots_by_frame: {free_slots_by_frame}")
-            
-            print(f"[DEBUG] format_free_slots_response_by_frame呼び出し")
+                    logger.debug("日付%sの必須項目が不足: date_str=%s, start_time=%s, end_time=%s", i+1, date_str, start_time, end_time)
+
+            logger.debug("全日付処理完了、free_slots_by_frame: %s", free_slots_by_frame)
+
             response_text = self.ai_service.format_free_slots_response_by_frame(free_slots_by_frame)
-            print(f"[DEBUG] レスポンス生成完了: {response_text}")
-            
+            logger.debug("レスポンス生成完了: %s", response_text)
+
             return TextSendMessage(text=response_text)
-            
+
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            print(f"[DEBUG] _handle_availability_checkで例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("_handle_availability_checkで例外発生: %s", e)
             return TextSendMessage(text=f"空き時間確認でエラーが発生しました: {str(e)}")
-    
+
+    async def _handle_availability_check_async(self, dates_info, line_user_id):
+        """_handle_availability_checkの非同期版（枠ごとの予定取得は並行して行う）"""
+        try:
+            authenticated = await asyncio.to_thread(self._check_user_auth, line_user_id)
+            if not authenticated:
+                return await asyncio.to_thread(self._send_auth_guide, line_user_id)
+            precheck = self._availability_precheck(line_user_id, dates_info, authenticated)
+            if precheck:
+                return precheck
+
+            access_token = await self.calendar_service.get_access_token_async(line_user_id)
+
+            async def frame(date_str, start_time, end_time):
+                try:
+                    start_dt, end_dt = self._availability_window(date_str, start_time, end_time)
+                    events = await self.calendar_service.get_events_for_time_range_async(
+                        start_dt, end_dt, line_user_id, access_token
+                    )
+                    return self._free_slots_frame(date_str, start_time, end_time, events)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    logger.exception(f"空き時間確認の枠の処理でエラー: {date_str} {e}")
+                    # エラーが発生しても他の日付は処理を続行
+                    return {'date': date_str, 'start_time': start_time, 'end_time': end_time, 'free_slots': []}
+
+            frames = [
+                (date_info.get('date'), date_info.get('time'), date_info.get('end_time'))
+                for date_info in dates_info
+                if date_info.get('date') and date_info.get('time') and date_info.get('end_time')
+            ]
+            free_slots_by_frame = await asyncio.gather(*(frame(*args) for args in frames))
+            response_text = self.ai_service.format_free_slots_response_by_frame(list(free_slots_by_frame))
+            return TextSendMessage(text=response_text)
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.exception(f"空き時間確認でエラーが発生しました: {e}")
+            return TextSendMessage(text=f"空き時間確認でエラーが発生しました: {str(e)}")
+
     def _handle_event_addition(self, user_message, line_user_id):
         """イベント追加を処理します"""
         try:
@@ -584,7 +894,7 @@ class LineBotHandler:
                 line_user_id=line_user_id,
                 force_add=True
             )
-            logger.info(f"[DEBUG] add_event result: success={success}, message={message}, result={result}")
+            logger.debug("add_event result: success=%s, message=%s, result=%s", success, message, result)
             
             # AIを使ってレスポンスをフォーマット
             response_text = self.ai_service.format_event_confirmation(success, message, result)
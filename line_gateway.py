@@ -0,0 +1,510 @@
+"""
+LINEへのメッセージ送信（reply / push）をまとめて扱うゲートウェイ
+- LINE APIのエンドポイントごとにトークンバケットで送信レートを制限する
+- pushには X-Line-Retry-Key を付け、同じキーでリトライする（受付済みを示す409は成功扱い）
+- replyの一時的なエラーはバックグラウンドでリトライし、呼び出し元を待たせない
+- reply tokenが失効していた場合はpushで送り直す
+- 時間がかかる処理の間はチャットに読み込み中アニメーションを表示する（start_loading）
+- 送信時間・結果ごとの件数をメトリクスに記録する
+
+LineGatewayは同期版（Flask / 日次予定送信）、AsyncLineGatewayはlinebot.v3の非同期クライアントを使う版（asgi.py）。
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+
+from config import Config
+from http_clients import SessionHttpClient
+from tracing import span
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SEND_DURATION_MS = registry.histogram('line_send_duration_ms', 'LINE APIへの送信時間（ミリ秒、endpoint別）')
+SENDS = registry.counter('line_sends_total', 'LINE APIへの送信数（endpoint / result別）')
+SEND_RETRIES = registry.counter('line_send_retries_total', 'LINE APIへの送信のリトライ数（endpoint別）')
+REPLY_FALLBACKS = registry.counter('line_reply_fallbacks_total', 'reply tokenの失効でpushに切り替えた送信数')
+RATE_LIMIT_WAIT_MS = registry.histogram('line_rate_limit_wait_ms', '送信レート制限で待った時間（ミリ秒、endpoint別）')
+DEFERRED_RESPONSES = registry.counter('line_deferred_responses_total', 'REPLY_DEADLINE_SECONDS内に処理が終わらずpushで送った応答数')
+
+INVALID_REPLY_TOKEN = 'Invalid reply token'
+
+# 読み込み中アニメーション（1対1のチャットのみ）
+LOADING_ENDPOINT = 'https://api.line.me/v2/bot/chat/loading/start'
+
+# 時間をおけば成功する可能性がある通信エラー
+TRANSPORT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    ConnectionError, TimeoutError, asyncio.TimeoutError)
+
+
+class TokenBucket:
+    """トークンバケットによる送信レート制限（rate: 1秒あたりの補充数、0以下で無制限）"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """トークンを1つ取り出す。取り出せなければ補充までの秒数を返す（取り出せたら0）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """トークンを1つ取り出す（なければ補充されるまで待つ）。待った秒数を返す"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            delay = self._take()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self):
+        """acquireの非同期版（イベントループを止めずに待つ）"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            delay = self._take()
+            if not delay:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+class DelayedExecutor:
+    """指定した秒数後に関数をスレッドプールで実行する（リトライ待ちでスレッドを占有しない）"""
+
+    def __init__(self, max_workers, name):
+        self.max_workers = max_workers
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+
+    def schedule(self, delay, fn, *args):
+        with self._cond:
+            if self._executor is None:
+                # gunicornのfork後に使われたプロセスでスレッドを開始する
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                threading.Thread(target=self._run, name=f'{self.name}-scheduler', daemon=True).start()
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), fn, args))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                _, _, fn, args = heapq.heappop(self._heap)
+            self._executor.submit(fn, *args)
+
+
+def _status(error):
+    """LINE APIのHTTPステータス（v2のLineBotApiError・v3のApiException、それ以外はNone）"""
+    if isinstance(error, LineBotApiError):
+        return error.status_code
+    status = getattr(error, 'status', None)
+    return status if isinstance(status, int) else None
+
+
+def _transport_errors():
+    # aiohttpは非同期版を使うプロセスでのみ読み込まれる
+    aiohttp = sys.modules.get('aiohttp')
+    return TRANSPORT_ERRORS + (aiohttp.ClientConnectionError,) if aiohttp else TRANSPORT_ERRORS
+
+
+def is_transient(error):
+    """時間をおけば成功する可能性があるエラーか（レート制限・サーバーエラー・通信エラー）"""
+    status = _status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, _transport_errors())
+
+
+def _may_have_been_delivered(error):
+    """送信が相手に届いていた可能性があるエラーか（429は受け付けられていない）"""
+    return is_transient(error) and _status(error) != 429
+
+
+def _is_invalid_reply_token(error):
+    if _status(error) != 400:
+        return False
+    message = getattr(getattr(error, 'error', None), 'message', None) or str(error)
+    return INVALID_REPLY_TOKEN in message
+
+
+def _result_label(error):
+    status = _status(error)
+    if status == 409:
+        return 'accepted'
+    if status == 429:
+        return 'rate_limited'
+    if is_transient(error):
+        return 'transient'
+    return 'error'
+
+
+def _backoff(attempt):
+    base = Config.LINE_SEND_RETRY_BASE_SECONDS
+    return base * (2 ** attempt) + random.uniform(0, base)
+
+
+def _push_retry_delay(to, error, attempt):
+    """pushを再試行するまでの秒数（再試行しない場合はNone）"""
+    attempts = Config.LINE_SEND_MAX_ATTEMPTS
+    if attempt == attempts - 1 or not is_transient(error):
+        return None
+    delay = _backoff(attempt)
+    SEND_RETRIES.inc(endpoint='push')
+    logger.warning(f"ユーザー {to} へのプッシュで一時的なエラー (試行 {attempt + 1}/{attempts})、{delay:.1f}秒後にリトライ: {error}")
+    return delay
+
+
+def _reply_failure_plan(reply_token, to, error, attempt, maybe_delivered):
+    """replyが失敗した後の処理を決める
+
+    ('push', retry_key): reply tokenが失効していたためpushで送り直す
+    ('retry', delay): delay秒後にreplyを再試行する
+    None: 諦める（ログに記録済み）
+    """
+    if _is_invalid_reply_token(error):
+        if maybe_delivered:
+            # 前回の送信が届いてreply tokenが使用済みになった可能性があるため、重複を避けてpushしない
+            logger.warning(f"ユーザー {to} のreply tokenは使用済みでした（前回の送信が届いていた可能性があります）")
+            return None
+        if not to:
+            logger.error(f"reply tokenが失効しており、送信先が不明なためpushできません: {error}")
+            return None
+        REPLY_FALLBACKS.inc()
+        logger.info(f"ユーザー {to} のreply tokenが失効していたためpushで送信します")
+        return 'push', str(uuid.uuid5(uuid.NAMESPACE_URL, f'line-reply/{reply_token}'))
+    attempts = Config.LINE_SEND_MAX_ATTEMPTS
+    if is_transient(error) and attempt + 1 < attempts:
+        delay = _backoff(attempt)
+        SEND_RETRIES.inc(endpoint='reply')
+        logger.warning(f"ユーザー {to} へのreplyで一時的なエラー (試行 {attempt + 1}/{attempts})、{delay:.1f}秒後にリトライ: {error}")
+        return 'retry', delay
+    logger.error(f"ユーザー {to} へのreply送信に失敗しました: {error}")
+    return None
+
+
+def loading_seconds(seconds):
+    """読み込み中アニメーションの表示秒数（5〜60秒の5の倍数に切り上げる）"""
+    return min(60, max(5, -(-int(seconds) // 5) * 5))
+
+
+def deferred_retry_key(reply_token):
+    """期限を過ぎてpushで送る応答のX-Line-Retry-Key（同じイベントの応答は1回だけ届く）"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'line-deferred/{reply_token}'))
+
+
+def _record_send(endpoint, started, error=None):
+    SEND_DURATION_MS.observe((time.perf_counter() - started) * 1000, endpoint=endpoint)
+    SENDS.inc(endpoint=endpoint, result=_result_label(error) if error else 'ok')
+
+
+class LineGateway:
+    """LINEへの送信をレート制限・リトライ付きで行う（get_gateway()でプロセスごとに共有する）"""
+
+    def __init__(self, line_bot_api):
+        self.line_bot_api = line_bot_api
+        self._buckets = {
+            'reply': TokenBucket(Config.LINE_REPLY_RATE_PER_SECOND),
+            'push': TokenBucket(Config.LINE_PUSH_RATE_PER_SECOND),
+            'loading': TokenBucket(Config.LINE_REPLY_RATE_PER_SECOND),
+        }
+        self._background = DelayedExecutor(Config.LINE_SEND_WORKERS, 'line-send')
+
+    def _call(self, endpoint, send, attempt=0):
+        """レート制限を守って1回送信し、時間と結果を記録する"""
+        with span('line', endpoint, attempt=attempt) as s:
+            waited = self._buckets[endpoint].acquire()
+            if waited:
+                RATE_LIMIT_WAIT_MS.observe(waited * 1000, endpoint=endpoint)
+                s.set('rate_limit_wait_ms', round(waited * 1000, 1))
+            started = time.perf_counter()
+            try:
+                send()
+            except Exception as e:
+                _record_send(endpoint, started, e)
+                raise
+            _record_send(endpoint, started)
+
+    # --- push ---
+    def push(self, to, messages, retry_key=None):
+        """pushで送信する（呼び出し元で完了を待つ）
+
+        一時的なエラーは同じX-Line-Retry-Keyで指数バックオフしながらリトライするため、
+        LINE側で受付済みだった送信が重複することはない。最後まで失敗した場合は例外を送出する。
+        """
+        retry_key = retry_key or str(uuid.uuid4())
+        for attempt in range(Config.LINE_SEND_MAX_ATTEMPTS):
+            try:
+                self._call('push', lambda: self.line_bot_api.push_message(to, messages, retry_key=retry_key), attempt)
+                return
+            except Exception as e:
+                if _status(e) == 409:
+                    logger.info(f"ユーザー {to} へのプッシュは受付済みでした（409）")
+                    return
+                delay = _push_retry_delay(to, e, attempt)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    def _push_in_background(self, to, messages, retry_key):
+        try:
+            self.push(to, messages, retry_key)
+        except Exception as e:
+            logger.error(f"ユーザー {to} へのプッシュ送信に失敗しました: {e}")
+
+    def push_deferred(self, to, reply_token, messages):
+        """期限内に返信できなかった応答をpushで送る（失敗はログに記録する）"""
+        DEFERRED_RESPONSES.inc()
+        self._push_in_background(to, messages, deferred_retry_key(reply_token))
+
+    # --- 読み込み中アニメーション ---
+    def start_loading(self, chat_id, seconds):
+        """読み込み中アニメーションをバックグラウンドで表示する（応答を送るか、seconds秒経つと消える）"""
+        self._background.schedule(0, self._start_loading, chat_id, loading_seconds(seconds))
+
+    def _start_loading(self, chat_id, seconds):
+        try:
+            # 固定しているSDKのバージョンには専用のメソッドがないため、認証・エラー処理付きの_postで呼ぶ
+            self._call('loading', lambda: self.line_bot_api._post(
+                '/v2/bot/chat/loading/start',
+                data=json.dumps({'chatId': chat_id, 'loadingSeconds': seconds}),
+                timeout=Config.LINE_API_TIMEOUT_SECONDS
+            ))
+        except Exception as e:
+            logger.warning(f"ユーザー {chat_id} の読み込み中アニメーションを表示できませんでした: {e}")
+
+    # --- reply ---
+    def reply(self, reply_token, to, messages):
+        """replyで送信する。最初の送信で届いた場合はTrueを返す
+
+        一時的なエラーはバックグラウンドでリトライし、呼び出し元は待たせない。
+        reply tokenが失効していた場合はtoへpushで送り直す（X-Line-Retry-Keyはreply tokenから作るため、
+        pushのリトライでも重複しない）。
+        """
+        try:
+            self._call('reply', lambda: self.line_bot_api.reply_message(reply_token, messages))
+            return True
+        except Exception as e:
+            self._after_reply_failure(reply_token, to, messages, e, attempt=0, maybe_delivered=False)
+            return False
+
+    def _retry_reply(self, reply_token, to, messages, attempt, maybe_delivered):
+        """replyを再送する（attemptはこの送信の0始まりの試行番号。pushと同じ数え方）"""
+        try:
+            self._call('reply', lambda: self.line_bot_api.reply_message(reply_token, messages), attempt)
+            logger.info(f"ユーザー {to} へのreplyをリトライで送信しました（試行 {attempt + 1}）")
+        except Exception as e:
+            self._after_reply_failure(reply_token, to, messages, e, attempt, maybe_delivered)
+
+    def _after_reply_failure(self, reply_token, to, messages, error, attempt, maybe_delivered):
+        plan = _reply_failure_plan(reply_token, to, error, attempt, maybe_delivered)
+        if plan is None:
+            return
+        action, value = plan
+        if action == 'push':
+            self._background.schedule(0, self._push_in_background, to, messages, value)
+        else:
+            self._background.schedule(
+                value, self._retry_reply, reply_token, to, messages, attempt + 1,
+                maybe_delivered or _may_have_been_delivered(error)
+            )
+
+
+class AsyncLineGateway:
+    """LineGatewayの非同期版（linebot.v3のAsyncMessagingApiを使い、接続プールはイベントループ内で共有する）
+
+    asgi.pyの起動時にイベントループ内で作成し、終了時にaclose()で閉じる。
+    """
+
+    def __init__(self):
+        from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration
+        import aiohttp
+        self.api_client = AsyncApiClient(Configuration(access_token=Config.LINE_CHANNEL_ACCESS_TOKEN))
+        self.messaging_api = AsyncMessagingApi(self.api_client)
+        # 読み込み中アニメーションは固定しているSDKのバージョンにないため直接呼び出す
+        self._http = aiohttp.ClientSession(
+            headers={'Authorization': f'Bearer {Config.LINE_CHANNEL_ACCESS_TOKEN}'},
+            timeout=aiohttp.ClientTimeout(total=Config.LINE_API_TIMEOUT_SECONDS),
+            raise_for_status=True
+        )
+        self._buckets = {
+            'reply': TokenBucket(Config.LINE_REPLY_RATE_PER_SECOND),
+            'push': TokenBucket(Config.LINE_PUSH_RATE_PER_SECOND),
+            'loading': TokenBucket(Config.LINE_REPLY_RATE_PER_SECOND),
+        }
+        self._tasks = set()
+
+    async def aclose(self):
+        """バックグラウンドのリトライを止めて接続を閉じる"""
+        for task in list(self._tasks):
+            task.cancel()
+        await self.api_client.close()
+        await self._http.close()
+
+    def _messages(self, messages):
+        """v2のメッセージ（TextSendMessageなど）をv3のメッセージに変換する"""
+        from linebot.v3.messaging import Message
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        return [m if isinstance(m, Message) else Message.from_dict(m.as_json_dict()) for m in messages]
+
+    def _schedule(self, delay, send, *args):
+        """delay秒後にsend(*args)をバックグラウンドで実行する"""
+        async def run():
+            await asyncio.sleep(delay)
+            await send(*args)
+        task = asyncio.get_running_loop().create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _call(self, endpoint, send, attempt=0):
+        """レート制限を守って1回送信し、時間と結果を記録する"""
+        with span('line', endpoint, attempt=attempt) as s:
+            waited = await self._buckets[endpoint].acquire_async()
+            if waited:
+                RATE_LIMIT_WAIT_MS.observe(waited * 1000, endpoint=endpoint)
+                s.set('rate_limit_wait_ms', round(waited * 1000, 1))
+            started = time.perf_counter()
+            try:
+                await send()
+            except Exception as e:
+                _record_send(endpoint, started, e)
+                raise
+            _record_send(endpoint, started)
+
+    # --- push ---
+    async def push(self, to, messages, retry_key=None):
+        """LineGateway.pushの非同期版"""
+        from linebot.v3.messaging import PushMessageRequest
+        retry_key = retry_key or str(uuid.uuid4())
+        request = PushMessageRequest(to=to, messages=self._messages(messages))
+        for attempt in range(Config.LINE_SEND_MAX_ATTEMPTS):
+            try:
+                await self._call('push', lambda: self.messaging_api.push_message(
+                    request, x_line_retry_key=retry_key, _request_timeout=Config.LINE_API_TIMEOUT_SECONDS
+                ), attempt)
+                return
+            except Exception as e:
+                if _status(e) == 409:
+                    logger.info(f"ユーザー {to} へのプッシュは受付済みでした（409）")
+                    return
+                delay = _push_retry_delay(to, e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def _push_in_background(self, to, messages, retry_key):
+        try:
+            await self.push(to, messages, retry_key)
+        except Exception as e:
+            logger.error(f"ユーザー {to} へのプッシュ送信に失敗しました: {e}")
+
+    async def push_deferred(self, to, reply_token, messages):
+        """LineGateway.push_deferredの非同期版"""
+        DEFERRED_RESPONSES.inc()
+        await self._push_in_background(to, messages, deferred_retry_key(reply_token))
+
+    # --- 読み込み中アニメーション ---
+    def start_loading(self, chat_id, seconds):
+        """LineGateway.start_loadingの非同期版（イベントループ上のタスクで表示する）"""
+        self._schedule(0, self._start_loading, chat_id, loading_seconds(seconds))
+
+    async def _start_loading(self, chat_id, seconds):
+        async def send():
+            async with self._http.post(LOADING_ENDPOINT, json={'chatId': chat_id, 'loadingSeconds': seconds}):
+                pass
+        try:
+            await self._call('loading', send)
+        except Exception as e:
+            logger.warning(f"ユーザー {chat_id} の読み込み中アニメーションを表示できませんでした: {e}")
+
+    # --- reply ---
+    async def _send_reply(self, reply_token, messages, attempt=0):
+        from linebot.v3.messaging import ReplyMessageRequest
+        request = ReplyMessageRequest(reply_token=reply_token, messages=self._messages(messages))
+        await self._call('reply', lambda: self.messaging_api.reply_message(
+            request, _request_timeout=Config.LINE_API_TIMEOUT_SECONDS
+        ), attempt)
+
+    async def reply(self, reply_token, to, messages):
+        """LineGateway.replyの非同期版（リトライ・pushへの切り替えはイベントループ上のタスクで行う）"""
+        try:
+            await self._send_reply(reply_token, messages)
+            return True
+        except Exception as e:
+            self._after_reply_failure(reply_token, to, messages, e, attempt=0, maybe_delivered=False)
+            return False
+
+    async def _retry_reply(self, reply_token, to, messages, attempt, maybe_delivered):
+        """replyを再送する（attemptはこの送信の0始まりの試行番号。pushと同じ数え方）"""
+        try:
+            await self._send_reply(reply_token, messages, attempt)
+            logger.info(f"ユーザー {to} へのreplyをリトライで送信しました（試行 {attempt + 1}）")
+        except Exception as e:
+            self._after_reply_failure(reply_token, to, messages, e, attempt, maybe_delivered)
+
+    def _after_reply_failure(self, reply_token, to, messages, error, attempt, maybe_delivered):
+        plan = _reply_failure_plan(reply_token, to, error, attempt, maybe_delivered)
+        if plan is None:
+            return
+        action, value = plan
+        if action == 'push':
+            self._schedule(0, self._push_in_background, to, messages, value)
+        else:
+            self._schedule(
+                value, self._retry_reply, reply_token, to, messages, attempt + 1,
+                maybe_delivered or _may_have_been_delivered(error)
+            )
+
+
+_shared_gateway = None
+_shared_gateway_pid = None
+_shared_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """プロセスで共有するLineGatewayを返す（送信レート制限はプロセス内の全送信で共有する）"""
+    global _shared_gateway, _shared_gateway_pid
+    pid = os.getpid()
+    if _shared_gateway is not None and _shared_gateway_pid == pid:
+        return _shared_gateway
+    with _shared_gateway_lock:
+        if _shared_gateway is None or _shared_gateway_pid != pid:
+            line_bot_api = LineBotApi(
+                Config.LINE_CHANNEL_ACCESS_TOKEN, timeout=Config.LINE_API_TIMEOUT_SECONDS, http_client=SessionHttpClient
+            )
+            _shared_gateway = LineGateway(line_bot_api)
+            _shared_gateway_pid = pid
+        return _shared_gateway
@@ -0,0 +1,117 @@
+"""
+ログの設定（configure_loggingをプロセスの起動時に1回呼ぶ）
+- レベル: 全体は LOG_LEVEL、モジュールごとは LOG_LEVELS（例: "calendar_service=DEBUG,linebot=WARNING"）
+- 出力: ログはキュー（QueueHandler）に入れ、別スレッド（QueueListener）が標準エラーに書き出す。
+  キューが満杯のときは呼び出し元を待たせずに捨て、log_records_dropped_totalに記録する
+- 形式: LOG_FORMAT=text（既定）または json（1行1レコード）
+- DEBUGログのサンプリング: Webhookのリクエストごとに LOG_DEBUG_SAMPLE_RATE の確率で、
+  そのリクエストのDEBUGログをまとめて出力するか決める（start_log_sampling）
+
+ホットパスのログは logger.debug("...%s", value) のように引数を渡して書く（DEBUGが無効なら文字列を作らない）。
+引数の計算自体が重い場合は logger.isEnabledFor(logging.DEBUG) で囲む。
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from config import Config
+from metrics import registry
+
+DROPPED_RECORDS = registry.counter('log_records_dropped_total', 'キューが満杯のため捨てたログの数')
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# このリクエストのDEBUGログを出力するか（リクエスト外ではNone＝すべて出力）
+_debug_sampled = contextvars.ContextVar('log_debug_sampled', default=None)
+
+_queue_handler = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DebugSamplingFilter(logging.Filter):
+    """サンプリングで外れたリクエストのDEBUGログを捨てる"""
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or _debug_sampled.get() is not False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """キューが満杯のときは待たずに捨てるQueueHandler"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+def start_log_sampling():
+    """このコンテキスト（リクエスト）のDEBUGログを出力するか決める（Webhookのリクエスト開始時に呼ぶ）"""
+    _debug_sampled.set(random.random() < Config.LOG_DEBUG_SAMPLE_RATE)
+
+
+def parse_levels(spec):
+    """LOG_LEVELSの "name=LEVEL,name=LEVEL" を {name: LEVEL} にする"""
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _start_listener():
+    """出力先のハンドラとキューを作り、書き出しスレッドを開始する"""
+    global _listener
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if Config.LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    _queue_handler.queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    _listener = QueueListener(_queue_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def configure_logging():
+    """ルートロガーにキュー経由の出力を設定する（2回目以降の呼び出しでは何もしない）"""
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+    root = logging.getLogger()
+    root.setLevel(Config.LOG_LEVEL.upper())
+    for name, level in parse_levels(Config.LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue())
+    _queue_handler.addFilter(DebugSamplingFilter())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    _start_listener()
+    atexit.register(_stop_listener)
+    # 書き出しスレッドはforkで引き継がれないため、fork後のプロセス（gunicornのワーカー）で作り直す
+    os.register_at_fork(after_in_child=_start_listener)
@@ -0,0 +1,431 @@
+"""
+データベースのスキーママイグレーション
+schema_migrations テーブルに適用済みのバージョンを記録し、未適用のマイグレーションを番号順に1つずつ
+トランザクション内で適用する。デプロイ時に `python db.py init` から実行される。
+"""
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQLで複数プロセスが同時にマイグレーションしないためのアドバイザリロックのキー
+MIGRATION_LOCK_KEY = 723401
+
+
+def _baseline(c, is_postgres):
+    """v1: 初期テーブル（日時はISO形式のTEXT）"""
+    if is_postgres:
+        # PostgreSQL: SERIAL型やIF NOT EXISTSの書き方に注意
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                line_user_id TEXT PRIMARY KEY,
+                google_token BYTEA,
+                created_at TEXT,
+                updated_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS onetimes (
+                code TEXT PRIMARY KEY,
+                line_user_id TEXT,
+                expires_at TEXT,
+                used INTEGER DEFAULT 0,
+                created_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pending_events (
+                line_user_id TEXT PRIMARY KEY,
+                event_json TEXT,
+                created_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS oauth_states (
+                state TEXT PRIMARY KEY,
+                line_user_id TEXT,
+                created_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT,
+                total INTEGER DEFAULT 0,
+                done INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TEXT,
+                started_at TEXT,
+                finished_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_tasks (
+                run_id TEXT,
+                line_user_id TEXT,
+                status TEXT DEFAULT 'pending',
+                lease_owner TEXT,
+                lease_expires_at TEXT,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (run_id, line_user_id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_agenda_tasks_run_status ON agenda_tasks (run_id, status)')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS reauth_notices (
+                line_user_id TEXT PRIMARY KEY,
+                code TEXT,
+                last_sent_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_task_metrics (
+                run_id TEXT,
+                line_user_id TEXT,
+                credential_load_ms INTEGER,
+                calendar_fetch_ms INTEGER,
+                render_ms INTEGER,
+                push_ms INTEGER,
+                total_ms INTEGER,
+                error_class TEXT,
+                PRIMARY KEY (run_id, line_user_id)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_run_reports (
+                job_id TEXT PRIMARY KEY,
+                report_json TEXT,
+                created_at TEXT
+            )
+        ''')
+    else:
+        # SQLite
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                line_user_id TEXT PRIMARY KEY,
+                google_token BLOB,
+                created_at TEXT,
+                updated_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS onetimes (
+                code TEXT PRIMARY KEY,
+                line_user_id TEXT,
+                expires_at TEXT,
+                used INTEGER DEFAULT 0,
+                created_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pending_events (
+                line_user_id TEXT PRIMARY KEY,
+                event_json TEXT,
+                created_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS oauth_states (
+                state TEXT PRIMARY KEY,
+                line_user_id TEXT,
+                created_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT,
+                total INTEGER DEFAULT 0,
+                done INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TEXT,
+                started_at TEXT,
+                finished_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_tasks (
+                run_id TEXT,
+                line_user_id TEXT,
+                status TEXT DEFAULT 'pending',
+                lease_owner TEXT,
+                lease_expires_at TEXT,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (run_id, line_user_id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_agenda_tasks_run_status ON agenda_tasks (run_id, status)')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS reauth_notices (
+                line_user_id TEXT PRIMARY KEY,
+                code TEXT,
+                last_sent_at TEXT
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_task_metrics (
+                run_id TEXT,
+                line_user_id TEXT,
+                credential_load_ms INTEGER,
+                calendar_fetch_ms INTEGER,
+                render_ms INTEGER,
+                push_ms INTEGER,
+                total_ms INTEGER,
+                error_class TEXT,
+                PRIMARY KEY (run_id, line_user_id)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS agenda_run_reports (
+                job_id TEXT PRIMARY KEY,
+                report_json TEXT,
+                created_at TEXT
+            )
+        ''')
+
+
+# 日時型に変換する列（v2。users・reauth_noticesはv6で変換する）
+TYPED_TIMESTAMP_COLUMNS = {
+    'onetimes': ('expires_at', 'created_at'),
+    'oauth_states': ('created_at',),
+    'pending_events': ('created_at',),
+}
+
+
+def _typed_timestamps(c, is_postgres):
+    """v2: 有効期限・作成日時をTEXTから日時型に変換
+
+    PostgreSQLはtimestamptz、SQLiteはUTCのエポック秒（INTEGER）。
+    既存の値はUTCとして変換する。
+    """
+    if is_postgres:
+        for table, columns in TYPED_TIMESTAMP_COLUMNS.items():
+            for column in columns:
+                c.execute(f'''
+                    ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamptz
+                    USING (NULLIF({column}, '')::timestamp AT TIME ZONE 'UTC')
+                ''')
+    else:
+        # SQLiteは列の型を変更できないため、テーブルを作り直して値を移す
+        c.execute('ALTER TABLE onetimes RENAME TO onetimes_old')
+        c.execute('''
+            CREATE TABLE onetimes (
+                code TEXT PRIMARY KEY,
+                line_user_id TEXT,
+                expires_at INTEGER,
+                used INTEGER DEFAULT 0,
+                created_at INTEGER
+            )
+        ''')
+        c.execute('''
+            INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
+            SELECT code, line_user_id, CAST(strftime('%s', expires_at) AS INTEGER), used,
+                   CAST(strftime('%s', created_at) AS INTEGER)
+            FROM onetimes_old
+        ''')
+        c.execute('DROP TABLE onetimes_old')
+
+        c.execute('ALTER TABLE oauth_states RENAME TO oauth_states_old')
+        c.execute('''
+            CREATE TABLE oauth_states (
+                state TEXT PRIMARY KEY,
+                line_user_id TEXT,
+                created_at INTEGER
+            )
+        ''')
+        c.execute('''
+            INSERT INTO oauth_states (state, line_user_id, created_at)
+            SELECT state, line_user_id, CAST(strftime('%s', created_at) AS INTEGER)
+            FROM oauth_states_old
+        ''')
+        c.execute('DROP TABLE oauth_states_old')
+
+        c.execute('ALTER TABLE pending_events RENAME TO pending_events_old')
+        c.execute('''
+            CREATE TABLE pending_events (
+                line_user_id TEXT PRIMARY KEY,
+                event_json TEXT,
+                created_at INTEGER
+            )
+        ''')
+        c.execute('''
+            INSERT INTO pending_events (line_user_id, event_json, created_at)
+            SELECT line_user_id, event_json, CAST(strftime('%s', created_at) AS INTEGER)
+            FROM pending_events_old
+        ''')
+        c.execute('DROP TABLE pending_events_old')
+
+
+def _auth_indexes(c, is_postgres):
+    """v3: ワンタイムコード・OAuth state・保留中イベントの結合用・有効期限用インデックス"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_onetimes_line_user_id ON onetimes (line_user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_onetimes_expires_at ON onetimes (expires_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_oauth_states_line_user_id ON oauth_states (line_user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_oauth_states_created_at ON oauth_states (created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_pending_events_created_at ON pending_events (created_at)')
+
+
+def _cache_invalidations(c, is_postgres):
+    """v4: プロセス間でキャッシュを無効化するための変更ログ"""
+    if is_postgres:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id BIGSERIAL PRIMARY KEY,
+                cache_name TEXT,
+                cache_key TEXT,
+                created_at timestamptz DEFAULT now()
+            )
+        ''')
+    else:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cache_name TEXT,
+                cache_key TEXT,
+                created_at INTEGER
+            )
+        ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created_at ON cache_invalidations (created_at)')
+
+
+def _postback_nonces(c, is_postgres):
+    """v5: 使用済みの確認ボタン（ポストバック）のnonce（同じボタンで予定を2回追加しない）"""
+    c.execute(f'''
+        CREATE TABLE IF NOT EXISTS postback_nonces (
+            nonce TEXT PRIMARY KEY,
+            line_user_id TEXT,
+            created_at {'timestamptz' if is_postgres else 'INTEGER'}
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_postback_nonces_created_at ON postback_nonces (created_at)')
+
+
+# 日時型に変換する列（v6。v2で漏れていたユーザー・再認証案内のテーブル）
+# agenda_jobs / agenda_tasks / agenda_task_metrics / agenda_run_reports は配信ジョブの記録で、
+# 読み書きがISO形式の文字列を前提にしている（リースの期限の比較を含む）ため変換しない
+TYPED_USER_TIMESTAMP_COLUMNS = {
+    'users': ('created_at', 'updated_at'),
+    'reauth_notices': ('last_sent_at',),
+}
+
+# v6でSQLiteのテーブルを作り直すときの定義（日時の列はINTEGER）
+_SQLITE_USER_TABLES = {
+    'users': '''
+        CREATE TABLE users (
+            line_user_id TEXT PRIMARY KEY,
+            google_token BLOB,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''',
+    'reauth_notices': '''
+        CREATE TABLE reauth_notices (
+            line_user_id TEXT PRIMARY KEY,
+            code TEXT,
+            last_sent_at INTEGER
+        )
+    ''',
+}
+
+
+def _typed_user_timestamps(c, is_postgres):
+    """v6: usersの作成・更新日時と再認証案内の送信日時をTEXTから日時型に変換（v2と同じ形式）"""
+    for table, columns in TYPED_USER_TIMESTAMP_COLUMNS.items():
+        if is_postgres:
+            for column in columns:
+                c.execute(f'''
+                    ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamptz
+                    USING (NULLIF({column}, '')::timestamp AT TIME ZONE 'UTC')
+                ''')
+            continue
+        # SQLiteは列の型を変更できないため、テーブルを作り直して値を移す
+        c.execute(f'PRAGMA table_info({table})')
+        names = [row[1] for row in c.fetchall()]
+        values = [
+            f"CAST(strftime('%s', NULLIF({name}, '')) AS INTEGER)" if name in columns else name
+            for name in names
+        ]
+        c.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+        c.execute(_SQLITE_USER_TABLES[table])
+        c.execute(f'''
+            INSERT INTO {table} ({', '.join(names)})
+            SELECT {', '.join(values)} FROM {table}_old
+        ''')
+        c.execute(f'DROP TABLE {table}_old')
+
+
+# (バージョン, 名前, 適用関数) を番号順に並べる。適用済みのものは変更しないこと
+MIGRATIONS = [
+    (1, 'baseline', _baseline),
+    (2, 'typed_timestamps', _typed_timestamps),
+    (3, 'auth_indexes', _auth_indexes),
+    (4, 'cache_invalidations', _cache_invalidations),
+    (5, 'postback_nonces', _postback_nonces),
+    (6, 'typed_user_timestamps', _typed_user_timestamps),
+]
+
+
+def _ensure_migrations_table(db):
+    def operation(c):
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TEXT
+            )
+        ''')
+
+    db._execute_with_retry(operation)
+
+
+def current_version(db):
+    """適用済みの最新バージョンを返す（未適用なら0）"""
+    def operation(c):
+        c.execute('SELECT MAX(version) FROM schema_migrations')
+        row = c.fetchone()
+        return row[0] or 0
+
+    return db._execute_with_retry(operation)
+
+
+def _apply(db, version, name, migration):
+    """1つのマイグレーションをトランザクション内で適用する。他のプロセスが適用済みならFalseを返す"""
+    def operation(c):
+        if db.is_postgres:
+            c.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_KEY,))
+            c.execute('SELECT 1 FROM schema_migrations WHERE version=%s', (version,))
+        else:
+            # SQLiteはDDLの前に暗黙のトランザクションを開始しないため明示的に開始する
+            if not c.connection.in_transaction:
+                c.execute('BEGIN IMMEDIATE')
+            c.execute('SELECT 1 FROM schema_migrations WHERE version=?', (version,))
+        if c.fetchone():
+            return False
+        migration(c, db.is_postgres)
+        now = datetime.utcnow().isoformat()
+        if db.is_postgres:
+            c.execute('INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)', (version, name, now))
+        else:
+            c.execute('INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)', (version, name, now))
+        return True
+
+    return db._execute_with_retry(operation)
+
+
+def migrate(db):
+    """未適用のマイグレーションを番号順に適用し、適用後のバージョンを返す"""
+    _ensure_migrations_table(db)
+    version = current_version(db)
+    for migration_version, name, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        if _apply(db, migration_version, name, migration):
+            logger.info(f"マイグレーションを適用しました: v{migration_version} {name}")
+        version = migration_version
+    return version
@@ -0,0 +1,95 @@
+"""
+予定の重複確認ボタン（クイックリプライのポストバック）のデータ
+- 追加・キャンセルの操作と追加する予定をデータ自体に持たせ、pending_eventsを読まずに処理できるようにする
+- LINE_CHANNEL_SECRETから作ったHMACで署名し、送信先のユーザーと有効期限（PENDING_EVENT_TTL_HOURS）を検証する
+
+データの形式: <署名（base64url）>.<JSON配列>
+  追加: ["a", 発行時刻, 開始(YYYYmmddHHMM), 終了(YYYYmmddHHMM), タイトル, 説明, 移動時間(0/1), nonce]
+  キャンセル: ["c", 発行時刻]
+
+追加のnonceはボタンごとのランダムな値で、押されたときにDB（postback_nonces）で使用済みにし、
+同じボタンを何度押しても（Webhookが再送されても）予定は1回だけ追加する。
+nonceがない以前の形式のデータは署名をnonceとして扱う。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from datetime import datetime
+
+from config import Config
+
+ACTION_ADD = 'a'
+ACTION_CANCEL = 'c'
+
+# LINEのポストバックデータの上限（文字数）
+MAX_DATA_LENGTH = 300
+
+_SIGNATURE_BYTES = 12
+_NONCE_BYTES = 6
+_COMPACT_FORMAT = '%Y%m%d%H%M'
+
+
+class InvalidPostback(Exception):
+    """署名・送信先・有効期限の検証に失敗したポストバック"""
+
+
+def _signature(line_user_id, body):
+    message = f"postback:{line_user_id}:{body}".encode('utf-8')
+    digest = hmac.new(Config.LINE_CHANNEL_SECRET.encode('utf-8'), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:_SIGNATURE_BYTES]).decode('ascii').rstrip('=')
+
+
+def _compact(datetime_str):
+    return datetime.fromisoformat(datetime_str).strftime(_COMPACT_FORMAT)
+
+
+def _expand(compact):
+    return datetime.strptime(compact, _COMPACT_FORMAT).strftime('%Y-%m-%dT%H:%M:00+09:00')
+
+
+def encode_confirmation(action, line_user_id, event_info=None):
+    """重複確認ボタンのデータ（LINEの上限を超える場合はNone）
+
+    event_infoはpending_eventsに保存する予定と同じ形式（title, start_datetime, end_datetime, description, has_travel）。
+    追加のデータには毎回新しいnonceを入れる。
+    """
+    fields = [action, int(time.time())]
+    if action == ACTION_ADD:
+        fields += [
+            _compact(event_info['start_datetime']),
+            _compact(event_info['end_datetime']),
+            event_info['title'],
+            event_info.get('description', ''),
+            1 if event_info.get('has_travel') else 0,
+            base64.urlsafe_b64encode(os.urandom(_NONCE_BYTES)).decode('ascii'),
+        ]
+    body = json.dumps(fields, ensure_ascii=False, separators=(',', ':'))
+    data = f"{_signature(line_user_id, body)}.{body}"
+    return data if len(data) <= MAX_DATA_LENGTH else None
+
+
+def decode_confirmation(data, line_user_id):
+    """重複確認ボタンのデータを検証し、(操作, 予定) を返す（キャンセルの予定はNone、追加の予定にはnonceを含める）"""
+    signature, _, body = data.partition('.')
+    if not body or not hmac.compare_digest(signature, _signature(line_user_id, body)):
+        raise InvalidPostback("署名が一致しません")
+    fields = json.loads(body)
+    action, issued_at = fields[0], fields[1]
+    if time.time() - issued_at > Config.PENDING_EVENT_TTL_HOURS * 3600:
+        raise InvalidPostback("有効期限が切れています")
+    if action == ACTION_CANCEL:
+        return action, None
+    if action != ACTION_ADD:
+        raise InvalidPostback(f"不明な操作です: {action}")
+    start, end, title, description, has_travel = fields[2:7]
+    return action, {
+        'title': title,
+        'start_datetime': _expand(start),
+        'end_datetime': _expand(end),
+        'description': description,
+        'has_travel': bool(has_travel),
+        'nonce': fields[7] if len(fields) > 7 else signature,
+    }
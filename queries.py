@@ -0,0 +1,268 @@
+"""
+DBHelperが使うSQL文の定義
+PostgreSQL / SQLite 共通のSQLを1回だけ定義する（プレースホルダーは %s）。
+構文が異なる場合のみ sqlite= にSQLite用のSQLを書く。
+"""
+from sql import Statement
+
+# --- users ---
+UPSERT_GOOGLE_TOKEN = Statement('upsert_google_token', '''
+    INSERT INTO users (line_user_id, google_token, created_at, updated_at)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (line_user_id) DO UPDATE SET google_token=EXCLUDED.google_token, updated_at=EXCLUDED.updated_at
+''')
+SELECT_GOOGLE_TOKEN = Statement('select_google_token', '''
+    SELECT google_token FROM users WHERE line_user_id=%s
+''', prepare=True)
+# 一括取得（PostgreSQLは配列、SQLiteはJSON配列の文字列を渡す）
+SELECT_GOOGLE_TOKENS = Statement('select_google_tokens', '''
+    SELECT line_user_id, google_token FROM users WHERE line_user_id = ANY(%s)
+''', sqlite='''
+    SELECT line_user_id, google_token FROM users WHERE line_user_id IN (SELECT value FROM json_each(%s))
+''', prepare=True)
+SELECT_GOOGLE_TOKEN_PAGE = Statement('select_google_token_page', '''
+    SELECT line_user_id, google_token
+    FROM users
+    WHERE line_user_id > %s AND google_token IS NOT NULL AND length(google_token) > 0
+    ORDER BY line_user_id
+    LIMIT %s
+''', prepare=True)
+USER_EXISTS = Statement('user_exists', '''
+    SELECT 1 FROM users WHERE line_user_id=%s
+''', prepare=True)
+SELECT_AUTHENTICATED_USER_IDS = Statement('select_authenticated_user_ids', '''
+    SELECT line_user_id FROM users WHERE google_token IS NOT NULL AND length(google_token) > 0
+''')
+COUNT_AUTHENTICATED_USERS = Statement('count_authenticated_users', '''
+    SELECT COUNT(*) FROM users WHERE google_token IS NOT NULL AND length(google_token) > 0
+''')
+COUNT_USERS = Statement('count_users', '''
+    SELECT COUNT(*) FROM users
+''')
+SELECT_AUTHENTICATED_USER_PAGE = Statement('select_authenticated_user_page', '''
+    SELECT line_user_id, length(google_token), created_at, updated_at
+    FROM users
+    WHERE line_user_id > %s AND google_token IS NOT NULL AND length(google_token) > 0
+    ORDER BY line_user_id
+    LIMIT %s
+''', prepare=True)
+SELECT_USER_PAGE = Statement('select_user_page', '''
+    SELECT line_user_id, length(google_token), created_at, updated_at
+    FROM users
+    WHERE line_user_id > %s
+    ORDER BY line_user_id
+    LIMIT %s
+''', prepare=True)
+
+# --- onetimes ---
+INSERT_ONETIME = Statement('insert_onetime', '''
+    INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
+    VALUES (%s, %s, %s, 0, %s)
+''')
+SELECT_ONETIME = Statement('select_onetime', '''
+    SELECT code, line_user_id, expires_at, used FROM onetimes WHERE code=%s
+''')
+MARK_ONETIME_USED = Statement('mark_onetime_used', '''
+    UPDATE onetimes SET used=1 WHERE code=%s
+''')
+SELECT_VALID_ONETIME = Statement('select_valid_onetime', '''
+    SELECT code FROM onetimes
+    WHERE line_user_id=%s AND used=0 AND expires_at > %s
+    ORDER BY expires_at DESC
+    LIMIT 1
+''', prepare=True)
+MARK_ONETIME_USED_BY_STATE = Statement('mark_onetime_used_by_state', '''
+    UPDATE onetimes SET used=1
+    WHERE code IN (
+        SELECT o.code FROM onetimes o
+        JOIN oauth_states os ON o.line_user_id = os.line_user_id
+        WHERE os.state = %s
+    )
+''')
+
+# --- oauth_states ---
+UPSERT_OAUTH_STATE = Statement('upsert_oauth_state', '''
+    INSERT INTO oauth_states (state, line_user_id, created_at)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (state) DO UPDATE SET line_user_id=EXCLUDED.line_user_id, created_at=EXCLUDED.created_at
+''')
+SELECT_LINE_USER_ID_BY_STATE = Statement('select_line_user_id_by_state', '''
+    SELECT line_user_id FROM oauth_states WHERE state=%s
+''')
+
+# --- pending_events ---
+UPSERT_PENDING_EVENT = Statement('upsert_pending_event', '''
+    INSERT INTO pending_events (line_user_id, event_json, created_at)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (line_user_id) DO UPDATE SET event_json=EXCLUDED.event_json, created_at=EXCLUDED.created_at
+''', prepare=True)
+SELECT_PENDING_EVENT = Statement('select_pending_event', '''
+    SELECT event_json FROM pending_events WHERE line_user_id=%s
+''', prepare=True)
+DELETE_PENDING_EVENT = Statement('delete_pending_event', '''
+    DELETE FROM pending_events WHERE line_user_id=%s
+''', prepare=True)
+
+# --- postback_nonces ---
+# 既に使われたnonceなら何もしない（rowcountが0）
+INSERT_POSTBACK_NONCE = Statement('insert_postback_nonce', '''
+    INSERT INTO postback_nonces (nonce, line_user_id, created_at)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (nonce) DO NOTHING
+''', prepare=True)
+DELETE_POSTBACK_NONCE = Statement('delete_postback_nonce', '''
+    DELETE FROM postback_nonces WHERE nonce=%s
+''', prepare=True)
+
+# --- cache_invalidations ---
+INSERT_CACHE_INVALIDATION = Statement('insert_cache_invalidation', '''
+    INSERT INTO cache_invalidations (cache_name, cache_key, created_at) VALUES (%s, %s, now())
+''', sqlite='''
+    INSERT INTO cache_invalidations (cache_name, cache_key, created_at)
+    VALUES (%s, %s, CAST(strftime('%%s', 'now') AS INTEGER))
+''', prepare=True)
+SELECT_DB_NOW = Statement('select_db_now', '''
+    SELECT now()
+''', sqlite='''
+    SELECT CAST(strftime('%%s', 'now') AS INTEGER)
+''', prepare=True)
+SELECT_CACHE_INVALIDATIONS = Statement('select_cache_invalidations', '''
+    SELECT id, cache_name, cache_key FROM cache_invalidations WHERE created_at >= %s
+''', prepare=True)
+
+# --- 期限切れ行の削除（テーブル名: 文） ---
+PURGE_EXPIRED = {
+    table: Statement(f'purge_expired_{table}', f'''
+        DELETE FROM {table} WHERE {key_column} IN (
+            SELECT {key_column} FROM {table}
+            WHERE {ts_column} < %s
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    ''', sqlite=f'''
+        DELETE FROM {table} WHERE {key_column} IN (
+            SELECT {key_column} FROM {table}
+            WHERE {ts_column} < %s
+            LIMIT %s
+        )
+    ''')
+    for table, (key_column, ts_column) in {
+        'onetimes': ('code', 'expires_at'),
+        'oauth_states': ('state', 'created_at'),
+        'pending_events': ('line_user_id', 'created_at'),
+        'cache_invalidations': ('id', 'created_at'),
+        'postback_nonces': ('nonce', 'created_at'),
+    }.items()
+}
+
+# --- agenda_jobs ---
+INSERT_AGENDA_JOB = Statement('insert_agenda_job', '''
+    INSERT INTO agenda_jobs (job_id, status, created_at)
+    VALUES (%s, 'queued', %s)
+    ON CONFLICT (job_id) DO NOTHING
+''')
+START_AGENDA_JOB = Statement('start_agenda_job', '''
+    UPDATE agenda_jobs SET status='running', started_at=COALESCE(started_at, %s), finished_at=NULL
+    WHERE job_id=%s
+''')
+FINISH_AGENDA_JOB = Statement('finish_agenda_job', '''
+    UPDATE agenda_jobs SET status=%s, error=%s, finished_at=%s WHERE job_id=%s AND status<>%s
+''')
+SELECT_AGENDA_JOB = Statement('select_agenda_job', '''
+    SELECT job_id, status, error, created_at, started_at, finished_at
+    FROM agenda_jobs WHERE job_id=%s
+''', prepare=True)
+SELECT_ACTIVE_AGENDA_JOB_IDS = Statement('select_active_agenda_job_ids', '''
+    SELECT job_id FROM agenda_jobs WHERE status IN ('queued', 'running') ORDER BY created_at
+''')
+
+# --- agenda_tasks ---
+ENQUEUE_AGENDA_TASKS = Statement('enqueue_agenda_tasks', '''
+    INSERT INTO agenda_tasks (run_id, line_user_id, status, attempts, updated_at)
+    SELECT %s, line_user_id, 'pending', 0, %s FROM users
+    WHERE google_token IS NOT NULL AND length(google_token) > 0
+    ON CONFLICT (run_id, line_user_id) DO NOTHING
+''')
+FAIL_EXPIRED_AGENDA_TASKS = Statement('fail_expired_agenda_tasks', '''
+    UPDATE agenda_tasks SET status='failed', error='lease expired', lease_owner=NULL, updated_at=%s
+    WHERE run_id=%s AND status='leased' AND lease_expires_at < %s AND attempts >= %s
+''', prepare=True)
+# PostgreSQL: SKIP LOCKEDで他のワーカーが確保中の行を飛ばして確保する
+CLAIM_AGENDA_TASKS = Statement('claim_agenda_tasks', '''
+    UPDATE agenda_tasks
+    SET status='leased', lease_owner=%s, lease_expires_at=%s, attempts=attempts + 1, updated_at=%s
+    WHERE run_id=%s AND line_user_id IN (
+        SELECT line_user_id FROM agenda_tasks
+        WHERE run_id=%s AND (status='pending' OR (status='leased' AND lease_expires_at < %s))
+        ORDER BY line_user_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING line_user_id
+''', prepare=True)
+# SQLite: BEGIN IMMEDIATEで書き込みロックを取ったうえで選択・更新する
+SELECT_CLAIMABLE_AGENDA_TASKS = Statement('select_claimable_agenda_tasks', '''
+    SELECT line_user_id FROM agenda_tasks
+    WHERE run_id=%s AND (status='pending' OR (status='leased' AND lease_expires_at < %s))
+    ORDER BY line_user_id
+    LIMIT %s
+''')
+LEASE_AGENDA_TASK = Statement('lease_agenda_task', '''
+    UPDATE agenda_tasks
+    SET status='leased', lease_owner=%s, lease_expires_at=%s, attempts=attempts + 1, updated_at=%s
+    WHERE run_id=%s AND line_user_id=%s
+''')
+# 確保中のタスクのリースを延長する（送信の直前に呼び、バッチの後ろのタスクのリースが切れないようにする）
+RENEW_AGENDA_TASK_LEASE = Statement('renew_agenda_task_lease', '''
+    UPDATE agenda_tasks SET lease_expires_at=%s, updated_at=%s
+    WHERE run_id=%s AND line_user_id=%s AND lease_owner=%s AND status='leased'
+''', prepare=True)
+COMPLETE_AGENDA_TASK = Statement('complete_agenda_task', '''
+    UPDATE agenda_tasks SET status=%s, error=%s, lease_owner=NULL, updated_at=%s
+    WHERE run_id=%s AND line_user_id=%s AND lease_owner=%s AND status='leased'
+''', prepare=True)
+COUNT_AGENDA_TASKS_BY_STATUS = Statement('count_agenda_tasks_by_status', '''
+    SELECT status, COUNT(*) FROM agenda_tasks WHERE run_id=%s GROUP BY status
+''', prepare=True)
+
+# --- agenda_task_metrics / agenda_run_reports ---
+UPSERT_AGENDA_TASK_METRICS = Statement('upsert_agenda_task_metrics', '''
+    INSERT INTO agenda_task_metrics
+        (run_id, line_user_id, credential_load_ms, calendar_fetch_ms, render_ms, push_ms, total_ms, error_class)
+    VALUES %s
+    ON CONFLICT (run_id, line_user_id) DO UPDATE SET
+        credential_load_ms=EXCLUDED.credential_load_ms, calendar_fetch_ms=EXCLUDED.calendar_fetch_ms,
+        render_ms=EXCLUDED.render_ms, push_ms=EXCLUDED.push_ms,
+        total_ms=EXCLUDED.total_ms, error_class=EXCLUDED.error_class
+''', bulk=True)
+SELECT_AGENDA_TASK_METRICS_PAGE = Statement('select_agenda_task_metrics_page', '''
+    SELECT line_user_id, credential_load_ms, calendar_fetch_ms, render_ms, push_ms, total_ms, error_class
+    FROM agenda_task_metrics
+    WHERE run_id=%s AND line_user_id > %s
+    ORDER BY line_user_id
+    LIMIT %s
+''', prepare=True)
+UPSERT_AGENDA_RUN_REPORT = Statement('upsert_agenda_run_report', '''
+    INSERT INTO agenda_run_reports (job_id, report_json, created_at)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (job_id) DO UPDATE SET report_json=EXCLUDED.report_json, created_at=EXCLUDED.created_at
+''')
+SELECT_AGENDA_RUN_REPORT = Statement('select_agenda_run_report', '''
+    SELECT report_json FROM agenda_run_reports WHERE job_id=%s
+''')
+
+# --- reauth_notices ---
+SELECT_REAUTH_NOTICE_SENT_AT = Statement('select_reauth_notice_sent_at', '''
+    SELECT last_sent_at FROM reauth_notices WHERE line_user_id=%s
+''', prepare=True)
+UPSERT_REAUTH_NOTICE = Statement('upsert_reauth_notice', '''
+    INSERT INTO reauth_notices (line_user_id, code, last_sent_at)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (line_user_id) DO UPDATE SET code=EXCLUDED.code, last_sent_at=EXCLUDED.last_sent_at
+''')
+
+
+def all_statements():
+    """定義済みの全Statement"""
+    statements = [value for value in globals().values() if isinstance(value, Statement)]
+    return statements + list(PURGE_EXPIRED.values())
@@ -1,11 +1,26 @@
-from datetime import datetime, timedelta
-from calendar_service import GoogleCalendarService
-from db import DBHelper
-from linebot import LineBotApi
+from datetime import datetime, timedelta, timezone
+from calendar_service import GoogleCalendarService, CalendarAuthError, TOKEN_NOT_LOADED
+from agenda_metrics import StageTimer, record_user_result, build_agenda_run_report, publish_run_report
+from db import get_db
+from linebot.exceptions import LineBotApiError
 from linebot.models import TextSendMessage
+from google.auth.exceptions import RefreshError, TransportError
+from googleapiclient.errors import HttpError
 from config import Config
+from line_gateway import get_gateway
+from logging_config import configure_logging
+import json
 import logging
-logging.basicConfig(level=logging.INFO)
+import os
+import random
+import socket
+import sys
+import time
+import uuid
+import requests
+configure_logging()
+
+logger = logging.getLogger("send_daily_agenda")
 
 def format_rich_agenda(events_info, is_tomorrow=False):
     if not events_info or not events_info[0]['events']:
@@ -26,61 +41,229 @@ def format_rich_agenda(events_info, is_tomorrow=False):
     footer = "━━━━━━━━━━"
     return f"{header}\n" + "\n".join(lines) + footer
 
-def send_daily_agenda():
-    logging.info(f"[DEBUG] 日次予定送信開始: {datetime.now()}")
-    db = DBHelper()
-    # 追加デバッグ: usersテーブル全件ダンプ
-    c = db.conn.cursor()
+def agenda_run_id(target_date):
+    """配信日ごとのジョブID（同じ日の実行は同じIDになり、各ユーザーへの送信は1回だけになる）"""
+    return f"agenda-{target_date.isoformat()}"
+
+def agenda_run_date(run_id):
+    """ジョブIDから配信日を取り出す"""
+    return datetime.strptime(run_id[len('agenda-'):], "%Y-%m-%d").date()
+
+def enqueue_agenda_run(db, target_date):
+    """配信日のジョブを登録し、認証済みユーザーごとの送信タスクを作成してジョブIDを返す"""
+    run_id = agenda_run_id(target_date)
+    db.create_agenda_job(run_id)
+    inserted = db.enqueue_agenda_tasks(run_id)
+    db.start_agenda_job(run_id)
+    logger.info("日次予定送信タスクを登録: run_id=%s, 追加件数=%s", run_id, inserted)
+    return run_id
+
+# 送信エラーの分類
+AUTH_REVOKED = 'auth_revoked'  # Google認証の失効・取り消し（再認証案内を送る）
+TRANSIENT = 'transient'  # 一時的な障害（バックオフしてリトライ）
+QUOTA = 'quota'  # レート制限・送信上限（リトライも再認証案内もしない）
+OTHER = 'other'  # 上記以外（リトライも再認証案内もしない）
+
+GOOGLE_QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded', 'dailyLimitExceeded')
+
+def classify_agenda_error(error):
+    """送信中の例外を auth_revoked / transient / quota / other に分類"""
+    if isinstance(error, (CalendarAuthError, RefreshError)):
+        return AUTH_REVOKED
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429:
+            return QUOTA
+        if status == 403:
+            reasons = str(error.content)
+            if any(reason in reasons for reason in GOOGLE_QUOTA_REASONS):
+                return QUOTA
+            return AUTH_REVOKED
+        if status == 401:
+            return AUTH_REVOKED
+        if status >= 500:
+            return TRANSIENT
+        return OTHER
+    if isinstance(error, LineBotApiError):
+        if error.status_code == 429:
+            return QUOTA
+        if error.status_code >= 500:
+            return TRANSIENT
+        return OTHER
+    if isinstance(error, (TransportError, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          ConnectionError, TimeoutError)):
+        return TRANSIENT
+    return OTHER
+
+def call_with_retry(operation, description):
+    """一時的なエラー（transient）のみ指数バックオフ＋ジッターでリトライ"""
+    attempts = Config.AGENDA_RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except Exception as e:
+            if attempt == attempts - 1 or classify_agenda_error(e) != TRANSIENT:
+                raise
+            delay = Config.AGENDA_RETRY_BASE_SECONDS * (2 ** attempt)
+            delay += random.uniform(0, Config.AGENDA_RETRY_BASE_SECONDS)
+            logger.warning(f"{description} で一時的なエラー (試行 {attempt + 1}/{attempts})、{delay:.1f}秒後にリトライ: {e}")
+            time.sleep(delay)
+
+def send_reauth_notice(user_id, gateway, db, retry_key=None):
+    """再認証案内を送信（REAUTH_NOTICE_INTERVAL_DAYS日に1回まで、有効なワンタイムコードは再利用）
+
+    retry_keyには送信タスクから決まるキーを渡す（同じタスクを別のワーカーが再実行しても二重に送らない）。
+    """
+    last_sent_at = db.get_reauth_notice_sent_at(user_id)
+    if last_sent_at and datetime.now(timezone.utc) - last_sent_at < timedelta(days=Config.REAUTH_NOTICE_INTERVAL_DAYS):
+        logger.debug("ユーザー %s への再認証案内は送信済みのためスキップ（前回: %s）", user_id, last_sent_at)
+        return False
+    onetime_code = db.get_valid_onetime_code(user_id) or db.generate_onetime_code(user_id)
+    auth_message = (
+        "Googleカレンダー連携の認証が切れています。\n"
+        "下記URLから再認証をお願いします。\n\n"
+        f"🔐 ワンタイムコード: {onetime_code}\n\n"
+        "https://task-bot-production.up.railway.app/onetime_login\n"
+        "（上記ページでワンタイムコードを入力してください）"
+    )
     try:
-        c.execute("SELECT 1 FROM information_schema.tables WHERE table_name='users'")
-        if c.fetchone():
-            logging.info('[DEBUG] usersテーブルは存在します')
-        else:
-            logging.info('[DEBUG] usersテーブルは存在しません')
+        gateway.push(user_id, TextSendMessage(text=auth_message), retry_key=retry_key or str(uuid.uuid4()))
+        db.record_reauth_notice(user_id, onetime_code)
+        logger.info("ユーザー %s に再認証案内を送信（ワンタイムコード付き）", user_id)
+        return True
     except Exception as e:
-        logging.error(f'[DEBUG] usersテーブル存在確認クエリエラー: {e}')
+        logger.error(f"ユーザー {user_id} への再認証案内送信エラー: {e}")
+        return False
+
+def send_agenda_to_user(user_id, target_date, calendar_service, gateway, db, timer=None, token_data=TOKEN_NOT_LOADED):
+    """1ユーザーに予定を送信。(成功したか, エラー分類) を返す
+
+    timer（StageTimer）を渡すと、段階ごとの処理時間を記録する。
+    token_dataに一括取得済みの認証トークンを渡すと、ユーザーごとにDBを読まない。
+    送信はgateway（LineGateway）が同じリトライキーでリトライする。
+    """
+    timer = timer or StageTimer()
+    # 同じ配信日・ユーザーには同じリトライキーを使い、リース再取得時の二重送信も防ぐ
+    task_key = f"{agenda_run_id(target_date)}/{user_id}"
+    retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, task_key))
     try:
-        c.execute('SELECT line_user_id, LENGTH(google_token), created_at, updated_at FROM users')
-        users = c.fetchall()
-        if users:
-            logging.info(f'[DEBUG] usersテーブル全件: {users}')
-        else:
-            logging.info('[DEBUG] usersテーブルは空です')
+        with timer.stage('credential_load'):
+            service = call_with_retry(
+                lambda: calendar_service.get_calendar_service(user_id, token_data),
+                f"ユーザー {user_id} の認証情報読み込み"
+            )
+        with timer.stage('calendar_fetch'):
+            events_info = call_with_retry(
+                lambda: calendar_service.get_events_for_dates([target_date], user_id, raise_errors=True, service=service),
+                f"ユーザー {user_id} の予定取得"
+            )
+        with timer.stage('render'):
+            message = format_rich_agenda(events_info, is_tomorrow=True)
+        logger.debug("ユーザー %s の予定件数: %d", user_id, len(events_info[0]['events']) if events_info else 0)
+        with timer.stage('push'):
+            gateway.push(user_id, TextSendMessage(text=message), retry_key=retry_key)
+        logger.debug("ユーザー %s への送信完了", user_id)
+        return True, None
     except Exception as e:
-        logging.error(f'[DEBUG] usersテーブル全件取得エラー: {e}')
+        error_class = classify_agenda_error(e)
+        logger.error(f"ユーザー {user_id} への送信中にエラー ({error_class}): {e}")
+        # 認証切れの場合のみLINEで再認証案内を送信
+        if error_class == AUTH_REVOKED:
+            send_reauth_notice(user_id, gateway, db, str(uuid.uuid5(uuid.NAMESPACE_URL, f"{task_key}/reauth")))
+        return False, error_class
+
+def finalize_agenda_run(run_id, db):
+    """ジョブの集計レポートを作成してDBに保存し、メトリクスとして公開"""
+    report = build_agenda_run_report(db, run_id)
+    db.save_agenda_run_report(run_id, json.dumps(report, ensure_ascii=False))
+    publish_run_report(report)
+    stages = ', '.join(
+        f"{stage}: p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms"
+        for stage, stats in report['stages'].items()
+    )
+    logger.info(
+        f"日次予定送信レポート: run_id={run_id}, users={report['users']}, failed={report['failed']}, "
+        f"wall={report['wall_seconds']}s, {stages}, errors={report['errors_by_class']}"
+    )
+    return report
+
+def run_agenda_worker(run_id, db=None):
+    """ジョブのタスクをリース付きで確保して送信する。確保できるタスクがなくなったら終了する
+
+    複数のプロセス・スレッドで同時に実行してよい（タスクはDBで排他的に確保される）。
+    """
+    db = db or get_db()
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    target_date = agenda_run_date(run_id)
     calendar_service = GoogleCalendarService()
-    line_bot_api = LineBotApi(Config.LINE_CHANNEL_ACCESS_TOKEN)
+    gateway = get_gateway()
+    logger.info("日次予定送信ワーカー開始: run_id=%s, owner=%s", run_id, owner)
+
+    processed = 0
+    while True:
+        user_ids = db.claim_agenda_tasks(
+            run_id,
+            owner,
+            Config.AGENDA_CLAIM_BATCH_SIZE,
+            Config.AGENDA_LEASE_SECONDS,
+            Config.AGENDA_MAX_ATTEMPTS
+        )
+        if not user_ids:
+            break
+        # 確保したバッチの認証トークンを1回のクエリでまとめて読む
+        tokens = db.get_google_tokens(user_ids)
+        for user_id in user_ids:
+            # バッチの後ろのタスクは確保から時間が経っているため、送信の直前にリースを延長する。
+            # 延長できなければ他のワーカーが再確保しているため送らない
+            if not db.renew_agenda_task_lease(run_id, user_id, owner, Config.AGENDA_LEASE_SECONDS):
+                logger.warning(f"タスクのリースが失効していたため送信しません: run_id={run_id}, user={user_id}")
+                continue
+            timer = StageTimer()
+            success, error_class = send_agenda_to_user(
+                user_id, target_date, calendar_service, gateway, db, timer, tokens.get(user_id)
+            )
+            record_user_result(timer, error_class)
+            # 段階別処理時間を保存してから、送信ごとにすぐタスクを完了にする（レポート作成時に揃っているように）
+            db.save_agenda_task_metrics(run_id, user_id, timer.stage_ms, timer.total_ms(), error_class)
+            if not db.complete_agenda_task(run_id, user_id, owner, 'done' if success else 'failed', error_class):
+                logger.warning(f"タスクのリースが失効していました: run_id={run_id}, user={user_id}")
+            processed += 1
+
+    # 他のワーカーが処理中のタスクも残っていなければジョブを完了にする
+    counts = db.get_agenda_task_counts(run_id)
+    if counts['pending'] == 0 and counts['leased'] == 0:
+        if db.finish_agenda_job(run_id, 'completed'):
+            logger.info("日次予定送信ジョブ完了: run_id=%s, counts=%s", run_id, counts)
+            try:
+                finalize_agenda_run(run_id, db)
+            except Exception as e:
+                logger.error(f"日次予定送信レポートの作成に失敗: run_id={run_id}, error={e}")
+    logger.info("日次予定送信ワーカー終了: run_id=%s, owner=%s, 処理件数=%d", run_id, owner, processed)
+    return processed
+
+def send_daily_agenda():
+    """明日分のジョブを登録し、このプロセスでもワーカーとして送信する"""
+    logger.info("日次予定送信開始")
+    db = get_db()
     tomorrow = datetime.now().date() + timedelta(days=1)
-    logging.info(f"[DEBUG] 明日の日付: {tomorrow}")
-    user_ids = db.get_all_user_ids()  # 認証済みユーザーのみ返すようにDBHelperを調整
-    logging.info(f"[DEBUG] 送信対象ユーザー: {user_ids}")
+    run_id = enqueue_agenda_run(db, tomorrow)
+    run_agenda_worker(run_id, db)
+    logger.info("日次予定送信完了: run_id=%s", run_id)
 
-    for user_id in user_ids:
+def run_worker_forever():
+    """未完了ジョブをポーリングしてタスクを処理し続ける（専用ワーカープロセス用）"""
+    db = get_db()
+    logger.info("日次予定送信ワーカーを開始します")
+    while True:
         try:
-            events_info = calendar_service.get_events_for_dates([tomorrow], user_id)
-            logging.info(f"[DEBUG] ユーザー: {user_id} の取得した予定: {events_info}")
-            message = format_rich_agenda(events_info, is_tomorrow=True)
-            logging.info(f"[DEBUG] 送信先: {user_id}, メッセージ: {message}")
-            line_bot_api.push_message(user_id, TextSendMessage(text=message))
-            logging.info(f"[DEBUG] ユーザー {user_id} への送信完了")
+            for run_id in db.get_active_agenda_job_ids():
+                run_agenda_worker(run_id, db)
         except Exception as e:
-            logging.error(f"[ERROR] ユーザー {user_id} への送信中にエラー: {e}")
-            # 認証エラー時はLINEで再認証案内を送信
-            onetime_code = db.generate_onetime_code(user_id)
-            auth_message = (
-                "Googleカレンダー連携の認証が切れています。\n"
-                "下記URLから再認証をお願いします。\n\n"
-                f"🔐 ワンタイムコード: {onetime_code}\n\n"
-                "https://task-bot-production.up.railway.app/onetime_login\n"
-                "（上記ページでワンタイムコードを入力してください）"
-            )
-            try:
-                line_bot_api.push_message(user_id, TextSendMessage(text=auth_message))
-                logging.info(f"[DEBUG] ユーザー {user_id} に再認証案内を送信（ワンタイムコード付き）")
-            except Exception as e2:
-                logging.error(f"[ERROR] ユーザー {user_id} への再認証案内送信エラー: {e2}")
-    
-    logging.info(f"[DEBUG] 日次予定送信完了: {datetime.now()}")
+            logger.error(f"日次予定送信ワーカーでエラー: {e}")
+        time.sleep(Config.AGENDA_WORKER_POLL_SECONDS)
 
 if __name__ == "__main__":
-    send_daily_agenda() 
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        run_worker_forever()
+    else:
+        send_daily_agenda()
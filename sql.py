@@ -0,0 +1,174 @@
+"""
+SQL文の定義と方言ごとの変換
+SQLは `%s` プレースホルダーで1回だけ定義し、SQLite向けには `?` に変換する。
+PostgreSQLでは prepare=True の文をサーバー側のプリペアドステートメント（PREPARE / EXECUTE）で実行し、
+文ごとの実行回数・実行時間を記録する。
+"""
+import re
+import textwrap
+import threading
+import time
+import weakref
+
+from metrics import registry
+
+STATEMENT_DURATION_MS = registry.histogram('db_statement_duration_ms', 'SQL文ごとの実行時間（ミリ秒）')
+
+# %s はプレースホルダー、%% は % そのもの（psycopg2と同じ書き方）
+_PLACEHOLDER = re.compile(r'%%|%s')
+
+# EXECUTE対象のプリペアドステートメントが存在しない場合のSQLSTATE
+INVALID_SQL_STATEMENT_NAME = '26000'
+
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE（トランザクション外）
+_TRANSACTION_STATUS_IDLE = 0
+
+
+def is_missing_prepared(error):
+    """サーバー側でプリペアドステートメントが破棄されていたことによるエラーか"""
+    return getattr(error, 'pgcode', None) == INVALID_SQL_STATEMENT_NAME
+
+
+def _to_numbered(sql):
+    """%s を PREPARE 用の $1, $2, ... に変換"""
+    counter = iter(range(1, 10000))
+    return _PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else f'${next(counter)}', sql)
+
+
+def _to_qmark(sql):
+    """%s をSQLite用の ? に変換"""
+    return _PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else '?', sql)
+
+
+class Statement:
+    """PostgreSQL / SQLite 共通で使う1つのSQL文
+
+    sqlite: SQLiteで構文が異なる場合のSQL（省略時はsqlのプレースホルダーを変換して使う）
+    prepare: PostgreSQLでプリペアドステートメントとして実行する（頻繁に実行する文に指定）
+    bulk: `VALUES %s` を含む一括INSERT（PostgreSQLはexecute_values、SQLiteはexecutemanyで実行）
+    """
+
+    def __init__(self, name, sql, sqlite=None, prepare=False, bulk=False):
+        self.name = name
+        self.sql = textwrap.dedent(sql).strip()
+        self.prepare = prepare and not bulk
+        self.bulk = bulk
+        sqlite_sql = textwrap.dedent(sqlite).strip() if sqlite else self.sql
+        self.param_count = sum(1 for m in _PLACEHOLDER.finditer(self.sql) if m.group() == '%s')
+        if bulk:
+            # 一括INSERTの1行分（VALUES %s）をSQLite向けに展開する
+            columns = re.search(r'\(([^)]*)\)\s*VALUES\s+%s', sqlite_sql, re.S).group(1)
+            row = '(' + ', '.join('%s' for _ in columns.split(',')) + ')'
+            self.sqlite_sql = _to_qmark(re.sub(r'VALUES\s+%s', f'VALUES {row}', sqlite_sql, count=1))
+        else:
+            self.sqlite_sql = _to_qmark(sqlite_sql)
+        self.prepare_sql = f'PREPARE {name} AS {_to_numbered(self.sql)}'
+        args = ', '.join(['%s'] * self.param_count)
+        self.execute_sql = f'EXECUTE {name} ({args})' if args else f'EXECUTE {name}'
+        self.calls = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+
+    def render(self, is_postgres):
+        return self.sql if is_postgres else self.sqlite_sql
+
+    def record(self, elapsed_ms):
+        with self._lock:
+            self.calls += 1
+            self.total_ms += elapsed_ms
+        STATEMENT_DURATION_MS.observe(elapsed_ms, statement=self.name)
+
+    def __repr__(self):
+        return f'<Statement {self.name}>'
+
+
+class StatementRunner:
+    """Statementを接続の方言に合わせて実行する"""
+
+    def __init__(self, is_postgres, use_prepared=True, page_size=500, on_execute=None):
+        self.is_postgres = is_postgres
+        self.on_execute = on_execute  # on_execute(stmt, params, elapsed_ms) 実行ごとに呼ぶ
+        self.use_prepared = is_postgres and use_prepared
+        self.page_size = page_size
+        self._prepared = weakref.WeakKeyDictionary()  # 接続 -> PREPARE済みの文の名前
+        self._lock = threading.Lock()
+
+    def execute(self, c, stmt, params=()):
+        started = time.perf_counter()
+        try:
+            if self.use_prepared and stmt.prepare:
+                self._execute_prepared(c, stmt, params)
+            else:
+                c.execute(stmt.render(self.is_postgres), params)
+        finally:
+            self._record(stmt, params, started)
+        return c
+
+    def _execute_prepared(self, c, stmt, params):
+        conn = c.connection
+        first_in_transaction = conn.info.transaction_status == _TRANSACTION_STATUS_IDLE
+        names = self._prepared_names(conn)
+        if stmt.name not in names:
+            c.execute(stmt.prepare_sql)
+            names.add(stmt.name)
+        try:
+            c.execute(stmt.execute_sql, params)
+        except Exception as e:
+            if not is_missing_prepared(e):
+                raise
+            # サーバー側で破棄されていた（DISCARD ALL・接続の付け替えなど）。この接続の記録を捨て、
+            # トランザクションの最初の文ならロールバックしてPREPAREし直し、この呼び出しの中で1回だけ再実行する
+            # （途中の文ならそれまでの変更が失われるため、呼び出し元で操作ごとやり直す）
+            self.forget_connection(conn)
+            if not first_in_transaction:
+                raise
+            conn.rollback()
+            names = self._prepared_names(conn)
+            c.execute(stmt.prepare_sql)
+            names.add(stmt.name)
+            c.execute(stmt.execute_sql, params)
+
+    def execute_bulk(self, c, stmt, rows):
+        """一括INSERTを実行する"""
+        if not rows:
+            return c
+        started = time.perf_counter()
+        try:
+            if self.is_postgres:
+                import psycopg2.extras
+                psycopg2.extras.execute_values(c, stmt.sql, rows, page_size=self.page_size)
+            else:
+                c.executemany(stmt.sqlite_sql, rows)
+        finally:
+            self._record(stmt, rows, started)
+        return c
+
+    def _record(self, stmt, params, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stmt.record(elapsed_ms)
+        if self.on_execute:
+            self.on_execute(stmt, params, elapsed_ms)
+
+    def _prepared_names(self, conn):
+        with self._lock:
+            return self._prepared.setdefault(conn, set())
+
+    def forget_connection(self, conn):
+        """閉じた接続のPREPARE済みの記録を捨てる（PREPAREは接続ごとに有効）"""
+        with self._lock:
+            self._prepared.pop(conn, None)
+
+
+def statement_stats(statements):
+    """文ごとの実行回数・合計/平均時間を実行時間の多い順に返す"""
+    stats = []
+    for stmt in statements:
+        if not stmt.calls:
+            continue
+        stats.append({
+            'statement': stmt.name,
+            'calls': stmt.calls,
+            'total_ms': round(stmt.total_ms, 1),
+            'avg_ms': round(stmt.total_ms / stmt.calls, 2)
+        })
+    return sorted(stats, key=lambda s: s['total_ms'], reverse=True)
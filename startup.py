@@ -0,0 +1,93 @@
+"""
+起動プロファイル（起動処理の所要時間・importの時間・プロセスのメモリ）
+- boot_phase(name): app.pyの起動処理の段階ごとの所要時間を記録する
+- resident_memory_bytes(): プロセスの常駐メモリ（RSS）。/metricsとgunicornのpost_forkで使う
+- `python startup.py` で主要ライブラリのimport時間とメモリの増加量を表示する（importの順に累積で計測）
+"""
+import contextlib
+import importlib
+import logging
+import os
+import resource
+import sys
+import time
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+STARTUP_PHASE_MS = registry.gauge('startup_phase_ms', '起動処理の段階ごとの所要時間（ミリ秒、phase別）')
+RESIDENT_MEMORY_BYTES = registry.gauge('process_resident_memory_bytes', 'プロセスの常駐メモリ（RSS、バイト）')
+
+# 起動時にimportする主なライブラリ（重い順ではなくapp.pyが読み込む順）
+PROFILED_MODULES = (
+    'flask',
+    'linebot',
+    'linebot.v3.messaging',
+    'openai',
+    'googleapiclient.discovery',
+    'google_auth_oauthlib.flow',
+    'psycopg2',
+    'db',
+    'line_bot_handler',
+    'send_daily_agenda',
+    'app',
+)
+
+
+def resident_memory_bytes():
+    """プロセスの常駐メモリ（Linuxは/proc/self/statusのVmRSS、それ以外は最大RSS）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト、Linuxはキロバイト単位
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def update_memory_gauge():
+    RESIDENT_MEMORY_BYTES.set(resident_memory_bytes())
+
+
+def record_phase(name, started):
+    """perf_counterの開始時刻startedからの経過時間を、起動処理の段階nameの所要時間として記録する"""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    STARTUP_PHASE_MS.set(elapsed_ms, phase=name)
+    logger.info(f"起動処理 {name}: {elapsed_ms:.1f}ms")
+
+
+@contextlib.contextmanager
+def boot_phase(name):
+    """with内の処理を起動処理の段階nameとして計測する"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, started)
+
+
+def profile_imports(modules=PROFILED_MODULES):
+    """modulesを順にimportし、(モジュール, import時間ミリ秒, RSSの増加量バイト) のリストを返す"""
+    results = []
+    for name in modules:
+        before = resident_memory_bytes()
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning(f"{name} をimportできませんでした: {e}")
+            continue
+        results.append((name, (time.perf_counter() - started) * 1000, resident_memory_bytes() - before))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    for name, elapsed_ms, rss_delta in profile_imports():
+        print(f"{name:28s} {elapsed_ms:8.1f}ms  +{rss_delta / 1024 / 1024:6.1f}MiB")
+    print(f"{'合計（RSS）':28s} {'':10s} {resident_memory_bytes() / 1024 / 1024:7.1f}MiB")
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# テストはリポジトリ直下のモジュールをimportする（設定は実際の値を使わない）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('DATABASE_REPLICA_URL', None)
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test-channel-secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test-access-token')
+os.environ.setdefault('OPENAI_API_KEY', 'test-openai-key')
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """一時ディレクトリのSQLiteを使うDBHelper"""
+    import db
+    helper = db.DBHelper(str(tmp_path / 'test.db'))
+    yield helper
+    helper.close()
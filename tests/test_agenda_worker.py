@@ -0,0 +1,138 @@
+import sqlite3
+import uuid
+from datetime import date
+
+import pytest
+
+import send_daily_agenda
+from calendar_service import CalendarAuthError
+
+TARGET_DATE = date(2026, 7, 10)
+
+
+@pytest.fixture
+def agenda_run(sqlite_db):
+    for user_id in ('u1', 'u2', 'u3'):
+        sqlite_db.save_google_token(user_id, b'token')
+    return send_daily_agenda.enqueue_agenda_run(sqlite_db, TARGET_DATE)
+
+
+def test_expired_lease_cannot_be_renewed_or_completed(sqlite_db, agenda_run):
+    assert sqlite_db.claim_agenda_tasks(agenda_run, 'worker-a', 10, -1, 3) == ['u1', 'u2', 'u3']
+    # リースが切れたタスクは別のワーカーが再確保する
+    assert sqlite_db.claim_agenda_tasks(agenda_run, 'worker-b', 10, 300, 3) == ['u1', 'u2', 'u3']
+    assert not sqlite_db.renew_agenda_task_lease(agenda_run, 'u1', 'worker-a', 300)
+    assert not sqlite_db.complete_agenda_task(agenda_run, 'u1', 'worker-a', 'done')
+    assert sqlite_db.renew_agenda_task_lease(agenda_run, 'u1', 'worker-b', 300)
+    assert sqlite_db.complete_agenda_task(agenda_run, 'u1', 'worker-b', 'done')
+
+
+def test_worker_completes_each_task_after_its_send_and_skips_lost_leases(sqlite_db, agenda_run, tmp_path, monkeypatch):
+    monkeypatch.setattr(send_daily_agenda, 'GoogleCalendarService', lambda: None)
+    monkeypatch.setattr(send_daily_agenda, 'get_gateway', lambda: None)
+    sent = []
+
+    def send(user_id, target_date, calendar_service, gateway, db, timer, token_data):
+        sent.append((user_id, db.get_agenda_task_counts(agenda_run)['done']))
+        if user_id == 'u1':
+            # u1の送信中にu3のリースが切れ、別のワーカーが再確保した
+            with sqlite3.connect(str(tmp_path / 'test.db')) as conn:
+                conn.execute("UPDATE agenda_tasks SET lease_owner='other' WHERE line_user_id='u3'")
+        return True, None
+
+    monkeypatch.setattr(send_daily_agenda, 'send_agenda_to_user', send)
+    assert send_daily_agenda.run_agenda_worker(agenda_run, sqlite_db) == 2
+    # u2を送る時点でu1は完了している
+    assert sent == [('u1', 0), ('u2', 1)]
+    assert sqlite_db.get_agenda_task_counts(agenda_run) == {'pending': 0, 'leased': 1, 'done': 2, 'failed': 0}
+
+
+class FakeGateway:
+    def __init__(self):
+        self.retry_keys = []
+
+    def push(self, to, messages, retry_key=None):
+        self.retry_keys.append(retry_key)
+
+
+class RevokedCalendar:
+    def get_calendar_service(self, user_id, token_data):
+        raise CalendarAuthError('revoked')
+
+
+class FakeDB:
+    def get_reauth_notice_sent_at(self, user_id):
+        return None
+
+    def get_valid_onetime_code(self, user_id):
+        return 'ABCD1234'
+
+    def record_reauth_notice(self, user_id, code):
+        pass
+
+
+def test_reauth_notice_retry_key_is_derived_from_the_task():
+    gateway = FakeGateway()
+    for _ in range(2):
+        assert send_daily_agenda.send_agenda_to_user(
+            'u1', TARGET_DATE, RevokedCalendar(), gateway, FakeDB()
+        ) == (False, send_daily_agenda.AUTH_REVOKED)
+    expected = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{send_daily_agenda.agenda_run_id(TARGET_DATE)}/u1/reauth"))
+    assert gateway.retry_keys == [expected, expected]
+
+
+def _http_error(status, content=b''):
+    import httplib2
+    from googleapiclient.errors import HttpError
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+@pytest.mark.parametrize('error, expected', [
+    (CalendarAuthError('revoked'), send_daily_agenda.AUTH_REVOKED),
+    (_http_error(401), send_daily_agenda.AUTH_REVOKED),
+    (_http_error(403, b'{"reason": "forbidden"}'), send_daily_agenda.AUTH_REVOKED),
+    (_http_error(403, b'{"reason": "rateLimitExceeded"}'), send_daily_agenda.QUOTA),
+    (_http_error(429), send_daily_agenda.QUOTA),
+    (_http_error(503), send_daily_agenda.TRANSIENT),
+    (_http_error(404), send_daily_agenda.OTHER),
+    (TimeoutError(), send_daily_agenda.TRANSIENT),
+    (ConnectionError(), send_daily_agenda.TRANSIENT),
+    (ValueError('bad'), send_daily_agenda.OTHER),
+])
+def test_classify_agenda_error(error, expected):
+    assert send_daily_agenda.classify_agenda_error(error) == expected
+
+
+@pytest.mark.parametrize('status, expected', [
+    (429, send_daily_agenda.QUOTA),
+    (500, send_daily_agenda.TRANSIENT),
+    (400, send_daily_agenda.OTHER),
+])
+def test_classify_line_errors(status, expected):
+    from linebot.exceptions import LineBotApiError
+    from linebot.models.error import Error
+    error = LineBotApiError(status, {}, error=Error(message='error'))
+    assert send_daily_agenda.classify_agenda_error(error) == expected
+
+
+def test_only_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(send_daily_agenda.Config, 'AGENDA_RETRY_ATTEMPTS', 3)
+    monkeypatch.setattr(send_daily_agenda.time, 'sleep', lambda seconds: None)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise TimeoutError()
+        return 'ok'
+
+    assert send_daily_agenda.call_with_retry(flaky, 'test') == 'ok'
+    calls.clear()
+
+    def revoked():
+        calls.append(1)
+        raise CalendarAuthError('revoked')
+
+    with pytest.raises(CalendarAuthError):
+        send_daily_agenda.call_with_retry(revoked, 'test')
+    assert len(calls) == 1
@@ -0,0 +1,82 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from coalesce import MessageCoalescer
+
+
+def test_messages_within_window_are_merged():
+    coalescer = MessageCoalescer(window_ms=50)
+    batch = coalescer.join('u1', '7/10 9-10時', 'token-1')
+    assert coalescer.join('u1', '7/11 9-10時', 'token-2') is None
+    assert coalescer.join('u2', '別のユーザー', 'token-3') is not None
+    assert batch.wait() == ('7/10 9-10時\n7/11 9-10時', 'token-2')
+
+
+def test_message_after_window_starts_new_batch():
+    coalescer = MessageCoalescer(window_ms=10)
+    first = coalescer.join('u1', 'a', 'token-1')
+    time.sleep(0.02)
+    second = coalescer.join('u1', 'b', 'token-2')
+    assert second is not None and second is not first
+    assert first.wait() == ('a', 'token-1')
+    assert second.wait() == ('b', 'token-2')
+
+
+class FakeGateway:
+    def __init__(self):
+        self.replies = []
+        self.replied = threading.Event()
+
+    def start_loading(self, user_id, seconds):
+        pass
+
+    def reply(self, reply_token, to, messages):
+        self.replies.append((reply_token, to, messages))
+        self.replied.set()
+        return True
+
+
+class FakeHandler:
+    def __init__(self):
+        self.gateway = FakeGateway()
+
+    def expects_slow_response(self, event):
+        return True
+
+    def coalescable(self, event):
+        return True
+
+    def build_response(self, event, text=None):
+        return text or event.message.text
+
+
+def _event(text, reply_token):
+    return SimpleNamespace(
+        message=SimpleNamespace(text=text),
+        source=SimpleNamespace(user_id='u1'),
+        reply_token=reply_token,
+    )
+
+
+@pytest.fixture
+def flask_app(monkeypatch):
+    app = pytest.importorskip('app')
+    monkeypatch.setattr(app, 'line_bot_handler', FakeHandler())
+    monkeypatch.setattr(app, 'message_coalescer', MessageCoalescer(window_ms=100))
+    return app
+
+
+def test_flask_handler_does_not_block_the_request_thread(flask_app):
+    started = time.monotonic()
+    # gunicornのsyncワーカーと同じく、1つのスレッドで順にWebhookを処理する
+    flask_app.handle_message(_event('7/10 9-10時', 'token-1'))
+    flask_app.handle_message(_event('7/11 9-10時', 'token-2'))
+    assert time.monotonic() - started < 0.1
+
+    gateway = flask_app.line_bot_handler.gateway
+    assert gateway.replied.wait(2)
+    time.sleep(0.05)
+    assert gateway.replies == [('token-2', 'u1', '7/10 9-10時\n7/11 9-10時')]
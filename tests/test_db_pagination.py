@@ -0,0 +1,33 @@
+def _add_users(db, count, without_token=()):
+    for i in range(count):
+        user_id = f'u{i:03d}'
+        db.save_google_token(user_id, b'' if user_id in without_token else b'token')
+
+
+def test_user_batches_cover_every_user_once_in_order(sqlite_db):
+    _add_users(sqlite_db, 7)
+    batches = list(sqlite_db.iter_user_batches(batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [user['line_user_id'] for batch in batches for user in batch] == [f'u{i:03d}' for i in range(7)]
+
+
+def test_exact_multiple_of_batch_size_ends_with_empty_page(sqlite_db):
+    _add_users(sqlite_db, 6)
+    assert [len(batch) for batch in sqlite_db.iter_user_batches(batch_size=3)] == [3, 3]
+
+
+def test_unauthenticated_users_are_skipped_unless_requested(sqlite_db):
+    _add_users(sqlite_db, 5, without_token=('u001', 'u003'))
+    assert list(sqlite_db.iter_user_ids(batch_size=2)) == ['u000', 'u002', 'u004']
+    assert len(list(sqlite_db.iter_user_ids(batch_size=2, authenticated_only=False))) == 5
+
+
+def test_google_tokens_are_paged_by_user(sqlite_db):
+    _add_users(sqlite_db, 5)
+    batches = list(sqlite_db.iter_google_tokens(batch_size=2))
+    assert [[user_id for user_id, _ in batch] for batch in batches] == [['u000', 'u001'], ['u002', 'u003'], ['u004']]
+    assert all(bytes(token) == b'token' for batch in batches for _, token in batch)
+
+
+def test_no_users(sqlite_db):
+    assert list(sqlite_db.iter_user_batches()) == []
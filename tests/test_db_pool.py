@@ -0,0 +1,157 @@
+import gc
+import threading
+import time
+
+import pytest
+
+import db
+
+
+class FakeInfo:
+    transaction_status = 0  # psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor:
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.info = FakeInfo()
+
+    def cursor(self):
+        return FakeCursor()
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def connect(dsn, cursor_factory=None):
+        conn = FakeConnection()
+        created.append(conn)
+        return conn
+
+    monkeypatch.setattr(db.psycopg2, 'connect', connect)
+    return created
+
+
+def test_returned_connections_are_reused_not_closed(connections):
+    pool = db.PostgresPool('postgres://test', minconn=1, maxconn=4)
+    for _ in range(5):
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+    assert len(connections) == 3
+    assert not any(conn.closed for conn in connections)
+    assert pool.idle_count() == 3
+    assert pool.in_use == 0
+
+
+def test_concurrent_checkouts_never_exceed_max(connections):
+    pool = db.PostgresPool('postgres://test', minconn=1, maxconn=3)
+    barrier = threading.Barrier(6)
+
+    def work():
+        barrier.wait()
+        for _ in range(50):
+            conn = pool.getconn()
+            time.sleep(0.0005)
+            pool.putconn(conn)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(connections) <= 3
+    assert not any(conn.closed for conn in connections)
+
+
+def test_discarded_connection_state_is_dropped(connections):
+    pool = db.PostgresPool('postgres://test', minconn=0, maxconn=2)
+    discarded = []
+    pool.on_discard = discarded.append
+    conn = pool.getconn()
+    pool.putconn(conn, close=True)
+    assert discarded == [conn] and conn.closed
+    del conn, discarded[:]
+    connections.clear()
+    gc.collect()
+    assert len(pool._born) == 0
+    assert len(pool._last_used) == 0
+
+
+def test_new_connection_does_not_inherit_old_age(connections, monkeypatch):
+    monkeypatch.setattr(db, 'DB_CONN_MAX_LIFETIME_SECONDS', 60)
+    pool = db.PostgresPool('postgres://test', minconn=0, maxconn=1)
+    old = pool.getconn()
+    pool._born[old] = time.monotonic() - 3600
+    pool.putconn(old)
+    fresh = pool.getconn()
+    assert fresh is not old and old.closed
+    assert time.monotonic() - pool._born[fresh] < 5
+    pool.putconn(fresh)
+    assert pool.getconn() is fresh
+
+
+class MissingPrepared(db.psycopg2.OperationalError):
+    pgcode = '26000'
+
+
+@pytest.fixture
+def helper(connections):
+    helper = db.DBHelper.__new__(db.DBHelper)
+    helper.pool = db.PostgresPool('postgres://test', minconn=1, maxconn=2)
+    return helper
+
+
+def test_missing_prepared_statement_keeps_the_connection(helper, connections):
+    reconnects = db.DB_RECONNECTS.value(pool='primary')
+    with pytest.raises(MissingPrepared):
+        with helper._connection() as conn:
+            raise MissingPrepared('prepared statement does not exist')
+    assert not conn.closed
+    assert helper.pool.getconn() is conn
+    assert db.DB_RECONNECTS.value(pool='primary') == reconnects
+
+
+def test_broken_connection_is_closed(helper, connections):
+    with pytest.raises(db.psycopg2.OperationalError):
+        with helper._connection() as conn:
+            raise db.psycopg2.OperationalError('server closed the connection unexpectedly')
+    assert conn.closed
+    assert helper.pool.getconn() is not conn
+
+
+def test_operation_is_rerun_once_on_the_same_connection(helper, connections):
+    used = []
+
+    def operation(c):
+        used.append(c)
+        if len(used) == 1:
+            raise MissingPrepared('prepared statement does not exist')
+        return 'ok'
+
+    assert helper._execute_postgres('test', operation, False, False, ()) == 'ok'
+    assert len(connections) == 1 and not connections[0].closed
@@ -0,0 +1,37 @@
+from concurrent.futures import Future
+
+import pytest
+
+
+class FakeGateway:
+    def __init__(self):
+        self.pushed = []
+
+    def push_deferred(self, to, reply_token, messages):
+        self.pushed.append((to, reply_token, messages))
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    app = pytest.importorskip('app')
+    gateway = FakeGateway()
+    monkeypatch.setattr(app.line_bot_handler.__class__, 'gateway', property(lambda self: gateway))
+    return app, gateway
+
+
+def test_pushes_the_response_when_done(app_module):
+    app, gateway = app_module
+    future = Future()
+    future.set_result('response')
+    app._push_when_done('u1', 'token', future)
+    assert gateway.pushed == [('u1', 'token', 'response')]
+
+
+def test_pushes_error_reply_when_building_the_response_failed(app_module):
+    app, gateway = app_module
+    future = Future()
+    future.set_exception(RuntimeError('boom'))
+    app._push_when_done('u1', 'token', future)
+    [(to, reply_token, message)] = gateway.pushed
+    assert (to, reply_token) == ('u1', 'token')
+    assert message.text == app.ERROR_REPLY_TEXT
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+import line_gateway
+from line_gateway import TokenBucket
+
+
+class FakeClock:
+    # 浮動小数点の誤差が出ないよう、時刻と補充間隔は2の累乗の分数にする
+    def __init__(self):
+        self.now = 1024.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(line_gateway.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(line_gateway.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_burst_is_sent_without_waiting(clock):
+    bucket = TokenBucket(rate=4, burst=5)
+    assert [bucket.acquire() for _ in range(5)] == [0.0] * 5
+    assert clock.slept == []
+
+
+def test_waits_for_refill_after_burst(clock):
+    bucket = TokenBucket(rate=4, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+    assert bucket.acquire() == 0.25
+    clock.now += 0.125
+    assert bucket.acquire() == 0.125
+
+
+def test_refill_is_capped_at_burst(clock):
+    bucket = TokenBucket(rate=4, burst=3)
+    clock.now += 64
+    assert [bucket.acquire() for _ in range(3)] == [0.0] * 3
+    assert bucket.acquire() == 0.25
+
+
+def test_zero_rate_is_unlimited(clock):
+    bucket = TokenBucket(rate=0)
+    assert all(bucket.acquire() == 0.0 for _ in range(100))
+    assert asyncio.run(bucket.acquire_async()) == 0.0
+
+
+def _line_error(status, message='error'):
+    from linebot.exceptions import LineBotApiError
+    from linebot.models.error import Error
+    return LineBotApiError(status, {}, error=Error(message=message))
+
+
+@pytest.fixture
+def max_attempts(monkeypatch):
+    monkeypatch.setattr(line_gateway.Config, 'LINE_SEND_MAX_ATTEMPTS', 3)
+
+
+def test_expired_reply_token_falls_back_to_push_with_stable_key(max_attempts):
+    error = _line_error(400, line_gateway.INVALID_REPLY_TOKEN)
+    action, retry_key = line_gateway._reply_failure_plan('token-1', 'u1', error, 0, False)
+    assert action == 'push'
+    assert line_gateway._reply_failure_plan('token-1', 'u1', error, 0, False) == ('push', retry_key)
+    assert line_gateway._reply_failure_plan('token-2', 'u1', error, 0, False)[1] != retry_key
+
+
+def test_used_reply_token_after_possible_delivery_is_not_pushed(max_attempts):
+    error = _line_error(400, line_gateway.INVALID_REPLY_TOKEN)
+    assert line_gateway._reply_failure_plan('token-1', 'u1', error, 1, True) is None
+
+
+def test_expired_reply_token_without_recipient_gives_up(max_attempts):
+    error = _line_error(400, line_gateway.INVALID_REPLY_TOKEN)
+    assert line_gateway._reply_failure_plan('token-1', None, error, 0, False) is None
+
+
+@pytest.mark.parametrize('error', [_line_error(500), _line_error(429), TimeoutError()])
+def test_transient_errors_are_retried_until_max_attempts(max_attempts, error):
+    action, delay = line_gateway._reply_failure_plan('token-1', 'u1', error, 0, False)
+    assert action == 'retry' and delay > 0
+    assert line_gateway._reply_failure_plan('token-1', 'u1', error, 2, False) is None
+
+
+def test_client_errors_are_not_retried(max_attempts):
+    assert line_gateway._reply_failure_plan('token-1', 'u1', _line_error(400, 'bad request'), 0, False) is None
+
+
+class FakeBackground:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, delay, fn, *args):
+        self.scheduled.append((fn, args))
+
+
+def test_reply_attempts_are_numbered_like_push(max_attempts, monkeypatch):
+    attempts = []
+
+    class FakeApi:
+        def reply_message(self, reply_token, messages):
+            raise _line_error(500)
+
+    gateway = line_gateway.LineGateway(FakeApi())
+    gateway._background = FakeBackground()
+    real_call = gateway._call
+
+    def call(endpoint, send, attempt=0):
+        attempts.append(attempt)
+        return real_call(endpoint, send, attempt)
+
+    monkeypatch.setattr(gateway, '_call', call)
+    assert gateway.reply('token-1', 'u1', 'message') is False
+    while gateway._background.scheduled:
+        fn, args = gateway._background.scheduled.pop(0)
+        fn(*args)
+    assert attempts == [0, 1, 2]
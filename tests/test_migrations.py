@@ -0,0 +1,75 @@
+import sqlite3
+from datetime import datetime, timezone
+
+import db as db_module
+import migrations
+
+
+def _tables(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+
+def test_fresh_database_is_migrated_to_latest(tmp_path):
+    path = str(tmp_path / 'fresh.db')
+    helper = db_module.DBHelper(path)
+    latest = migrations.MIGRATIONS[-1][0]
+    assert migrations.current_version(helper) == latest
+    assert {'users', 'onetimes', 'cache_invalidations', 'postback_nonces', 'schema_migrations'} <= _tables(path)
+    # 2回目は何もしない
+    assert migrations.migrate(helper) == latest
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM schema_migrations').fetchone()[0] == len(migrations.MIGRATIONS)
+    helper.close()
+
+
+def test_versions_are_unique_and_ordered():
+    versions = [version for version, _, _ in migrations.MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert versions[0] == 1
+
+
+def test_legacy_text_timestamps_are_converted(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    helper = db_module.DBHelper(path, init_schema=False)
+    migrations._ensure_migrations_table(helper)
+    assert migrations._apply(helper, 1, 'baseline', migrations._baseline)
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at) VALUES (?, ?, ?, 0, ?)",
+            ('ABCD1234', 'u1', '2099-01-01T00:00:00', '2026-01-01T00:00:00')
+        )
+        conn.execute(
+            "INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at) VALUES (?, ?, ?, 0, ?)",
+            ('OLD00000', 'u2', '2020-01-01T00:00:00', '2020-01-01T00:00:00')
+        )
+        conn.execute(
+            "INSERT INTO users (line_user_id, google_token, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            ('u1', b'token', '2026-01-01T00:00:00.123456', '2026-01-02T00:00:00')
+        )
+        conn.execute(
+            "INSERT INTO reauth_notices (line_user_id, code, last_sent_at) VALUES (?, ?, ?)",
+            ('u1', 'ABCD1234', '2026-01-03T00:00:00')
+        )
+
+    assert migrations.migrate(helper) == migrations.MIGRATIONS[-1][0]
+    with sqlite3.connect(path) as conn:
+        expires_at = conn.execute("SELECT expires_at FROM onetimes WHERE code='ABCD1234'").fetchone()[0]
+    assert expires_at == int(datetime(2099, 1, 1, tzinfo=timezone.utc).timestamp())
+    assert helper.get_valid_onetime_code('u1') == 'ABCD1234'
+    assert helper.get_valid_onetime_code('u2') is None
+    [[user]] = list(helper.iter_user_batches())
+    assert user['created_at'] == datetime(2026, 1, 1, tzinfo=timezone.utc)
+    assert user['updated_at'] == datetime(2026, 1, 2, tzinfo=timezone.utc)
+    assert bytes(helper.get_google_token('u1')) == b'token'
+    assert helper.get_reauth_notice_sent_at('u1') == datetime(2026, 1, 3, tzinfo=timezone.utc)
+    helper.close()
+
+
+def test_user_and_reauth_timestamps_are_written_as_utc(sqlite_db):
+    before = datetime.now(timezone.utc).replace(microsecond=0)
+    sqlite_db.save_google_token_json('u1', '{}')
+    sqlite_db.record_reauth_notice('u1', 'ABCD1234')
+    [[user]] = list(sqlite_db.iter_user_batches())
+    assert user['created_at'] >= before and user['updated_at'] >= before
+    assert sqlite_db.get_reauth_notice_sent_at('u1') >= before
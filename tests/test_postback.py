@@ -0,0 +1,100 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import line_bot_handler as lbh
+from postback import (
+    ACTION_ADD, ACTION_CANCEL, MAX_DATA_LENGTH, InvalidPostback, decode_confirmation, encode_confirmation,
+)
+
+EVENT_INFO = {
+    'title': '打ち合わせ',
+    'start_datetime': '2026-07-10T09:00:00+09:00',
+    'end_datetime': '2026-07-10T10:00:00+09:00',
+    'description': '会議室A',
+    'has_travel': True,
+}
+
+
+def test_add_round_trip():
+    action, event_info = decode_confirmation(encode_confirmation(ACTION_ADD, 'u1', EVENT_INFO), 'u1')
+    assert action == ACTION_ADD
+    assert {k: v for k, v in event_info.items() if k != 'nonce'} == EVENT_INFO
+    assert event_info['nonce']
+
+
+def test_each_button_gets_its_own_nonce():
+    first = decode_confirmation(encode_confirmation(ACTION_ADD, 'u1', EVENT_INFO), 'u1')[1]
+    second = decode_confirmation(encode_confirmation(ACTION_ADD, 'u1', EVENT_INFO), 'u1')[1]
+    assert first['nonce'] != second['nonce']
+
+
+def test_cancel_round_trip():
+    assert decode_confirmation(encode_confirmation(ACTION_CANCEL, 'u1'), 'u1') == (ACTION_CANCEL, None)
+
+
+def test_rejects_other_user_and_tampered_data():
+    data = encode_confirmation(ACTION_ADD, 'u1', EVENT_INFO)
+    with pytest.raises(InvalidPostback):
+        decode_confirmation(data, 'u2')
+    with pytest.raises(InvalidPostback):
+        decode_confirmation(data.replace('打ち合わせ', '飲み会'), 'u1')
+
+
+def test_rejects_expired(monkeypatch):
+    data = encode_confirmation(ACTION_CANCEL, 'u1')
+    monkeypatch.setattr(time, 'time', lambda: 10 ** 10)
+    with pytest.raises(InvalidPostback):
+        decode_confirmation(data, 'u1')
+
+
+def test_too_long_event_does_not_fit():
+    assert encode_confirmation(ACTION_ADD, 'u1', dict(EVENT_INFO, description='長' * MAX_DATA_LENGTH)) is None
+
+
+class FakeCalendar:
+    def __init__(self, succeed=True):
+        self.added = []
+        self.succeed = succeed
+
+    def add_event(self, title, start, end, description, line_user_id=None, force_add=False):
+        self.added.append(title)
+        return self.succeed, 'message', None
+
+
+class FakeAI:
+    def format_event_confirmation(self, success, message, result):
+        return 'added' if success else 'failed'
+
+
+@pytest.fixture
+def handler(sqlite_db, monkeypatch):
+    monkeypatch.setattr(lbh, 'get_db', lambda: sqlite_db)
+    h = lbh.LineBotHandler()
+    h.calendar_service = FakeCalendar()
+    h.ai_service = FakeAI()
+    return h
+
+
+def _postback(data):
+    return SimpleNamespace(source=SimpleNamespace(user_id='u1'), postback=SimpleNamespace(data=data))
+
+
+def test_replayed_postback_adds_the_event_once(handler):
+    event = _postback(encode_confirmation(ACTION_ADD, 'u1', dict(EVENT_INFO, has_travel=False)))
+    assert handler.handle_postback(event).text == 'added'
+    # 連打・Webhookの再送
+    assert handler.handle_postback(event).text == lbh.POSTBACK_USED_TEXT
+    assert asyncio.run(handler.handle_postback_async(event)).text == lbh.POSTBACK_USED_TEXT
+    assert handler.calendar_service.added == ['打ち合わせ']
+
+
+def test_failed_add_can_be_retried_with_the_same_button(handler):
+    handler.calendar_service = FakeCalendar(succeed=False)
+    event = _postback(encode_confirmation(ACTION_ADD, 'u1', dict(EVENT_INFO, has_travel=False)))
+    assert handler.handle_postback(event).text == 'failed'
+    handler.calendar_service.succeed = True
+    assert handler.handle_postback(event).text == 'added'
+    assert handler.handle_postback(event).text == lbh.POSTBACK_USED_TEXT
@@ -0,0 +1,91 @@
+import gc
+
+import pytest
+
+from sql import INVALID_SQL_STATEMENT_NAME, Statement, StatementRunner
+
+
+class MissingPrepared(Exception):
+    pgcode = INVALID_SQL_STATEMENT_NAME
+
+
+class FakeInfo:
+    transaction_status = 0
+
+
+class FakeConnection:
+    def __init__(self):
+        self.info = FakeInfo()
+        self.prepared = set()  # サーバー側でPREPARE済みの文
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = 0
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        self.connection.info.transaction_status = 2  # INTRANS
+        if sql.startswith('PREPARE '):
+            self.connection.prepared.add(sql.split()[1])
+        elif sql.startswith('EXECUTE '):
+            if sql.split()[1] not in self.connection.prepared:
+                raise MissingPrepared('prepared statement does not exist')
+
+
+STMT = Statement('select_user', 'SELECT * FROM users WHERE line_user_id = %s', prepare=True)
+
+
+def test_statement_renders_each_dialect():
+    assert STMT.prepare_sql == 'PREPARE select_user AS SELECT * FROM users WHERE line_user_id = $1'
+    assert STMT.execute_sql == 'EXECUTE select_user (%s)'
+    assert STMT.sqlite_sql == 'SELECT * FROM users WHERE line_user_id = ?'
+
+
+def test_prepares_once_per_connection():
+    runner = StatementRunner(is_postgres=True)
+    c = FakeCursor(FakeConnection())
+    runner.execute(c, STMT, ('u1',))
+    runner.execute(c, STMT, ('u2',))
+    assert [sql.split()[0] for sql in c.executed] == ['PREPARE', 'EXECUTE', 'EXECUTE']
+
+
+def test_new_connection_does_not_inherit_prepared_set():
+    runner = StatementRunner(is_postgres=True)
+    runner.execute(FakeCursor(FakeConnection()), STMT, ('u1',))
+    gc.collect()
+    assert len(runner._prepared) == 0
+    c = FakeCursor(FakeConnection())
+    runner.execute(c, STMT, ('u1',))
+    assert c.executed[0].startswith('PREPARE ')
+
+
+def test_reprepares_and_retries_when_server_dropped_statement():
+    runner = StatementRunner(is_postgres=True)
+    conn = FakeConnection()
+    runner.execute(FakeCursor(conn), STMT, ('u1',))
+    conn.prepared.clear()  # DISCARD ALLなど
+    conn.info.transaction_status = 0
+    c = FakeCursor(conn)
+    runner.execute(c, STMT, ('u1',))
+    assert [sql.split()[0] for sql in c.executed] == ['EXECUTE', 'PREPARE', 'EXECUTE']
+    assert conn.rollbacks == 1
+
+
+def test_missing_statement_mid_transaction_is_raised_for_the_caller_to_retry():
+    runner = StatementRunner(is_postgres=True)
+    conn = FakeConnection()
+    runner.execute(FakeCursor(conn), STMT, ('u1',))
+    conn.prepared.clear()
+    with pytest.raises(MissingPrepared):
+        runner.execute(FakeCursor(conn), STMT, ('u1',))
+    assert conn.rollbacks == 0
+    c = FakeCursor(conn)
+    runner.execute(c, STMT, ('u1',))
+    assert c.executed[0].startswith('PREPARE ')
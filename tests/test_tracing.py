@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+import tracing
+
+
+@pytest.fixture
+def finished(monkeypatch):
+    traces = []
+    monkeypatch.setattr(tracing, '_finish', traces.append)
+    return traces
+
+
+def _span(trace, parent, category, start_ms, end_ms, error=None):
+    span = tracing.Span(trace, parent, category, 'op', {})
+    span.start_ns = int(start_ms * 1e6)
+    span.end_ns = int(end_ms * 1e6)
+    span.error = error
+    trace.spans.append(span)
+    return span
+
+
+def test_summarize_counts_calls_and_time_per_category():
+    trace = tracing.Trace()
+    root = _span(trace, None, 'webhook', 0, 100)
+    _span(trace, root, 'openai', 10, 60)
+    _span(trace, root, 'db', 60, 62)
+    _span(trace, root, 'db', 62, 65, error='OperationalError: boom')
+    # Webhookへの応答後に送るpush
+    _span(trace, root, 'line', 100, 150)
+    assert tracing.summarize(trace) == (
+        'total=150.0ms webhook=100.0ms openai=1/50ms calendar=0/0ms db=2/5ms(errors=1) line=1/50ms'
+    )
+
+
+def test_trace_finishes_after_its_last_span(finished):
+    with tracing.start_trace('webhook'):
+        with tracing.span('db', 'select'):
+            pass
+        deferred = tracing.span('line', 'push')
+    # ルートスパンは終わったが、pushのスパンが残っている
+    assert finished == []
+    with deferred:
+        pass
+    [trace] = finished
+    assert [s.category for s in trace.spans] == ['db', 'webhook', 'line']
+
+
+def test_span_outside_trace_is_null(finished):
+    assert tracing.span('db') is tracing.NULL_SPAN
+    with tracing.start_trace('webhook'):
+        pass
+    assert len(finished) == 1
+
+
+def test_context_carries_span_to_threads(finished):
+    import contextvars
+    with tracing.start_trace('webhook'):
+        context = contextvars.copy_context()
+
+        def work():
+            with tracing.span('openai', 'extract'):
+                pass
+
+        thread = threading.Thread(target=context.run, args=(work,))
+        thread.start()
+        thread.join()
+    [trace] = finished
+    root = next(s for s in trace.spans if s.parent_id is None)
+    assert [s.parent_id for s in trace.spans if s.category == 'openai'] == [root.span_id]
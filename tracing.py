@@ -0,0 +1,276 @@
+"""
+リクエストごとのトレース（スパン）
+- /callbackでWebhookのトレースを開始し（start_trace）、メッセージの処理（handler）・OpenAI・Calendar API・DB操作・LINEへの送信を
+  子スパンで計測する（span）。トレース外（日次予定送信など）のspanは何もしない
+- 現在のスパンはコンテキスト（ContextVar）で引き継ぐ（処理用のスレッド・asyncio.to_thread・asyncioのタスクにも引き継がれる）
+- トレースのすべてのスパンが終わった時点で、外部呼び出しの回数と時間を1行のログにまとめ、
+  TRACE_EXPORTER（jsonl: TRACE_JSONL_PATHへの追記 / otlp: TRACE_OTLP_ENDPOINTへのOTLP/HTTP JSON）に書き出す
+  （書き出しはバックグラウンドのスレッドで行い、キューが満杯のときは捨てる）
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from config import Config
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTS_DROPPED = registry.counter('trace_exports_dropped_total', '書き出しのキューが満杯のため捨てたトレースの数')
+TRACE_EXPORT_ERRORS = registry.counter('trace_export_errors_total', 'トレースの書き出しの失敗数')
+
+SERVICE_NAME = 'line-calendar-bot'
+
+# 1行のまとめに回数と時間を出す外部呼び出しの種類
+EXTERNAL_CATEGORIES = ('openai', 'calendar', 'db', 'line')
+
+_EXPORT_QUEUE_SIZE = 1000
+
+_current = contextvars.ContextVar('trace_span', default=None)
+
+
+def user_hash(line_user_id):
+    """スパンに記録するユーザーの識別子（LINEのユーザーIDそのものは記録しない）"""
+    return hashlib.sha256(line_user_id.encode('utf-8')).hexdigest()[:12]
+
+
+class Trace:
+    """1回のWebhookリクエストのスパンの集まり"""
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.finished = False
+        self._open = 0
+        self._lock = threading.Lock()
+
+    def _opened(self):
+        with self._lock:
+            if self.finished:
+                return False
+            self._open += 1
+            return True
+
+    def _closed(self, span):
+        with self._lock:
+            self.spans.append(span)
+            self._open -= 1
+            if self._open > 0:
+                return
+            self.finished = True
+        _finish(self)
+
+
+class Span:
+    """1つの処理段階（categoryは openai / calendar / db / line など、operationはその中の操作名）"""
+
+    def __init__(self, trace, parent, category, operation, attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.category = category
+        self.operation = operation
+        self.attributes = attributes
+        self.error = None
+        self.start_ns = None
+        self.end_ns = None
+        self._token = None
+
+    @property
+    def name(self):
+        return f"{self.category} {self.operation}" if self.operation else self.category
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def fail(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None and self.error is None:
+            self.fail(exc)
+        _current.reset(self._token)
+        self.trace._closed(self)
+        return False
+
+
+class _NullSpan:
+    """トレース外で使うスパン（何も記録しない）"""
+
+    def set(self, key, value):
+        pass
+
+    def fail(self, error):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def start_trace(name, **attributes):
+    """新しいトレースのルートスパン（withで使う。Webhookのリクエスト開始時に呼ぶ）"""
+    trace = Trace()
+    trace._opened()
+    return Span(trace, None, name, '', attributes)
+
+
+def span(category, operation='', **attributes):
+    """現在のトレースの子スパン（withで使う。トレース外・終了したトレースではNULL_SPAN）"""
+    parent = _current.get()
+    if parent is None or not parent.trace._opened():
+        return NULL_SPAN
+    return Span(parent.trace, parent, category, operation, attributes)
+
+
+def current_span():
+    """現在のスパン（トレース外ではNULL_SPAN）"""
+    return _current.get() or NULL_SPAN
+
+
+def summarize(trace):
+    """トレースの外部呼び出しの回数と時間の1行のまとめ（例: openai=1/812ms calendar=2/340ms ...）"""
+    root = next(s for s in trace.spans if s.parent_id is None)
+    # pushで送る応答はWebhookへの応答の後も処理が続くため、最後のスパンの終了までを合計とする
+    total_ms = (max(s.end_ns for s in trace.spans) - root.start_ns) / 1e6
+    parts = [f"total={total_ms:.1f}ms", f"{root.category}={root.duration_ms:.1f}ms"]
+    for category in EXTERNAL_CATEGORIES:
+        spans = [s for s in trace.spans if s.category == category]
+        errors = sum(1 for s in spans if s.error)
+        part = f"{category}={len(spans)}/{sum(s.duration_ms for s in spans):.0f}ms"
+        parts.append(f"{part}(errors={errors})" if errors else part)
+    return ' '.join(parts)
+
+
+def _finish(trace):
+    logger.info("トレース %s: %s", trace.trace_id, summarize(trace))
+    if Config.TRACE_EXPORTER:
+        _exporter().submit(trace)
+
+
+def _span_record(trace, s):
+    return {
+        'trace_id': trace.trace_id,
+        'span_id': s.span_id,
+        'parent_id': s.parent_id,
+        'name': s.name,
+        'start_ns': s.start_ns,
+        'duration_ms': round(s.duration_ms, 3),
+        'attributes': s.attributes,
+        'error': s.error,
+    }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_span(trace, s):
+    otlp = {
+        'traceId': trace.trace_id,
+        'spanId': s.span_id,
+        'name': s.name,
+        'kind': 2 if s.parent_id is None else 3,  # SERVER / CLIENT
+        'startTimeUnixNano': str(s.start_ns),
+        'endTimeUnixNano': str(s.end_ns),
+        'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in s.attributes.items()],
+        'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+    }
+    if s.parent_id:
+        otlp['parentSpanId'] = s.parent_id
+    return otlp
+
+
+def otlp_payload(traces):
+    """OTLP/HTTP（JSON）のExportTraceServiceRequest"""
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [_otlp_span(trace, s) for trace in traces for s in trace.spans],
+        }],
+    }]}
+
+
+class _Exporter:
+    """終了したトレースをバックグラウンドのスレッドで書き出す"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=_EXPORT_QUEUE_SIZE)
+        threading.Thread(target=self._run, name='trace-exporter', daemon=True).start()
+
+    def submit(self, trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            TRACE_EXPORTS_DROPPED.inc()
+
+    def _run(self):
+        while True:
+            traces = [self._queue.get()]
+            # 溜まっている分はまとめて書き出す
+            while len(traces) < 100:
+                try:
+                    traces.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._export(traces)
+            except Exception as e:
+                TRACE_EXPORT_ERRORS.inc()
+                logger.warning(f"トレースを書き出せませんでした: {e}")
+
+    def _export(self, traces):
+        if Config.TRACE_EXPORTER == 'otlp':
+            import requests
+            response = requests.post(Config.TRACE_OTLP_ENDPOINT, json=otlp_payload(traces), timeout=5)
+            response.raise_for_status()
+        else:
+            with open(Config.TRACE_JSONL_PATH, 'a', encoding='utf-8') as f:
+                for trace in traces:
+                    for s in trace.spans:
+                        f.write(json.dumps(_span_record(trace, s), ensure_ascii=False, default=str) + '\n')
+
+
+_shared_exporter = None
+_shared_exporter_pid = None
+_shared_exporter_lock = threading.Lock()
+
+
+def _exporter():
+    """プロセスで共有する書き出し用のスレッド（fork後のプロセスでは作り直す）"""
+    global _shared_exporter, _shared_exporter_pid
+    pid = os.getpid()
+    if _shared_exporter is not None and _shared_exporter_pid == pid:
+        return _shared_exporter
+    with _shared_exporter_lock:
+        if _shared_exporter is None or _shared_exporter_pid != pid:
+            _shared_exporter = _Exporter()
+            _shared_exporter_pid = pid
+        return _shared_exporter